@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of sort_media_files.py on a synthetic media corpus.
+
+The corpus is generated locally (and reproducibly, see ``--seed``):
+JPEG files with and without EXIF info, MP4 and QuickTime files with the
+creation time in their ``mvhd`` box, M2TS (BDAV) streams, junk files and
+bursts of pictures taken in the same second (name collisions).
+
+Measured (separately) in files/s and MB/s:
+    - discovery: globbing the source files
+    - location: ``_canonical_image_location`` per kind of file, and per
+      extraction backend (hits, and fallbacks as failed)
+    - collisions: choosing the output file names of the bursts
+    - transfer: copying the files to their output files
+    - total: ``process_media_files`` (with the default number of jobs)
+
+Startup (which doesn't parse any media files) is measured as well, in a
+new interpreter: importing the module and ``--help``. It fails (exit code
+1) if the media libraries get loaded or it takes longer than
+``--max-startup-ms``.
+
+Usage:
+    - python3 benchmark_media_files.py
+    - python3 benchmark_media_files.py --scale 10 --corpus-dir /tmp/corpus
+    - python3 benchmark_media_files.py --startup-only
+"""
+
+import datetime
+import logging
+import random
+import struct
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from glob import iglob
+from os import makedirs, stat
+from os.path import abspath, dirname, exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from statistics import median
+from time import perf_counter
+
+import sort_media_files
+
+# Files of each kind in the corpus (for --scale 1)
+_CORPUS_FILES = {
+    'jpeg-exif': 200,
+    'jpeg-no-exif': 50,
+    'mp4': 40,
+    'mov': 40,
+    'm2ts': 10,
+    'junk': 30,
+}
+# Bursts of pictures with the same date/time (for --scale 1)
+_BURSTS = 5
+_BURST_FILES = 40
+
+# Timestamps of the media files in the corpus
+_START_DATETIME = datetime.datetime(2015, 1, 1)
+_DATETIME_RANGE = 3 * 365 * 24 * 3600
+
+# Startup (median) not to exceed, in milliseconds
+_MAX_STARTUP_MS = 250
+# Commands (arguments of the interpreter) of the startup benchmark
+_STARTUP_COMMANDS = {
+    'import': ['-c', 'import sort_media_files'],
+    'help': ['sort_media_files.py', '--help'],
+}
+# Libraries which must not be loaded on startup
+_BACKEND_MODULES = ('exifread', 'MediaInfoDLL3', 'asyncio')
+
+_MP4_EPOCH = datetime.datetime(1904, 1, 1)
+_M2TS_PACKET_SIZE = 192
+
+
+def _jpeg(rng: random.Random, date_time: datetime.datetime = None,
+          size: int = 0) -> bytes:
+    """
+    Minimal baseline JPEG, with the DateTimeOriginal EXIF tag if
+    ``date_time`` is given, padded with (random) entropy coded data up to
+    ``size`` bytes.
+    """
+    data = b'\xff\xd8'
+    if date_time is not None:
+        date_time_value = date_time.strftime('%Y:%m:%d %H:%M:%S').encode()
+        # TIFF header, IFD0 (at 8) pointing to the EXIF IFD (at 26)
+        ifd0 = struct.pack('<HHHII', 1, 0x8769, 4, 1, 26) + bytes(4)
+        exif_ifd = struct.pack('<HHHII', 1, 0x9003, 2, 20, 44) + bytes(4)
+        tiff = (b'II*\0' + struct.pack('<I', 8) + ifd0 + exif_ifd +
+                date_time_value + b'\0')
+        app1 = b'Exif\0\0' + tiff
+        data += b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+    dqt = b'\x00' + b'\x01' * 64
+    data += b'\xff\xdb' + struct.pack('>H', len(dqt) + 2) + dqt
+    sof = b'\x08' + struct.pack('>HH', 1, 1) + b'\x01' + b'\x01\x11\x00'
+    data += b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof
+    for table_class in (0x00, 0x10):
+        dht = bytes([table_class]) + b'\x01' + bytes(16)
+        data += b'\xff\xc4' + struct.pack('>H', len(dht) + 2) + dht
+    sos = b'\x01' + b'\x01\x00' + b'\x00\x3f\x00'
+    data += b'\xff\xda' + struct.pack('>H', len(sos) + 2) + sos
+    # No markers in the entropy coded data
+    padding = rng.randbytes(max(size - len(data) - 2, 1)).replace(
+        b'\xff', b'\x00')
+    return data + padding + b'\xff\xd9'
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I', len(payload) + 8) + box_type + payload
+
+
+def _mp4(rng: random.Random, date_time: datetime.datetime, brand: bytes,
+         size: int) -> bytes:
+    """
+    MP4 (or QuickTime, by ``brand``) file with the creation time in the
+    ``mvhd`` box, padded with a (random) ``mdat`` box up to ``size`` bytes.
+    """
+    seconds = int((date_time - _MP4_EPOCH).total_seconds())
+    mvhd = (bytes(4) + struct.pack('>IIII', seconds, seconds, 1000, 1000) +
+            struct.pack('>IH', 0x10000, 0x100) + bytes(10) +
+            struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0,
+                        0x40000000) + bytes(24) + struct.pack('>I', 2))
+    data = (_box(b'ftyp', brand + bytes(4) + brand + b'mp41') +
+            _box(b'moov', _box(b'mvhd', mvhd)))
+    return data + _box(b'mdat', rng.randbytes(max(size - len(data) - 8, 0)))
+
+
+def _m2ts(rng: random.Random, size: int) -> bytes:
+    """
+    BDAV MPEG-2 transport stream: 188 byte TS packets, each with a 4 byte
+    timestamp header.
+    """
+    packets = []
+    for index in range(max(size // _M2TS_PACKET_SIZE, 1)):
+        pid = 0 if index % 100 == 0 else 0x1011
+        packets.append(
+            struct.pack('>IBBB', index * 1000 & 0x3fffffff, 0x47, pid >> 8,
+                        pid & 0xff) + bytes([0x10 | index & 0xf]) +
+            rng.randbytes(184))
+    return b''.join(packets)
+
+
+def _random_datetime(rng: random.Random) -> datetime.datetime:
+    return _START_DATETIME + datetime.timedelta(
+        seconds=rng.randrange(_DATETIME_RANGE))
+
+
+def generate_corpus(corpus_dir: str, scale: int = 1, seed: int = 0) -> dict:
+    """
+    Generate the corpus in ``corpus_dir`` and return the generated files
+    by kind. The same ``scale`` and ``seed`` always generate the same files.
+    """
+    rng = random.Random(seed)
+    corpus = {kind: [] for kind in _CORPUS_FILES}
+    corpus['burst'] = []
+
+    def write(kind: str, file_name: str, data: bytes):
+        file_dir = join(corpus_dir, kind)
+        makedirs(file_dir, exist_ok=True)
+        corpus_file = join(file_dir, file_name)
+        with open(corpus_file, 'wb') as corpus_fd:
+            corpus_fd.write(data)
+        corpus[kind].append(corpus_file)
+
+    for index in range(_CORPUS_FILES['jpeg-exif'] * scale):
+        write('jpeg-exif', f'IMG_{index:05d}.jpg',
+              _jpeg(rng, _random_datetime(rng), rng.randrange(50000, 500000)))
+    for index in range(_CORPUS_FILES['jpeg-no-exif'] * scale):
+        write('jpeg-no-exif', f'IMG_{index:05d}.jpg',
+              _jpeg(rng, None, rng.randrange(50000, 500000)))
+    for index in range(_CORPUS_FILES['mp4'] * scale):
+        write('mp4', f'VID_{index:05d}.mp4',
+              _mp4(rng, _random_datetime(rng), b'isom',
+                   rng.randrange(1000000, 8000000)))
+    for index in range(_CORPUS_FILES['mov'] * scale):
+        write('mov', f'MVI_{index:05d}.mov',
+              _mp4(rng, _random_datetime(rng), b'qt  ',
+                   rng.randrange(1000000, 8000000)))
+    for index in range(_CORPUS_FILES['m2ts'] * scale):
+        write('m2ts', f'{index:05d}.m2ts',
+              _m2ts(rng, rng.randrange(1000000, 4000000)))
+    for index in range(_CORPUS_FILES['junk'] * scale):
+        write('junk', f'file{index:05d}', rng.randbytes(rng.randrange(1,
+                                                                      100000)))
+    for burst in range(_BURSTS * scale):
+        date_time = _random_datetime(rng)
+        for index in range(_BURST_FILES):
+            write('burst', f'BURST_{burst:03d}_{index:03d}.jpg',
+                  _jpeg(rng, date_time, rng.randrange(50000, 500000)))
+    return corpus
+
+
+def _size(files: list) -> int:
+    return sum(stat(corpus_file).st_size for corpus_file in files)
+
+
+def _report(stage: str, files: int, size: int, seconds: float,
+            failed: int = 0):
+    print(f'{stage:<24} {files:>7} {failed:>7} {seconds:>9.3f} '
+          f'{files / seconds if seconds else 0:>10.1f} '
+          f'{size / 1e6 / seconds if seconds else 0:>9.1f}')
+
+
+def benchmark_discovery(corpus_dir: str, repeat: int = 5):
+    start = perf_counter()
+    for _ in range(repeat):
+        files = list(iglob(join(corpus_dir, '**'), recursive=True))
+    seconds = (perf_counter() - start) / repeat
+    _report('discovery', len(files), 0, seconds)
+
+
+def benchmark_startup(max_startup_ms: float = _MAX_STARTUP_MS,
+                      repeat: int = 5) -> bool:
+    """
+    Measure the startup of new interpreters (see :data:`_STARTUP_COMMANDS`)
+    and check that no media library is loaded. Returns whether startup is
+    fine.
+    """
+    script_dir = dirname(abspath(sort_media_files.__file__))
+    is_fine = True
+    for command, args in _STARTUP_COMMANDS.items():
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            subprocess.run([sys.executable, *args],
+                           cwd=script_dir,
+                           stdout=subprocess.DEVNULL,
+                           check=True)
+            times.append(perf_counter() - start)
+        startup_ms = median(times) * 1000
+        print(f'startup {command:<16} {startup_ms:>9.1f} ms '
+              f'(max {max_startup_ms:g} ms)')
+        if startup_ms > max_startup_ms:
+            print(f'Startup ({command}) too slow', file=sys.stderr)
+            is_fine = False
+
+    loaded_modules = subprocess.run(
+        [
+            sys.executable, '-c', 'import sys, sort_media_files; '
+            f'print(*(m for m in {_BACKEND_MODULES!r} if m in sys.modules))'
+        ],
+        cwd=script_dir,
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True).stdout.split()
+    if loaded_modules:
+        print(f'Loaded on startup: {", ".join(loaded_modules)}',
+              file=sys.stderr)
+        is_fine = False
+    return is_fine
+
+
+def benchmark_location(corpus: dict) -> dict:
+    """
+    Run :func:`sort_media_files._canonical_image_location` on every file,
+    per kind of file, then per extraction backend. Returns the locations of
+    the files (or ``None``).
+    """
+    for backend in sort_media_files._EXTRACTION_BACKENDS:
+        backend.reset()
+    locations = {}
+    for kind, files in corpus.items():
+        failed = 0
+        start = perf_counter()
+        for corpus_file in files:
+            try:
+                locations[corpus_file] = (
+                    sort_media_files._canonical_image_location(corpus_file))
+            except Exception:
+                locations[corpus_file] = None
+                failed += 1
+        seconds = perf_counter() - start
+        _report(f'location {kind}', len(files), _size(files), seconds,
+                failed)
+    for backend in sort_media_files._EXTRACTION_BACKENDS:
+        hits, fallbacks, latency = backend.counters()
+        _report(f'backend {backend.name}', hits, 0, latency.total, fallbacks)
+    return locations
+
+
+def benchmark_collisions(corpus: dict, locations: dict, dest_dir: str):
+    """
+    Choose the output file names of the bursts (same date/time), creating
+    the output files (empty) so later ones collide with them.
+    """
+    files = [
+        corpus_file for corpus_file in corpus['burst']
+        if locations[corpus_file] is not None
+    ]
+    start = perf_counter()
+    for corpus_file in files:
+        output_file = sort_media_files._plan_output_file(
+            corpus_file,
+            dest_dir,
+            locate_function=lambda corpus_file: locations[corpus_file])
+        makedirs(dirname(output_file), exist_ok=True)
+        open(output_file, 'wb').close()
+    seconds = perf_counter() - start
+    _report('collisions', len(files), 0, seconds)
+
+
+def benchmark_transfer(corpus: dict, locations: dict, dest_dir: str):
+    """
+    Copy the located files to their output files (the source files are
+    in the page cache after generating them).
+    """
+    files = [
+        corpus_file for corpus_file in sorted(locations)
+        if locations[corpus_file] is not None
+    ]
+    process_function = sort_media_files._generate_process_function(
+        is_copy=True, is_dryrun=False)
+    reserved_files = set()
+    output_files = [
+        sort_media_files._plan_output_file(
+            corpus_file,
+            dest_dir,
+            locate_function=lambda corpus_file: locations[corpus_file],
+            reserved_files=reserved_files) for corpus_file in files
+    ]
+    start = perf_counter()
+    for corpus_file, output_file in zip(files, output_files):
+        process_function(corpus_file, output_file)
+    seconds = perf_counter() - start
+    _report('transfer', len(files), _size(files), seconds)
+
+
+def benchmark_total(corpus_dir: str, corpus: dict, dest_dir: str):
+    files = [corpus_file for files in corpus.values() for corpus_file in files]
+    process_function = sort_media_files._generate_process_function(
+        is_copy=True, is_dryrun=False)
+    failed = 0
+
+    def on_result(result):
+        nonlocal failed
+        failed += result.status == 'failed'
+
+    start = perf_counter()
+    with ThreadPoolExecutor(
+            max_workers=sort_media_files._DEFAULT_JOBS) as executor:
+        sort_media_files.process_media_files(join(corpus_dir, '**'),
+                                             dest_dir,
+                                             process_function=process_function,
+                                             executor=executor,
+                                             on_result=on_result)
+    seconds = perf_counter() - start
+    _report('total', len(files), _size(files), seconds, failed)
+
+
+def main(args=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--corpus-dir',
+                        dest='corpus_dir',
+                        help='Directory to generate the corpus in, which is '
+                        'kept (default: temporary directory)')
+    parser.add_argument('--scale',
+                        dest='scale',
+                        type=int,
+                        default=1,
+                        help='Size of the corpus (default: %(default)s, '
+                        'about 1000 files and 500 MB)')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default=0,
+                        help='Seed of the corpus (default: %(default)s)')
+    parser.add_argument('--max-startup-ms',
+                        dest='max_startup_ms',
+                        type=float,
+                        default=_MAX_STARTUP_MS,
+                        help='Slowest acceptable startup in milliseconds '
+                        '(default: %(default)g)')
+    parser.add_argument('--startup-only',
+                        dest='startup_only',
+                        action='store_true',
+                        help='Only measure the startup (no corpus)')
+    options = parser.parse_args(args=args)
+    if options.corpus_dir is not None and exists(options.corpus_dir):
+        parser.error(f'{options.corpus_dir} exists already')
+
+    if not benchmark_startup(options.max_startup_ms):
+        return 1
+    if options.startup_only:
+        return 0
+
+    # The failures of the junk files are expected
+    logging.basicConfig(level=logging.CRITICAL)
+
+    work_dir = mkdtemp(prefix='benchmark-media-files-')
+    try:
+        corpus_dir = options.corpus_dir or join(work_dir, 'corpus')
+        start = perf_counter()
+        corpus = generate_corpus(corpus_dir,
+                                 scale=options.scale,
+                                 seed=options.seed)
+        print(f'Generated {sum(len(files) for files in corpus.values())} '
+              f'files in {perf_counter() - start:.1f}s')
+
+        print(f'{"stage":<24} {"files":>7} {"failed":>7} {"seconds":>9} '
+              f'{"files/s":>10} {"MB/s":>9}')
+        benchmark_discovery(corpus_dir)
+        locations = benchmark_location(corpus)
+        benchmark_collisions(corpus, locations, join(work_dir, 'collisions'))
+        benchmark_transfer(corpus, locations, join(work_dir, 'transfer'))
+        benchmark_total(corpus_dir, corpus, join(work_dir, 'total'))
+    finally:
+        rmtree(work_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
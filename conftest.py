@@ -0,0 +1,2 @@
+# test_media_file.py is a script dumping the MediaInfo tags of a file
+collect_ignore = ['test_media_file.py']
@@ -16,16 +16,49 @@
 #                     level=logging.DEBUG if _DEBUG else logging.INFO,
 #                     format='%(message)s')
 
+import ctypes
 import datetime
-import exifread
-import MediaInfoDLL3
+import errno
+import filecmp
+import hashlib
+import json
 import logging
+import math
+import re
+import sys
+import tarfile
+import zlib
 
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque, namedtuple
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import (FIRST_COMPLETED, Executor, ThreadPoolExecutor,
+                                wait)
+from fcntl import ioctl
+from functools import partial
 from glob import iglob
-from os import makedirs, stat
-from os.path import basename, dirname, exists, isdir, join, splitext
-from pprint import pformat
-from shutil import copy2 as copy, move
+from importlib import import_module
+from os import (O_CLOEXEC, O_NONBLOCK, O_RDONLY, chdir, chmod, close,
+                cpu_count, fsdecode, fsencode, fstat, fsync, getcwd, major,
+                makedirs, minor, nice, open as os_open, read, rename, rmdir,
+                scandir, sep, stat, link, unlink, utime, walk)
+from os.path import (abspath, basename, dirname, exists, isdir, join, relpath,
+                     splitext)
+try:
+    from os import POSIX_FADV_DONTNEED, POSIX_FADV_WILLNEED, posix_fadvise
+except ImportError:
+    # Not available on all platforms (e.g. macOS)
+    POSIX_FADV_DONTNEED = POSIX_FADV_WILLNEED = posix_fadvise = None
+from select import select
+from shutil import copy2 as copy, copyfileobj, copystat, move
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from stat import S_ISBLK, S_ISDIR
+from struct import calcsize, pack, unpack_from
+from tempfile import gettempdir, mkstemp
+from threading import (BoundedSemaphore, Condition, Event, Lock, Semaphore,
+                       Thread, get_ident)
+from time import monotonic, perf_counter, sleep, time
+from zipfile import BadZipFile, ZipFile
 
 _EXIF_DATETIME_ORIGINAL = 'EXIF DateTimeOriginal'
 _EXIF_DATETIME_DIGITIZED = 'EXIF DateTimeDigitized'
@@ -36,6 +69,651 @@ _TRY_TAGS = (_EXIF_DATETIME_ORIGINAL, _EXIF_DATETIME_DIGITIZED,
 
 _LOGGER = logging.getLogger(__name__)
 
+# Libraries of the backends parsing media files
+_BACKEND_MODULES = {
+    'exifread': 'exifread',
+    'mediainfo': 'MediaInfoDLL3',
+}
+# Imported backend libraries
+_backend_modules = {}
+
+
+def _backend_module(backend: str):
+    """
+    Return the library of ``backend``, imported on first use. Runs which
+    don't parse media files (e.g. ``--help``, ``--undo`` or re-layouts of
+    sorted files) and library users thus don't pay for loading them.
+    """
+    module = _backend_modules.get(backend)
+    if module is None:
+        # Imports are thread-safe
+        module = import_module(_BACKEND_MODULES[backend])
+        _backend_modules[backend] = module
+    return module
+
+
+# Summaries, still logged with --quiet
+_SUMMARY_LOGGER = logging.getLogger(f'{__name__}.summary')
+
+
+class _LazyFormat:
+    """
+    Pretty-print ``obj`` (see :func:`pprint.pformat`) only once the log
+    record is actually emitted, e.g. for debug dumps.
+    """
+
+    __slots__ = ('obj', )
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        from pprint import pformat
+
+        return pformat(self.obj)
+
+
+# Same default as for ThreadPoolExecutor (most work is waiting for I/O)
+_DEFAULT_JOBS = min(32, (cpu_count() or 1) + 4)
+# Maximum number of worker threads for --jobs auto
+_MAX_AUTO_JOBS = 64
+
+
+class _LatencyHistogram:
+    """
+    Latencies (in seconds) counted in logarithmic buckets (of ``BASE``),
+    to get percentiles (within a few percent) in constant memory.
+    """
+
+    BASE = 1.05
+    # Shortest latency told apart
+    MIN_SECONDS = 1e-7
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.bytes = 0
+        self.buckets = {}
+
+    def add(self, seconds: float, size: int = 0):
+        self.count += 1
+        self.total += seconds
+        self.bytes += size
+        bucket = int(
+            math.log(max(seconds, self.MIN_SECONDS)) / math.log(self.BASE))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def copy(self):
+        histogram = _LatencyHistogram()
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.bytes = self.bytes
+        histogram.buckets = dict(self.buckets)
+        return histogram
+
+    def cumulative_counts(self, bounds: tuple) -> list:
+        """
+        Number of latencies up to each of the (ascending) ``bounds``.
+        """
+        counts = []
+        count = 0
+        buckets = sorted(self.buckets.items())
+        for bound in bounds:
+            while buckets and self.BASE**(buckets[0][0] + 0.5) <= bound:
+                count += buckets.pop(0)[1]
+            counts.append(count)
+        return counts
+
+    def percentile(self, percent: float) -> float:
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # Middle of the bucket
+                return self.BASE**(bucket + 0.5)
+        return 0.0
+
+
+def _stats_extension(input_file: str) -> str:
+    """
+    File extension of ``input_file`` for the statistics (lower case).
+    """
+    return splitext(input_file)[1][1:].lower() or '-'
+
+
+class _StageTimer:
+
+    def __init__(self, stats, stage: str, input_file: str, size: int):
+        self._stats = stats
+        self._stage = stage
+        self._input_file = input_file
+        self._size = size
+
+    def __enter__(self):
+        tags = self._stats.tags
+        if tags is not None:
+            ident = get_ident()
+            self._previous_tag = tags.get(ident)
+            tags[ident] = (self._stage, _stats_extension(self._input_file))
+        self._start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._stats.record(self._stage, self._input_file,
+                           perf_counter() - self._start, self._size)
+        tags = self._stats.tags
+        if tags is not None:
+            tags[get_ident()] = self._previous_tag
+
+
+class _Stats:
+    """
+    Timings of the stages of a run (see ``--stats``), per stage and per
+    file extension. Costs a single check per stage unless
+    enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # Decisions of the _ConcurrencyController (if any)
+        self.decisions = []
+        self._lock = Lock()
+        self._histograms = {}
+        self._results = {}
+        self._start = None
+        # Details per input file (see --manifest), if tracked
+        self._details = None
+        # Stage and file extension per thread (see --profile), if tracked
+        self.tags = None
+        # Queue name => depths (see _StageConcurrency), while running
+        self.queues = {}
+
+    @property
+    def tracks_details(self) -> bool:
+        return self._details is not None
+
+    def enable(self, details: bool = False):
+        self.decisions = []
+        self.queues = {}
+        self._histograms = {}
+        self._results = {}
+        self._details = {} if details else None
+        for backend in _EXTRACTION_BACKENDS:
+            backend.reset()
+        self._start = monotonic()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def timer(self, stage: str, input_file: str, size: int = 0):
+        """
+        Context manager timing ``stage`` for ``input_file`` (of ``size``
+        bytes transferred).
+        """
+        if not self.enabled:
+            return _NO_TIMER
+        return _StageTimer(self, stage, input_file, size)
+
+    def record(self, stage: str, input_file: str, seconds: float,
+               size: int = 0):
+        extension = _stats_extension(input_file)
+        with self._lock:
+            for key in ((stage, None), (stage, extension)):
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = _LatencyHistogram()
+                histogram.add(seconds, size)
+            if self._details is not None:
+                timings = self._details.setdefault(input_file,
+                                                   {}).setdefault(
+                                                       'timings', {})
+                timings[stage] = timings.get(stage, 0.0) + seconds
+
+    def note(self, input_file: str, **details):
+        """
+        Add ``details`` (e.g. the media type) of ``input_file``, if tracked.
+        """
+        if self._details is None:
+            return
+        with self._lock:
+            self._details.setdefault(input_file, {}).update(details)
+
+    def move_details(self, input_file: str, other_file: str):
+        """
+        Add the details of ``input_file`` (e.g. a temporary file) to
+        ``other_file``.
+        """
+        if self._details is None:
+            return
+        with self._lock:
+            details = self._details.pop(input_file, {})
+            timings = details.pop('timings', {})
+            other_details = self._details.setdefault(other_file, {})
+            other_details.update(details)
+            other_timings = other_details.setdefault('timings', {})
+            for stage, seconds in timings.items():
+                other_timings[stage] = other_timings.get(stage, 0.0) + seconds
+
+    def histograms(self) -> dict:
+        """
+        Copy of the latency histogram of each stage (all file extensions).
+        """
+        histograms = {}
+        with self._lock:
+            for (stage, extension), histogram in self._histograms.items():
+                if extension is None:
+                    histograms[stage] = histogram.copy()
+        return histograms
+
+    def transferred(self) -> int:
+        """
+        Bytes transferred so far.
+        """
+        with self._lock:
+            histogram = self._histograms.get(('transfer', None))
+            return 0 if histogram is None else histogram.bytes
+
+    def pop_details(self, input_file: str) -> dict:
+        if self._details is None:
+            return {}
+        with self._lock:
+            return self._details.pop(input_file, {})
+
+    def timed(self, stage: str, input_files):
+        """
+        Yield the ``input_files``, timing each of them as ``stage``.
+        """
+        input_files = iter(input_files)
+        while True:
+            start = perf_counter()
+            try:
+                input_file = next(input_files)
+            except StopIteration:
+                return
+            self.record(stage, input_file, perf_counter() - start)
+            yield input_file
+
+    def result(self, result):
+        with self._lock:
+            self._results[result.status] = self._results.get(
+                result.status, 0) + 1
+
+    def report(self):
+        elapsed = max(monotonic() - self._start, 1e-9)
+        files = sum(self._results.values())
+        transfer = self._histograms.get(('transfer', None),
+                                        _LatencyHistogram())
+        _SUMMARY_LOGGER.info(
+            'Stats: %d files (%s) in %.1f s, %.1f files/s, '
+            '%.1f MB transferred, %.1f MB/s', files,
+            ', '.join(f'{count} {status}'
+                      for status, count in sorted(self._results.items())),
+            elapsed, files / elapsed, transfer.bytes / 1e6,
+            transfer.bytes / 1e6 / elapsed)
+        _SUMMARY_LOGGER.info('%-10s %-8s %9s %10s %9s %9s %9s', 'stage',
+                             'ext', 'count', 'total s', 'p50 ms', 'p95 ms',
+                             'p99 ms')
+        for stage, extension in sorted(self._histograms,
+                                       key=lambda key:
+                                       (_STAGES.index(key[0]), key[1]
+                                        is not None, key[1] or '')):
+            histogram = self._histograms[stage, extension]
+            _SUMMARY_LOGGER.info('%-10s %-8s %9d %10.3f %9.3f %9.3f %9.3f',
+                                 stage if extension is None else '',
+                                 extension or 'all', histogram.count,
+                                 histogram.total,
+                                 histogram.percentile(50) * 1000,
+                                 histogram.percentile(95) * 1000,
+                                 histogram.percentile(99) * 1000)
+        _SUMMARY_LOGGER.info('%-10s %9s %9s %10s %9s %9s %9s', 'backend',
+                             'hits', 'fallbacks', 'total s', 'p50 ms',
+                             'p95 ms', 'p99 ms')
+        for backend in _EXTRACTION_BACKENDS:
+            hits, fallbacks, latency = backend.counters()
+            if latency.count == 0:
+                continue
+            _SUMMARY_LOGGER.info('%-10s %9d %9d %10.3f %9.3f %9.3f %9.3f',
+                                 backend.name, hits, fallbacks,
+                                 latency.total,
+                                 latency.percentile(50) * 1000,
+                                 latency.percentile(95) * 1000,
+                                 latency.percentile(99) * 1000)
+        for (elapsed, stage, old_limit, new_limit, files_per_sec,
+             mb_per_sec, reason) in self.decisions:
+            _SUMMARY_LOGGER.info(
+                'Auto jobs at %.1f s: %s workers %d -> %d (%.1f files/s, '
+                '%.1f MB/s, %s)', elapsed, stage, old_limit, new_limit,
+                files_per_sec, mb_per_sec, reason)
+
+
+# Stages timed with --stats (in the order of processing)
+_STAGES = ('discovery', 'extract', 'open', 'exif', 'date', 'naming', 'mkdir',
+           'digest', 'transfer')
+_NO_TIMER = nullcontext()
+_STATS = _Stats()
+
+# Seconds between the progress lines of --progress (when not on a terminal)
+_PROGRESS_INTERVAL = 10.0
+# Seconds between the refreshes of the status line of --progress (terminal)
+_PROGRESS_REFRESH = 0.5
+
+
+class _ProgressReporter(Thread):
+    """
+    Report the progress of a run (see ``--progress``): the processed files
+    out of the discovered ones, the failures, the files/s and MB/s (of the
+    last ``WINDOW`` seconds) and the estimated time left.
+
+    On a terminal, a status line is refreshed every ``refresh`` seconds.
+    Otherwise (e.g. redirected to a log file), a plain line is logged every
+    ``interval`` seconds. Either way, the refresh rate doesn't depend on
+    the processed files.
+
+    The total is the number of input files discovered so far (see
+    :meth:`discovering`), so the time left is only estimated once the
+    discovery finished, unless the input files are counted ahead (see
+    :meth:`precount`).
+    """
+
+    # Seconds of the moving window of the rates
+    WINDOW = 10.0
+
+    def __init__(self,
+                 interval: float = _PROGRESS_INTERVAL,
+                 refresh: float = _PROGRESS_REFRESH,
+                 stream=None):
+        super().__init__(name='progress-reporter', daemon=True)
+        self.stream = sys.stdout if stream is None else stream
+        self.is_tty = self.stream.isatty()
+        self.interval = refresh if self.is_tty else interval
+        self.discovered = 0
+        self.total = None
+        self._results = {}
+        # (timestamp, files, bytes)
+        self._samples = deque()
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._start = None
+
+    def start(self):
+        self._start = monotonic()
+        super().start()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        if self.is_tty:
+            # Replaced by the summary
+            self.stream.write('\r\033[K')
+            self.stream.flush()
+        self._report(final=True)
+
+    def precount(self, source_files: str, shard: tuple = None):
+        """
+        Count the input files in the background, while they are processed
+        (only names are matched, nothing is parsed).
+        """
+        Thread(target=self._count,
+               args=(source_files, shard),
+               name='progress-precount',
+               daemon=True).start()
+
+    def _count(self, source_files: str, shard: tuple):
+        root_dir = _glob_root(source_files)
+        total = 0
+        for input_file in iglob(source_files, recursive=True):
+            if shard is None or _in_shard(input_file, root_dir, shard):
+                total += 1
+        # The discovery may have been faster
+        if self.total is None:
+            self.total = total
+
+    def discovering(self, input_files):
+        """
+        Yield the ``input_files``, counting them.
+        """
+        for input_file in input_files:
+            self.discovered += 1
+            yield input_file
+        self.total = self.discovered
+
+    def result(self, result):
+        with self._lock:
+            self._results[result.status] = self._results.get(
+                result.status, 0) + 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._report()
+
+    def _report(self, final: bool = False):
+        now = monotonic()
+        with self._lock:
+            results = dict(self._results)
+        files = sum(results.values())
+        size = _STATS.transferred()
+
+        if final:
+            since, since_files, since_size = self._start, 0, 0
+        else:
+            self._samples.append((now, files, size))
+            while now - self._samples[0][0] > self.WINDOW:
+                self._samples.popleft()
+            since, since_files, since_size = self._samples[0]
+            if since == now:
+                since, since_files, since_size = self._start, 0, 0
+        elapsed = max(now - since, 1e-9)
+        files_per_sec = (files - since_files) / elapsed
+        mb_per_sec = (size - since_size) / elapsed / 1e6
+
+        total = self.total
+        if total is None:
+            done = f'{files}/{self.discovered}+ files'
+        else:
+            done = f'{files}/{total} files ({files / max(total, 1):.1%})'
+        line = (f'{done}, {results.get("failed", 0)} failed, '
+                f'{files_per_sec:.1f} files/s, {mb_per_sec:.1f} MB/s')
+
+        if final:
+            _SUMMARY_LOGGER.info(
+                'Progress: %s, %.1f MB in %s', line, size / 1e6,
+                datetime.timedelta(seconds=round(now - self._start)))
+            return
+        if total is None or files_per_sec == 0:
+            eta = '?'
+        else:
+            eta = datetime.timedelta(seconds=round(
+                max(total - files, 0) / files_per_sec))
+        if self.is_tty:
+            self.stream.write(f'\r\033[K{line}, ETA {eta}')
+            self.stream.flush()
+        else:
+            _SUMMARY_LOGGER.info('Progress: %s, ETA %s', line, eta)
+
+
+# Seconds between the updates of the metrics file (see --metrics-file)
+_METRICS_INTERVAL = 15.0
+_METRICS_PREFIX = 'sort_media_files'
+# Upper bounds (seconds) of the buckets of the latency histograms
+_METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _metric_labels(**labels) -> str:
+    return ','.join('{}="{}"'.format(
+        name,
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for name, value in labels.items())
+
+
+def _metric_media(result) -> tuple:
+    """
+    Media type (image, video, audio or other) and file extension labels of
+    the metrics for ``result``, from the extension of its output file (as
+    chosen by the extraction backend), if any. Extensions which are not
+    supported are reported as ``other``, to keep the number of series
+    bounded whatever the source directory holds.
+    """
+    extension = _stats_extension(result.output_file or result.input_file)
+    media_subdir = _MEDIA_EXTENSION_SUBDIRS.get(extension)
+    if media_subdir is None:
+        return 'other', 'other'
+    return _METRIC_MEDIA_TYPES.get(media_subdir, 'other'), extension
+
+
+class _MetricsExporter(Thread):
+    """
+    Write the metrics of a run in the Prometheus text format to
+    ``metrics_file`` every ``interval`` seconds and at the end (see
+    ``--metrics-file``), e.g. for the textfile collector of node_exporter:
+
+    - processed files by status, media type, file extension and reason
+      (class of the error, or why the file was skipped)
+    - latency histograms of the stages (see :data:`_STAGES`)
+    - files extracted (or not) and latency histograms per extraction
+      backend (see :class:`_ExtractionBackend`)
+    - bytes transferred
+    - depths of the queues (parsing and transfer lanes)
+
+    The file is replaced atomically, so it is never read half-written.
+    """
+
+    def __init__(self, metrics_file: str, interval: float = _METRICS_INTERVAL):
+        super().__init__(name='metrics-exporter', daemon=True)
+        self.metrics_file = metrics_file
+        self.interval = interval
+        # (status, media type, file extension, reason) => files
+        self._files = {}
+        self._lock = Lock()
+        self._stop_event = Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.write()
+
+    def result(self, result):
+        if result.reason is not None:
+            reason = result.reason
+        elif result.error is not None:
+            # The error is '<class>: <message>' (see _failed_result)
+            reason = result.error.split(':', 1)[0]
+        else:
+            reason = ''
+        key = (result.status, *_metric_media(result), reason)
+        with self._lock:
+            self._files[key] = self._files.get(key, 0) + 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.write()
+            except:
+                _LOGGER.exception('Failed to write metrics to %s',
+                                  self.metrics_file)
+
+    def _format(self) -> str:
+        lines = [
+            f'# HELP {_METRICS_PREFIX}_files_total Processed files.',
+            f'# TYPE {_METRICS_PREFIX}_files_total counter',
+        ]
+        with self._lock:
+            files = dict(self._files)
+        for (status, media_type, extension,
+             reason), count in sorted(files.items()):
+            labels = _metric_labels(status=status,
+                                    media_type=media_type,
+                                    extension=extension,
+                                    reason=reason)
+            lines.append(f'{_METRICS_PREFIX}_files_total{{{labels}}} {count}')
+
+        lines += [
+            f'# HELP {_METRICS_PREFIX}_stage_duration_seconds Duration of '
+            'the processing stages per file.',
+            f'# TYPE {_METRICS_PREFIX}_stage_duration_seconds histogram',
+        ]
+        name = f'{_METRICS_PREFIX}_stage_duration_seconds'
+        histograms = _STATS.histograms()
+        for stage in _STAGES:
+            histogram = histograms.get(stage)
+            if histogram is None:
+                continue
+            for bound, count in zip(
+                    _METRICS_BUCKETS,
+                    histogram.cumulative_counts(_METRICS_BUCKETS)):
+                labels = _metric_labels(stage=stage, le=bound)
+                lines.append(f'{name}_bucket{{{labels}}} {count}')
+            labels = _metric_labels(stage=stage, le='+Inf')
+            lines.append(f'{name}_bucket{{{labels}}} {histogram.count}')
+            labels = _metric_labels(stage=stage)
+            lines.append(f'{name}_sum{{{labels}}} {histogram.total}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+        lines += [
+            f'# HELP {_METRICS_PREFIX}_backend_files_total Files extracted '
+            '(hit) or passed on to the next backend (fallback).',
+            f'# TYPE {_METRICS_PREFIX}_backend_files_total counter',
+        ]
+        backends = [(backend.name, ) + backend.counters()
+                    for backend in _EXTRACTION_BACKENDS]
+        for backend, hits, fallbacks, _ in backends:
+            for result, count in (('hit', hits), ('fallback', fallbacks)):
+                labels = _metric_labels(backend=backend, result=result)
+                lines.append(
+                    f'{_METRICS_PREFIX}_backend_files_total{{{labels}}} '
+                    f'{count}')
+        lines += [
+            f'# HELP {_METRICS_PREFIX}_backend_duration_seconds Duration of '
+            'the extraction backends per file.',
+            f'# TYPE {_METRICS_PREFIX}_backend_duration_seconds histogram',
+        ]
+        name = f'{_METRICS_PREFIX}_backend_duration_seconds'
+        for backend, _, _, histogram in backends:
+            for bound, count in zip(
+                    _METRICS_BUCKETS,
+                    histogram.cumulative_counts(_METRICS_BUCKETS)):
+                labels = _metric_labels(backend=backend, le=bound)
+                lines.append(f'{name}_bucket{{{labels}}} {count}')
+            labels = _metric_labels(backend=backend, le='+Inf')
+            lines.append(f'{name}_bucket{{{labels}}} {histogram.count}')
+            labels = _metric_labels(backend=backend)
+            lines.append(f'{name}_sum{{{labels}}} {histogram.total}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+        lines += [
+            f'# HELP {_METRICS_PREFIX}_transferred_bytes_total Bytes '
+            'transferred.',
+            f'# TYPE {_METRICS_PREFIX}_transferred_bytes_total counter',
+            f'{_METRICS_PREFIX}_transferred_bytes_total '
+            f'{_STATS.transferred()}',
+            f'# HELP {_METRICS_PREFIX}_queue_depth Files waiting to be '
+            'processed by a stage (or ready for the next stage).',
+            f'# TYPE {_METRICS_PREFIX}_queue_depth gauge',
+        ]
+        for queue, queue_depth in sorted(_STATS.queues.items()):
+            waiting, ready = queue_depth()
+            for state, depth in (('waiting', waiting), ('ready', ready)):
+                labels = _metric_labels(queue=queue, state=state)
+                lines.append(
+                    f'{_METRICS_PREFIX}_queue_depth{{{labels}}} {depth}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        metrics = self._format()
+        # Not *.prom, which is picked up by the textfile collector
+        temp_fd, temp_file = mkstemp(prefix=_TEMP_FILE_PREFIX,
+                                     suffix='.tmp',
+                                     dir=dirname(abspath(self.metrics_file)))
+        try:
+            with open(temp_fd, 'w', encoding='utf-8') as metrics_fd:
+                metrics_fd.write(metrics)
+            chmod(temp_file, 0o644)
+            rename(temp_file, self.metrics_file)
+        finally:
+            if exists(temp_file):
+                unlink(temp_file)
+
 
 def _get_mtime(input_file: str):
     file_stat = stat(input_file)
@@ -51,13 +729,16 @@ def _get_generic_subdir(input_file: str):
 
 def _read_exif_info(input_file: str, try_tags: tuple = tuple()):
     with open(input_file, 'rb') as img_fd:
-        exif_info = exifread.process_file(img_fd, details=False)
-        _LOGGER.debug('exif_info: %s', pformat(exif_info))
+        with _STATS.timer('exif', input_file):
+            exif_info = _backend_module('exifread').process_file(
+                img_fd, details=False)
+        _LOGGER.debug('exif_info: %s', _LazyFormat(exif_info))
 
         for try_tag in try_tags:
             if try_tag in exif_info:
+                _STATS.note(input_file, date_source=try_tag)
                 _LOGGER.debug('TAG \'%s\': %s', try_tag,
-                              pformat(exif_info[try_tag]))
+                              _LazyFormat(exif_info[try_tag]))
                 return exif_info[try_tag]
 
     raise Exception('None of the TAGs ({}) available for {}'.format(
@@ -68,7 +749,7 @@ def _get_image_subdir(input_file: str):
     date_time_tag = _read_exif_info(input_file, try_tags=_TRY_TAGS)
 
     date_time = date_time_tag.values
-    _LOGGER.debug('date_time: %s', pformat(date_time))
+    _LOGGER.debug('date_time: %s', _LazyFormat(date_time))
 
     (date_val, time_val) = date_time.split()
     iso_date_val = date_val.replace(':', '-')
@@ -82,14 +763,15 @@ def _get_image_subdir(input_file: str):
 def _get_image_datetime(input_file: str, *args, **kwargs):
     date_time_tag = _read_exif_info(input_file, try_tags=_TRY_TAGS)
 
-    date_time = date_time_tag.values
-    _LOGGER.debug('date_time: %s', pformat(date_time))
+    with _STATS.timer('date', input_file):
+        date_time = date_time_tag.values
+        _LOGGER.debug('date_time: %s', _LazyFormat(date_time))
 
-    (date_val, time_val) = date_time.split()
-    iso_date_val = date_val.replace(':', '-')
+        (date_val, time_val) = date_time.split()
+        iso_date_val = date_val.replace(':', '-')
 
-    parsed_date = datetime.date.fromisoformat(iso_date_val)
-    parsed_time = datetime.time.fromisoformat(time_val)
+        parsed_date = datetime.date.fromisoformat(iso_date_val)
+        parsed_time = datetime.time.fromisoformat(time_val)
 
     # return parsed_date, parsed_time
     return datetime.datetime.combine(parsed_date, parsed_time)
@@ -121,8 +803,12 @@ def _fromtimestring(datetime_str: str):
         raise ValueError('Got empty timestamp')
         # return None
 
+    # Older MediaInfo versions: 'UTC 2019-01-02 03:04:05',
+    # newer ones: '2019-01-02 03:04:05 UTC'
     if datetime_str.startswith('UTC '):
         parse_datetime_str = datetime_str[4:]
+    elif datetime_str.endswith(' UTC'):
+        parse_datetime_str = datetime_str[:-4]
     else:
         parse_datetime_str = datetime_str
 
@@ -147,17 +833,20 @@ _MEDIA_DATE_INFO = [
 
 
 def _get_mediainfo_datetime(input_file: str,
-                            media_info: MediaInfoDLL3.MediaInfo):
-    for date_info in _MEDIA_DATE_INFO:
-        datetime_str = media_info.Get(MediaInfoDLL3.Stream.General, 0,
-                                      date_info)
-        if datetime_str != '':
-            try:
-                return _fromtimestring(datetime_str)
-            except ValueError:
-                _LOGGER.error(
-                    f'Unable to parse date/time \'{date_info}\'=\'{datetime_str}\'.'
-                )
+                            media_info: 'MediaInfoDLL3.MediaInfo'):
+    general = _backend_module('mediainfo').Stream.General
+    with _STATS.timer('date', input_file):
+        for date_info in _MEDIA_DATE_INFO:
+            datetime_str = media_info.Get(general, 0, date_info)
+            if datetime_str != '':
+                try:
+                    date_time = _fromtimestring(datetime_str)
+                except ValueError:
+                    _LOGGER.error('Unable to parse date/time \'%s\'=\'%s\'.',
+                                  date_info, datetime_str)
+                else:
+                    _STATS.note(input_file, date_source=date_info)
+                    return date_time
 
     raise ValueError(
         f'No (valid) date/time info found in: {", ".join(_MEDIA_DATE_INFO)}')
@@ -168,12 +857,13 @@ _VIDEOS_SUBDIR = 'Videos'
 _AUDIO_SUBDIR = 'Audio'
 _OTHER_SUBDIR = 'Other'
 
+# Media types supported with MediaInfo (see _MediaInfoBackend)
 # TODO: Support for other documents
 #     ? MS Office documents: doc, docx, xls, xlsx, ppt, pptx, pps, ppsx, pst, ...
 #     ? OpenDocument formats: odt, ods, ...
 #     ? Other: pdf, swf, ...
 #     ? Audio: MIDI, mp3 (audio/mpeg), ...
-_MEDIA_TYPE_HANDLERS = {
+_MEDIAINFO_MEDIA_TYPES = {
     # Bitmap
     # TODO: Check if EXIF/XMP info is available
     'image/bmp': (_get_image_datetime, _PICTURES_SUBDIR),
@@ -210,236 +900,4068 @@ _MEDIA_TYPE_HANDLERS = {
     # Windows Media
     'audio/x-ms-wma': (_get_mediainfo_datetime, _AUDIO_SUBDIR),
     'video/x-ms-wmv': (_get_mediainfo_datetime, _VIDEOS_SUBDIR),
-    # Q&D hack for MP2TS
-    # ! FIXME - Should check on Format (=> BDAV) instead
-    '': (_get_mediainfo_datetime, _VIDEOS_SUBDIR),
 }
 
 
-def _canonical_image_location(input_file: str):
-    mi = MediaInfoDLL3.MediaInfo()
-    result = mi.Open(input_file)
-    if result != 1:
-        raise Exception(f'Unable to load input file \'{input_file}\'')
-    try:
-        media_type = mi.Get(MediaInfoDLL3.Stream.General, 0,
-                            'InternetMediaType')
-
-        file_ext = mi.Get(MediaInfoDLL3.Stream.General, 0, 'FileExtension')
-        if file_ext == '':
-            file_extensions = mi.Get(MediaInfoDLL3.Stream.General, 0,
-                                     'Format/Extensions')
-            if file_extensions != '':
-                file_ext = file_extensions.split()[0]
-            _LOGGER.debug('Using file extension \'%s\' for media type \'%s\'',
-                          file_ext, media_type)
-        if file_ext == '':
-            raise Exception(
-                f'Unable to determine file extension for media type: {media_type}'
-            )
+# File extensions of the supported media types,
+# used to re-layout already sorted files (without parsing them again)
+_MEDIA_EXTENSION_SUBDIRS = {
+    'bmp': _PICTURES_SUBDIR,
+    'gif': _PICTURES_SUBDIR,
+    'jpeg': _PICTURES_SUBDIR,
+    'jpg': _PICTURES_SUBDIR,
+    'png': _PICTURES_SUBDIR,
+    'tif': _PICTURES_SUBDIR,
+    'tiff': _PICTURES_SUBDIR,
+    '3gp': _VIDEOS_SUBDIR,
+    '3gpp': _VIDEOS_SUBDIR,
+    'avi': _VIDEOS_SUBDIR,
+    'm2ts': _VIDEOS_SUBDIR,
+    'm4v': _VIDEOS_SUBDIR,
+    'mov': _VIDEOS_SUBDIR,
+    'mp4': _VIDEOS_SUBDIR,
+    'mts': _VIDEOS_SUBDIR,
+    'qt': _VIDEOS_SUBDIR,
+    'wmv': _VIDEOS_SUBDIR,
+    'amr': _AUDIO_SUBDIR,
+    'm4a': _AUDIO_SUBDIR,
+    'wav': _AUDIO_SUBDIR,
+    'wma': _AUDIO_SUBDIR,
+}
+
+# Media subdirectory => media type label of the metrics (see _metric_media)
+_METRIC_MEDIA_TYPES = {
+    _PICTURES_SUBDIR: 'image',
+    _VIDEOS_SUBDIR: 'video',
+    _AUDIO_SUBDIR: 'audio',
+}
 
-        if media_type not in _MEDIA_TYPE_HANDLERS:
-            raise Exception(f'Unsupported media type: {media_type}')
+# Length (hex digits) of the content digest in the output file names of
+# sharded runs
+_DIGEST_SUFFIX_LENGTH = 8
 
-        get_datetime, media_subdir = _MEDIA_TYPE_HANDLERS[media_type]
-        date_time: datetime.datetime = get_datetime(input_file=input_file,
-                                                    media_info=mi)
-    finally:
-        mi.Close()
+# With the digest suffix of sharded runs and the counter suffix of
+# duplicates, if any
+_CANONICAL_FILE_NAME = re.compile(
+    r'^(?P<datetime>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})'
+    rf'(?:_[0-9a-f]{{{_DIGEST_SUFFIX_LENGTH}}})?(?:_\d+)?\.(?P<ext>[^.]+)$')
+# Directories of a library sorted with --separate: <media>/YYYY/MM/DD
+_SEPARATE_DIRS = re.compile(r'^(?P<media_subdir>[^/]+)/\d{4}/\d{2}/\d{2}$')
+
+
+def _canonical_name_location(input_file: str, root_dir: str):
+    """
+    Same as :func:`_canonical_image_location` for an already sorted file,
+    using its canonical (``%Y-%m-%d_%H-%M-%S``) file name instead of its
+    media information. The file name itself is kept (including a digest
+    and counter suffix), so re-layouts don't shuffle the names of
+    duplicates.
+
+    The media subdir is only taken from the path if the file is in a
+    ``<media>/YYYY/MM/DD`` directory below ``root_dir`` (the library),
+    otherwise it depends on the file extension.
+    """
+    match = _CANONICAL_FILE_NAME.match(basename(input_file))
+    if match is None:
+        raise ValueError(f'Not a canonical file name: {input_file}')
+
+    date_time = datetime.datetime.strptime(match.group('datetime'),
+                                           '%Y-%m-%d_%H-%M-%S')
+    file_ext = match.group('ext')
+    _STATS.note(input_file, date_source='file name')
+
+    # Sorted with --separate: <media_subdir>/YYYY/MM/DD/<file>
+    subdirs = relpath(abspath(input_file), abspath(root_dir)).split(sep)[:-1]
+    match = _SEPARATE_DIRS.match('/'.join(subdirs[-4:]))
+    media_subdir = match and match.group('media_subdir')
+    if media_subdir not in (_PICTURES_SUBDIR, _VIDEOS_SUBDIR, _AUDIO_SUBDIR):
+        media_subdir = _MEDIA_EXTENSION_SUBDIRS.get(file_ext.lower())
+        if media_subdir is None:
+            raise ValueError(f'Unknown media file extension: {input_file}')
 
     return (
         media_subdir,
         join(date_time.strftime('%Y'), date_time.strftime('%m'),
              date_time.strftime('%d')),
-        date_time.strftime('%Y-%m-%d_%H-%M-%S'),
+        splitext(basename(input_file))[0],
         file_ext,
     )
 
 
-def _process_input_file(input_file: str,
-                        dest_dir: str,
-                        separate: bool = False,
-                        do_rename: bool = True,
-                        process_function: callable = copy):
-    if isdir(input_file):
-        _LOGGER.info('Skipping directory \033[0;33m%s\033[0;m', input_file)
-        return
+def _relayout_location(input_file: str, root_dir: str):
+    try:
+        return _canonical_name_location(input_file, root_dir)
+    except ValueError as e:
+        _LOGGER.debug('%s: parsing media file', e)
+        return _canonical_image_location(input_file)
 
-    _LOGGER.info('Processing input file %s', input_file)
 
-    # output_subdir = _get_image_subdir(input_file)
-    # output_subdir = _get_generic_subdir(input_file)
-    # output_subdir, output_file_name = _canonical_image_location(input_file)
-    (
-        media_subdir,
-        output_subdir,
-        output_file_basename,
-        output_file_ext,
-    ) = _canonical_image_location(input_file)
-    if separate:
-        output_dir = join(dest_dir, media_subdir, output_subdir)
-    else:
-        output_dir = join(dest_dir, output_subdir)
+# Bytes read ahead to check the magic bytes of the backends
+_HEADER_SIZE = 16
+# Formats (of MediaInfo) without an internet media type
+_MEDIAINFO_FORMATS = {
+    'BDAV': _VIDEOS_SUBDIR,
+    'MPEG-TS': _VIDEOS_SUBDIR,
+}
 
-    if not do_rename:
-        output_file_basename, output_file_ext = splitext(basename(input_file))
 
-    output_file_name = '.'.join((output_file_basename, output_file_ext))
-    output_file = join(output_dir, output_file_name)
+class _ExtractionBackend(ABC):
+    """
+    Backend extracting the media type and the date/time of media files (see
+    :func:`_canonical_image_location`).
 
-    # if exists(output_file):
-    #     raise Exception(
-    #         'Output file \'{}\' already exists'.format(output_file))
+    Backends declare the files they handle by ``magic`` bytes (``(offset,
+    bytes)`` in the header of the file) and/or file ``extensions``, see
+    :meth:`can_handle`. Cheaper backends (lower ``cost`` tier) are tried
+    first, falling back to the next capable backend if they fail, unless
+    the failure is final (see :meth:`is_final`).
+    """
 
-    counter = 0
-    while exists(output_file):
-        counter += 1
-        _LOGGER.info(
-            'Output file \033[0;33m\'{}\'\033[0;m already exists'.format(
-                output_file))
-        output_file_name = '.'.join(
-            (f'{output_file_basename}_{counter}', output_file_ext))
-        output_file = join(output_dir, output_file_name)
+    name = None
+    # 0: a few bytes parsed natively, 1: metadata parsed in Python,
+    # 2: (external) library parsing the whole container
+    cost = 0
+    magic = ()
+    extensions = ()
 
-    # _LOGGER.info('Copying %s to %s', input_file, output_dir)
+    def __init__(self):
+        self.hits = 0
+        self.fallbacks = 0
+        self.latency = _LatencyHistogram()
+        self._lock = Lock()
 
-    # makedirs(output_dir, mode=0o755, exist_ok=True)
+    def can_handle(self, input_file: str, header: bytes) -> bool:
+        """
+        Whether ``input_file`` (with the first bytes ``header``) is worth
+        trying.
+        """
+        if any(
+                header.startswith(magic_bytes, offset)
+                for offset, magic_bytes in self.magic):
+            return True
+        return splitext(input_file)[1][1:].lower() in self.extensions
 
-    # # process_function(input_file, output_dir)
+    def is_final(self, input_file: str, header: bytes) -> bool:
+        """
+        Whether a failure for ``input_file`` is final, i.e. the next
+        backends would parse the same metadata again.
+        """
+        return False
 
-    process_function(input_file, output_file)
+    @abstractmethod
+    def extract(self, input_file: str, header: bytes) -> tuple:
+        """
+        Return ``(media type, media subdir, date/time, file extension)`` of
+        ``input_file``, or raise an exception if not possible.
+        """
 
+    def record(self, seconds: float, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.fallbacks += 1
+            self.latency.add(seconds)
 
-def process_media_files(source_files: str,
-                        dest_dir: str,
-                        separate: bool = False,
-                        do_rename: bool = True,
-                        process_function: callable = copy):
-    input_files = iglob(source_files, recursive=True)
-    for input_file in input_files:
-        try:
-            _process_input_file(input_file,
-                                dest_dir,
-                                separate=separate,
-                                do_rename=do_rename,
-                                process_function=process_function)
-        except:
-            _LOGGER.info(
-                f'Failed to process \033[0;31m{input_file}\033[0;m. \033[0;33mSkipping\033[0;m.'
-            )
-            _LOGGER.exception(f'Failed to process {input_file}.')
+    def counters(self) -> tuple:
+        """
+        Return ``(hits, fallbacks, latency histogram)`` so far.
+        """
+        with self._lock:
+            return self.hits, self.fallbacks, self.latency.copy()
 
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.fallbacks = 0
+            self.latency = _LatencyHistogram()
 
-def _parse_options(args: list) -> tuple:
-    from argparse import ArgumentParser
 
-    parser = ArgumentParser(
-        description=
-        'Sort image files like Nexcloud Android client does on a smartphone.')
+def _file_extension(input_file: str, default: str) -> str:
+    return splitext(input_file)[1][1:] or default
 
-    parser.add_argument('--source-files',
-                        dest='source_files',
-                        default='.',
-                        required=True)
 
-    parser.add_argument('--destination-dir', dest='dest_dir', required=True)
+def _iter_boxes(data: bytes, start: int = 0, end: int = None):
+    """
+    Yield ``(type, payload start, payload end)`` of the boxes (atoms) of
+    an MP4 or QuickTime file in ``data[start:end]``.
+    """
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:
+            size, = unpack_from('>Q', data, offset + 8)
+            header_size = 16
+        elif size == 0:
+            # Up to the end
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise ValueError(f'Invalid {box_type} box')
+        yield box_type, offset + header_size, offset + size
+        offset += size
 
-    parser.add_argument('--move',
-                        dest='copy',
-                        default=True,
-                        action='store_false')
 
-    parser.add_argument('--separate',
-                        dest='separate',
-                        default=False,
-                        action='store_true')
+class _MvhdBackend(_ExtractionBackend):
+    """
+    MP4 and QuickTime files: the creation time of the ``mvhd`` box (in UTC,
+    like MediaInfo's ``Encoded_Date``), or the ``©day`` user data if any
+    (like MediaInfo's ``Recorded_Date``). Only the top level box headers and
+    the ``moov`` box are read. Files with other metadata (``meta`` boxes,
+    e.g. the creation date of Apple devices) are left to MediaInfo.
+    """
 
-    parser.add_argument('--no-rename',
-                        dest='rename',
-                        default=True,
-                        action='store_false')
+    name = 'mvhd'
+    cost = 0
+    magic = ((4, b'ftyp'), (4, b'moov'), (4, b'wide'), (4, b'mdat'))
+    extensions = ('mp4', 'm4v', 'm4a', 'mov', 'qt', '3gp', '3gpp')
+    # 1904-01-01, start of the time stamps
+    EPOCH = datetime.datetime(1904, 1, 1)
+    # Larger moov boxes (e.g. huge sample tables) are left to MediaInfo
+    MAX_MOOV_SIZE = 16 * 1024 * 1024
 
-    parser.add_argument('--dryrun',
-                        dest='dryrun',
-                        default=False,
-                        action='store_true')
+    def _read_moov(self, input_file: str) -> tuple:
+        """
+        Return the major brand and the payload of the ``moov`` box.
+        """
+        brand = None
+        with open(input_file, 'rb') as input_fd:
+            file_size = fstat(input_fd.fileno()).st_size
+            offset = 0
+            while offset + 8 <= file_size:
+                input_fd.seek(offset)
+                header = input_fd.read(16)
+                size, box_type = unpack_from('>I4s', header)
+                header_size = 8
+                if size == 1:
+                    size, = unpack_from('>Q', header, 8)
+                    header_size = 16
+                elif size == 0:
+                    size = file_size - offset
+                if size < header_size:
+                    raise ValueError(f'Invalid {box_type} box')
+                if box_type == b'ftyp' and offset == 0:
+                    brand = header[header_size:header_size + 4]
+                elif box_type == b'moov':
+                    if size > self.MAX_MOOV_SIZE:
+                        raise ValueError(f'moov box too large ({size})')
+                    input_fd.seek(offset + header_size)
+                    return brand, input_fd.read(size - header_size)
+                offset += size
+        raise ValueError('No moov box')
 
-    parsed_args = parser.parse_args(args=args)
+    def extract(self, input_file: str, header: bytes) -> tuple:
+        brand, moov = self._read_moov(input_file)
+        creation_time = None
+        recorded_date = None
+        handlers = set()
+        for box_type, start, end in _iter_boxes(moov):
+            if box_type == b'mvhd':
+                if moov[start] == 1:
+                    creation_time, = unpack_from('>Q', moov, start + 4)
+                else:
+                    creation_time, = unpack_from('>I', moov, start + 4)
+            elif box_type == b'meta':
+                raise ValueError('Metadata left to MediaInfo')
+            elif box_type == b'udta':
+                for udta_type, udta_start, udta_end in _iter_boxes(
+                        moov, start, end):
+                    if udta_type == b'meta':
+                        raise ValueError('Metadata left to MediaInfo')
+                    if udta_type == b'\xa9day':
+                        # Size and language of the text
+                        recorded_date = moov[udta_start + 4:udta_end].decode(
+                            'utf-8', errors='replace').strip('\0 ')
+            elif box_type == b'trak':
+                for _, mdia_start, mdia_end in (
+                        box for box in _iter_boxes(moov, start, end)
+                        if box[0] == b'mdia'):
+                    for hdlr_type, hdlr_start, _ in _iter_boxes(
+                            moov, mdia_start, mdia_end):
+                        if hdlr_type == b'hdlr':
+                            handlers.add(moov[hdlr_start + 8:hdlr_start + 12])
 
-    return (
-        parsed_args.source_files,
-        parsed_args.dest_dir,
-        parsed_args.copy,
-        parsed_args.separate,
-        parsed_args.rename,
-        parsed_args.dryrun,
-    )
+        if b'soun' in handlers and b'vide' not in handlers:
+            media_type, media_subdir = 'audio/mp4', _AUDIO_SUBDIR
+            default_ext = 'm4a'
+        elif brand == b'qt  ':
+            media_type, media_subdir = 'video/quicktime', _VIDEOS_SUBDIR
+            default_ext = 'mov'
+        else:
+            media_type, media_subdir = 'video/mp4', _VIDEOS_SUBDIR
+            default_ext = 'mp4'
 
+        date_time = None
+        if recorded_date:
+            try:
+                date_time = _fromtimestring(recorded_date)
+            except ValueError:
+                _LOGGER.error('Unable to parse date/time \'©day\'=\'%s\'.',
+                              recorded_date)
+            else:
+                _STATS.note(input_file, date_source='©day')
+        if date_time is None:
+            if not creation_time:
+                raise ValueError('No creation time in mvhd box')
+            date_time = self.EPOCH + datetime.timedelta(seconds=creation_time)
+            _STATS.note(input_file, date_source='mvhd')
+        return (media_type, media_subdir, date_time,
+                _file_extension(input_file, default_ext))
 
-def _generate_process_function(is_copy: bool, is_dryrun: bool):
-    if is_copy:
-        _LOGGER.debug("Copying files")
-        action_name = 'Copying'
-        real_makedirs = makedirs
-        real_process_function = copy
-    else:
-        _LOGGER.debug("Moving files")
-        action_name = 'Moving'
-        real_makedirs = makedirs
-        real_process_function = move
 
-    if is_dryrun:
-        _LOGGER.info("*** DRY-RUN ***")
+class _ExifBackend(_ExtractionBackend):
+    """
+    JPEG and TIFF pictures: the date/time of their EXIF info, without
+    MediaInfo. Other TIFF based files (e.g. camera raw files) are left to
+    MediaInfo.
+    """
 
-        def dummy_function(*args, **kwargs):
-            pass
+    name = 'exif'
+    cost = 1
+    magic = ((0, b'\xff\xd8\xff'), )
+    extensions = ('tif', 'tiff')
 
-        action_name = '[DRY-RUN] ' + action_name
-        real_makedirs = dummy_function
-        real_process_function = dummy_function
+    def is_final(self, input_file: str, header: bytes) -> bool:
+        # MediaInfo would parse the EXIF info of JPEG pictures again (see
+        # _MEDIAINFO_MEDIA_TYPES), TIFF files are only told by their file
+        # extension
+        return header.startswith(self.magic[0][1])
 
-    def process_function(input_file: str, output_file: str):
-        output_dir = dirname(output_file)
+    def extract(self, input_file: str, header: bytes) -> tuple:
+        date_time = _get_image_datetime(input_file)
+        if header.startswith(b'\xff\xd8'):
+            media_type, default_ext = 'image/jpeg', 'jpg'
+        else:
+            media_type, default_ext = 'image/tiff', 'tif'
+        return (media_type, _PICTURES_SUBDIR, date_time,
+                _file_extension(input_file, default_ext))
 
-        # _LOGGER.info('%s %s to %s', action_name, input_file, output_dir)
-        _LOGGER.info('%s \033[0;32m%s\033[0;m to \033[0;32m%s\033[0;m',
-                     action_name, input_file, output_file)
 
-        # Create destination directory
-        real_makedirs(output_dir, mode=0o755, exist_ok=True)
+class _MediaInfoBackend(_ExtractionBackend):
+    """
+    Any media file supported by MediaInfo (see
+    :data:`_MEDIAINFO_MEDIA_TYPES`), the fallback of the other backends.
+    """
 
-        # Apply the action on the file
-        # real_process_function(input_file, output_dir)
-        real_process_function(input_file, output_file)
+    name = 'mediainfo'
+    cost = 2
 
-    return process_function
+    def can_handle(self, input_file: str, header: bytes) -> bool:
+        return True
 
+    def extract(self, input_file: str, header: bytes) -> tuple:
+        MediaInfoDLL3 = _backend_module('mediainfo')
+        mi = MediaInfoDLL3.MediaInfo()
+        with _STATS.timer('open', input_file):
+            result = mi.Open(input_file)
+        if result != 1:
+            raise Exception(f'Unable to load input file \'{input_file}\'')
+        try:
+            media_type = mi.Get(MediaInfoDLL3.Stream.General, 0,
+                                'InternetMediaType')
 
-def main():
-    from sys import argv, stdout
-    from os import environ
+            file_ext = mi.Get(MediaInfoDLL3.Stream.General, 0,
+                              'FileExtension')
+            if file_ext == '':
+                file_extensions = mi.Get(MediaInfoDLL3.Stream.General, 0,
+                                         'Format/Extensions')
+                if file_extensions != '':
+                    file_ext = file_extensions.split()[0]
+                _LOGGER.debug(
+                    'Using file extension \'%s\' for media type \'%s\'',
+                    file_ext, media_type)
+            if file_ext == '':
+                raise Exception('Unable to determine file extension for '
+                                f'media type: {media_type}')
 
-    log_debug = bool(environ.get('DEBUG', False))
-    logging.basicConfig(stream=stdout,
-                        level=logging.DEBUG if log_debug else logging.INFO,
-                        format='%(message)s')
+            if media_type in _MEDIAINFO_MEDIA_TYPES:
+                get_datetime, media_subdir = _MEDIAINFO_MEDIA_TYPES[
+                    media_type]
+            else:
+                media_format = mi.Get(MediaInfoDLL3.Stream.General, 0,
+                                      'Format')
+                if media_type != '' or media_format not in _MEDIAINFO_FORMATS:
+                    raise Exception(
+                        f'Unsupported media type: {media_type or media_format}'
+                    )
+                get_datetime = _get_mediainfo_datetime
+                media_subdir = _MEDIAINFO_FORMATS[media_format]
+            date_time: datetime.datetime = get_datetime(input_file=input_file,
+                                                        media_info=mi)
+        finally:
+            mi.Close()
 
-    [
-        source_files,
-        dest_dir,
-        is_copy,
-        separate,
-        do_rename,
-        is_dryrun,
-    ] = _parse_options(argv[1:])
+        return media_type, media_subdir, date_time, file_ext
 
-    process_function = _generate_process_function(is_copy, is_dryrun)
 
-    process_media_files(source_files,
-                        dest_dir,
-                        separate=separate,
-                        do_rename=do_rename,
-                        process_function=process_function)
+# Backends, cheapest first (see _register_extraction_backend)
+_EXTRACTION_BACKENDS = []
+
+
+def _register_extraction_backend(backend: _ExtractionBackend):
+    _EXTRACTION_BACKENDS.append(backend)
+    # Stable: in the order of registration within a cost tier
+    _EXTRACTION_BACKENDS.sort(key=lambda backend: backend.cost)
+
+
+_register_extraction_backend(_MvhdBackend())
+_register_extraction_backend(_ExifBackend())
+_register_extraction_backend(_MediaInfoBackend())
+
+
+def _canonical_image_location(input_file: str):
+    """
+    Location of ``input_file``: ``(media subdir, YYYY/MM/DD,
+    YYYY-MM-DD_hh-mm-ss, file extension)``, by the cheapest capable
+    extraction backend (see :class:`_ExtractionBackend`). When it fails,
+    the next capable backend is tried (unless the failure is final), the
+    error of the last one is raised.
+    """
+    with open(input_file, 'rb') as input_fd:
+        header = input_fd.read(_HEADER_SIZE)
+
+    error = None
+    for backend in _EXTRACTION_BACKENDS:
+        if not backend.can_handle(input_file, header):
+            continue
+        start = perf_counter()
+        try:
+            media_type, media_subdir, date_time, file_ext = backend.extract(
+                input_file, header)
+        except Exception as e:
+            backend.record(perf_counter() - start, hit=False)
+            _LOGGER.debug('Backend %s failed for %s: %s', backend.name,
+                          input_file, e)
+            if backend.is_final(input_file, header):
+                raise
+            error = e
+            continue
+        backend.record(perf_counter() - start, hit=True)
+        _STATS.note(input_file, media_type=media_type, backend=backend.name)
+        break
+    else:
+        if error is None:
+            raise Exception(f'No backend for input file \'{input_file}\'')
+        raise error
+
+    return (
+        media_subdir,
+        join(date_time.strftime('%Y'), date_time.strftime('%m'),
+             date_time.strftime('%d')),
+        date_time.strftime('%Y-%m-%d_%H-%M-%S'),
+        file_ext,
+    )
+
+
+_JOURNAL_VERSION = 1
+
+
+class _Journal:
+    """
+    Write-ahead journal of the file operations of a run.
+
+    The journal is a JSON lines file. The first record describes the run
+    (options), followed by a ``plan`` record before each file operation and a
+    ``done`` record once it completed. Files which failed to process are
+    recorded with a ``fail`` record. Reverting an operation (see
+    :func:`undo_media_files`) is recorded with an ``undo`` record.
+
+    Every record is flushed to the operating system right away, which is
+    enough to survive a crash or OOM kill of the process. Calling ``fsync``
+    for every record is way too expensive on millions of files, so the
+    journal is only synced every ``sync_interval`` records (and on close).
+    After a reboot, the tail of the journal may thus be missing, but
+    resuming still checks the state of the file system (see
+    :func:`_resume_planned_files`) so no file is lost.
+
+    The state of all journaled files is kept in memory, so files which
+    are already processed can be skipped (see :meth:`is_known`).
+    """
+
+    def __init__(self, journal_file: str, sync_interval: int = 1000):
+        self.journal_file = journal_file
+        self.sync_interval = sync_interval
+        self.run_options = None
+        self.planned = {}
+        self.finished = {}
+        self.failed = set()
+        self._unsynced = 0
+        self._fd = None
+        self._lock = Lock()
+        self._truncated = False
+
+    def load(self):
+        """
+        Load the state of an earlier (interrupted) run from the journal.
+        """
+        with open(self.journal_file, 'r', encoding='utf-8') as journal_fd:
+            for line_number, line in enumerate(journal_fd, start=1):
+                self._truncated = not line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last record may have been partially written on a crash
+                    _LOGGER.warning('Ignoring invalid journal record %d in %s',
+                                    line_number, self.journal_file)
+                    continue
+                operation = record['op']
+                if operation == 'run':
+                    self.run_options = record
+                elif operation == 'plan':
+                    self.planned[record['src']] = record['dst']
+                elif operation == 'done':
+                    self.planned.pop(record['src'], None)
+                    self.finished[record['src']] = record['dst']
+                elif operation == 'fail':
+                    self.planned.pop(record['src'], None)
+                    self.failed.add(record['src'])
+                elif operation == 'undo':
+                    self.planned.pop(record['src'], None)
+                    self.finished.pop(record['src'], None)
+
+        if self.run_options is None:
+            raise Exception(
+                f'No run information found in journal \'{self.journal_file}\''
+            )
+        if self.run_options.get('version') != _JOURNAL_VERSION:
+            raise Exception('Unsupported journal version {} in \'{}\''.format(
+                self.run_options.get('version'), self.journal_file))
+
+    def open(self, **run_options):
+        """
+        Open the journal for writing.
+
+        When no earlier run was loaded, a new journal is started with the
+        given ``run_options``. Otherwise, records are appended to it.
+        """
+        if self.run_options is None:
+            self._fd = open(self.journal_file, 'x', encoding='utf-8')
+            self.run_options = dict(op='run',
+                                    version=_JOURNAL_VERSION,
+                                    **run_options)
+            self._write(self.run_options, sync=True)
+        else:
+            self._fd = open(self.journal_file, 'a', encoding='utf-8')
+            if self._truncated:
+                # Terminate the partially written record of the crashed run
+                self._fd.write('\n')
+
+    def close(self):
+        if self._fd is not None:
+            self._sync()
+            self._fd.close()
+            self._fd = None
+
+    def is_known(self, input_file: str) -> bool:
+        input_file = abspath(input_file)
+        return (input_file in self.finished or input_file in self.failed
+                or input_file in self.planned)
+
+    def plan(self, input_file: str, output_file: str):
+        input_file = abspath(input_file)
+        output_file = abspath(output_file)
+        self.planned[input_file] = output_file
+        self._write(dict(op='plan', src=input_file, dst=output_file))
+
+    def done(self, input_file: str, output_file: str):
+        input_file = abspath(input_file)
+        output_file = abspath(output_file)
+        self.planned.pop(input_file, None)
+        self.finished[input_file] = output_file
+        self._write(dict(op='done', src=input_file, dst=output_file))
+
+    def fail(self, input_file: str):
+        input_file = abspath(input_file)
+        self.planned.pop(input_file, None)
+        self.failed.add(input_file)
+        self._write(dict(op='fail', src=input_file))
+
+    def undo(self, input_file: str, output_file: str):
+        input_file = abspath(input_file)
+        output_file = abspath(output_file)
+        self.planned.pop(input_file, None)
+        self.finished.pop(input_file, None)
+        self._write(dict(op='undo', src=input_file, dst=output_file))
+
+    def _write(self, record: dict, sync: bool = False):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._fd.write(line)
+            self._fd.flush()
+            self._unsynced += 1
+            if sync or self._unsynced >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._fd.flush()
+        fsync(self._fd.fileno())
+        self._unsynced = 0
+
+
+def _remove_stale_temp_files(output_dirs):
+    """
+    Remove the temporary files (see :func:`_copy_exclusive`) of crashed runs
+    in ``output_dirs``. Temporary files changed recently may still be
+    written by another process (e.g. another shard), so they are kept.
+    """
+    stale_time = time() - _STALE_TEMP_FILE_AGE
+    for output_dir in output_dirs:
+        try:
+            entries = list(scandir(output_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not entry.name.startswith(_TEMP_FILE_PREFIX):
+                continue
+            try:
+                if (entry.is_file(follow_symlinks=False)
+                        and entry.stat().st_ctime < stale_time):
+                    _LOGGER.info('Removing stale temporary file %s',
+                                 entry.path)
+                    unlink(entry.path)
+            except FileNotFoundError:
+                # Renamed (or removed) in the meantime
+                pass
+
+
+@contextmanager
+def _open_output_archive_member(output_file: str):
+    """
+    Open the member ``<archive>::<member>`` of an output archive (see
+    :class:`_ArchiveSink`) and yield ``(file object, mtime)``. Raises
+    ``KeyError`` if there is no such member.
+    """
+    archive_file, _, member_name = output_file.partition(
+        _ARCHIVE_MEMBER_SEPARATOR)
+    if archive_file.endswith('.zip'):
+        with ZipFile(archive_file) as archive:
+            info = archive.getinfo(member_name)
+            with archive.open(info) as member_fd:
+                yield member_fd, datetime.datetime(
+                    *info.date_time).timestamp()
+    else:
+        with tarfile.open(archive_file) as archive:
+            info = archive.getmember(member_name)
+            yield archive.extractfile(info), info.mtime
+
+
+def _output_exists(output_file: str) -> bool:
+    """
+    Whether ``output_file`` (also a member of an output archive) exists.
+    """
+    if not _is_archive_member(output_file):
+        return exists(output_file)
+    try:
+        with _open_output_archive_member(output_file):
+            return True
+    except (OSError, KeyError, BadZipFile, tarfile.TarError):
+        return False
+
+
+def _resume_planned_files(journal: _Journal, process_function: callable):
+    """
+    Finish the file operations which were planned but not completed
+    by an interrupted run. The media files are not parsed again.
+    """
+    _remove_stale_temp_files({journal.run_options['dest_dir']} | {
+        dirname(output_file)
+        for output_file in journal.planned.values()
+        if not _is_archive_member(output_file)
+    })
+    is_copy = journal.run_options['copy']
+    for input_file, output_file in list(journal.planned.items()):
+        if not exists(input_file):
+            if _output_exists(output_file):
+                _LOGGER.info('Already processed %s to %s', input_file,
+                             output_file)
+                journal.done(input_file, output_file)
+            elif _is_archive_member(input_file):
+                # Extracted from its archive again
+                del journal.planned[input_file]
+            else:
+                _LOGGER.error('Input file %s of interrupted operation to %s '
+                              'disappeared', input_file, output_file)
+                journal.fail(input_file)
+            continue
+
+        # Output files are never overwritten (see _claim_output_file), so
+        # an existing output file with the same content is the result of
+        # the interrupted copy (or move across file systems). Otherwise,
+        # another file took the name in the meantime. Archive members are
+        # reserved for their input file (see _ArchiveSink.plan).
+        try:
+            if _is_archive_member(output_file):
+                is_processed = _output_exists(output_file)
+            else:
+                is_processed = exists(output_file) and filecmp.cmp(
+                    input_file, output_file, shallow=False)
+            if is_processed:
+                _LOGGER.info('Already processed %s to %s', input_file,
+                             output_file)
+                if not is_copy:
+                    unlink(input_file)
+            else:
+                output_file = process_function(input_file,
+                                               output_file) or output_file
+        except:
+            _LOGGER.exception('Failed to resume %s.', input_file)
+            journal.fail(input_file)
+        else:
+            journal.done(input_file, output_file)
+
+
+def _undo_file_operation(input_file: str,
+                         output_file: str,
+                         is_copy: bool,
+                         journal: _Journal = None,
+                         is_dryrun: bool = False) -> bool:
+    if not _output_exists(output_file):
+        _LOGGER.error('Output file %s of %s does not exist (anymore)',
+                      output_file, input_file)
+        return False
+
+    if is_copy and _is_archive_member(output_file):
+        _LOGGER.error('Not undoing %s: members can not be removed from '
+                      'output archive %s', input_file, output_file)
+        return False
+    if is_copy:
+        _LOGGER.info('Removing copy \033[0;32m%s\033[0;m of %s', output_file,
+                     input_file)
+        if not is_dryrun:
+            unlink(output_file)
+    else:
+        if exists(input_file):
+            _LOGGER.error('Not moving %s back: %s already exists', output_file,
+                          input_file)
+            return False
+        _LOGGER.info(
+            'Moving \033[0;32m%s\033[0;m back to \033[0;32m%s\033[0;m',
+            output_file, input_file)
+        if not is_dryrun:
+            makedirs(dirname(input_file), mode=0o755, exist_ok=True)
+            if _is_archive_member(output_file):
+                # The member is kept in the output archive
+                with _open_output_archive_member(output_file) as (
+                        member_fd, mtime), open(input_file, 'xb') as input_fd:
+                    copyfileobj(member_fd, input_fd, _ARCHIVE_CHUNK_SIZE)
+                utime(input_file, (mtime, mtime))
+            else:
+                try:
+                    rename(output_file, input_file)
+                except OSError:
+                    # E.g. across file systems
+                    move(output_file, input_file)
+
+    if journal is not None:
+        journal.undo(input_file, output_file)
+
+    return True
+
+
+def _remove_empty_dirs(directories: set, top_dir: str):
+    """
+    Remove the (empty) ``directories`` and their empty parent directories,
+    up to (not including) ``top_dir``.
+    """
+    top_dir = abspath(top_dir)
+    removed = set()
+    # Deepest directories first, so parents are empty when we get there
+    for directory in sorted(directories, key=len, reverse=True):
+        while (directory not in removed and directory != top_dir
+               and directory.startswith(top_dir)):
+            try:
+                rmdir(directory)
+            except OSError:
+                # Not empty (or already gone)
+                break
+            _LOGGER.debug('Removed empty directory %s', directory)
+            removed.add(directory)
+            directory = dirname(directory)
+
+
+def undo_media_files(journal_file: str,
+                     jobs: int = _DEFAULT_JOBS,
+                     is_dryrun: bool = False):
+    """
+    Revert the file operations of the run recorded in ``journal_file``.
+
+    Moved files are renamed back to their original location and copies are
+    removed. Afterwards, the directories which became empty are removed.
+    Files moved into output archives are extracted back, the archives are
+    kept as they are.
+    """
+    journal = _Journal(journal_file)
+    journal.load()
+    is_copy = journal.run_options['copy']
+    dest_dir = journal.run_options['dest_dir']
+
+    operations = dict(journal.finished)
+    # Interrupted operations which (partially) completed
+    for input_file, output_file in journal.planned.items():
+        if _output_exists(output_file) and (is_copy or not exists(input_file)
+                                    or _is_archive_member(input_file)):
+            operations[input_file] = output_file
+
+    _LOGGER.info('Undoing %d file operations of %s', len(operations),
+                 journal_file)
+
+    if not is_dryrun:
+        journal.open()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(
+                lambda operation: _undo_file_operation(
+                    *operation,
+                    # Archive members are always extracted (copied)
+                    is_copy=is_copy or _is_archive_member(operation[0]),
+                    journal=None if is_dryrun else journal,
+                    is_dryrun=is_dryrun), operations.items())
+            failures = list(results).count(False)
+    finally:
+        journal.close()
+
+    if not is_dryrun:
+        _remove_empty_dirs(
+            {dirname(output_file)
+             for output_file in operations.values()}, dest_dir)
+
+    if failures:
+        _LOGGER.error('Failed to undo %d of %d file operations', failures,
+                      len(operations))
+
+
+def _glob_root(pattern: str) -> str:
+    """
+    Return the directory part of ``pattern`` without any wildcards.
+    """
+    root = []
+    for part in pattern.split(sep):
+        if re.search(r'[*?[]', part):
+            break
+        root.append(part)
+    return sep.join(root) or '.'
+
+
+def _glob_regex(pattern: str):
+    """
+    Compile ``pattern`` to a regular expression matching the same paths
+    as ``iglob(pattern, recursive=True)``.
+    """
+    regex = ''
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith('**' + sep, index):
+            regex += f'(?:.*{re.escape(sep)})?'
+            index += 3
+        elif pattern.startswith('**', index):
+            regex += '.*'
+            index += 2
+        elif pattern[index] == '*':
+            regex += f'[^{re.escape(sep)}]*'
+            index += 1
+        elif pattern[index] == '?':
+            regex += f'[^{re.escape(sep)}]'
+            index += 1
+        elif pattern[index] == '[' and ']' in pattern[index + 2:]:
+            end = pattern.index(']', index + 2)
+            char_class = pattern[index + 1:end]
+            if char_class.startswith('!'):
+                char_class = '^' + char_class[1:]
+            regex += '[' + char_class.replace('\\', '\\\\') + ']'
+            index = end + 1
+        else:
+            regex += re.escape(pattern[index])
+            index += 1
+    return re.compile(regex + r'\Z')
+
+
+class _PlannedOutputFile(str):
+    """
+    Output file chosen by :func:`_plan_output_file`, with the parts of its
+    name: the base name (without counter suffix), the counter and the
+    suffix (file extension). :func:`_claim_output_file` continues with the
+    next counter if the name got taken in the meantime.
+    """
+
+    def __new__(cls, output_file: str, output_file_basename: str,
+                counter: int, output_file_suffix: str):
+        planned_output_file = super().__new__(cls, output_file)
+        planned_output_file.output_file_basename = output_file_basename
+        planned_output_file.counter = counter
+        planned_output_file.output_file_suffix = output_file_suffix
+        return planned_output_file
+
+
+def _plan_output_file(input_file: str,
+                      dest_dir: str,
+                      separate: bool = False,
+                      do_rename: bool = True,
+                      locate_function: callable = _canonical_image_location,
+                      reserved_files: set = None,
+                      plan_function: callable = None) -> str:
+    """
+    Plan the output file of ``input_file`` in ``dest_dir``: the first free
+    name, with a counter suffix if taken (also by the ``reserved_files`` of
+    pending file operations). With a ``plan_function`` (e.g.
+    :meth:`_ArchiveSink.plan`), the output backend chooses the name from
+    the output file without counter suffix instead.
+    """
+    # output_subdir = _get_image_subdir(input_file)
+    # output_subdir = _get_generic_subdir(input_file)
+    # output_subdir, output_file_name = _canonical_image_location(input_file)
+    (
+        media_subdir,
+        output_subdir,
+        output_file_basename,
+        output_file_ext,
+    ) = locate_function(input_file)
+    if separate:
+        output_dir = join(dest_dir, media_subdir, output_subdir)
+    else:
+        output_dir = join(dest_dir, output_subdir)
+
+    if not do_rename:
+        output_file_basename, output_file_ext = splitext(basename(input_file))
+        # Without the dot
+        output_file_ext = output_file_ext[1:]
+
+    output_file_name = '.'.join((output_file_basename, output_file_ext))
+    output_file = join(output_dir, output_file_name)
+
+    # if exists(output_file):
+    #     raise Exception(
+    #         'Output file \'{}\' already exists'.format(output_file))
+
+    def is_taken(output_file: str) -> bool:
+        if reserved_files is not None and output_file in reserved_files:
+            return True
+        # The input file may already be at its location (re-layout)
+        return (exists(output_file)
+                and abspath(output_file) != abspath(input_file))
+
+    with _STATS.timer('naming', input_file):
+        if plan_function is not None:
+            return plan_function(input_file, output_file)
+
+        counter = 0
+        while is_taken(output_file):
+            counter += 1
+            _LOGGER.info('Output file \033[0;33m\'%s\'\033[0;m already exists',
+                         output_file)
+            output_file_name = '.'.join(
+                (f'{output_file_basename}_{counter}', output_file_ext))
+            output_file = join(output_dir, output_file_name)
+
+    output_file = _PlannedOutputFile(output_file, output_file_basename,
+                                     counter, '.' + output_file_ext)
+    if reserved_files is not None:
+        reserved_files.add(output_file)
+
+    return output_file
+
+
+# renameat2(2) flag and "current directory" file descriptor
+_RENAME_NOREPLACE = 1
+_AT_FDCWD = -100
+# Errors of file systems which don't support renameat2 or hard links
+_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP,
+                       errno.EOPNOTSUPP, errno.EPERM, errno.EMLINK)
+
+_libc = None
+
+
+def _renameat2(input_file: str, output_file: str, flags: int):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(_libc, 'renameat2'):
+        # glibc < 2.28 (or no glibc at all)
+        raise OSError(errno.ENOSYS, 'renameat2 is not available')
+    if _libc.renameat2(_AT_FDCWD, fsencode(input_file), _AT_FDCWD,
+                       fsencode(output_file), flags) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, f'renameat2: {errno.errorcode.get(error)}',
+                      input_file, None, output_file)
+
+
+def _rename_exclusive(input_file: str, output_file: str):
+    """
+    Rename ``input_file`` to ``output_file``, atomically failing with
+    ``FileExistsError`` if ``output_file`` exists: with
+    ``renameat2(RENAME_NOREPLACE)``, or by hard linking it (and removing
+    ``input_file``) if not supported. File systems supporting neither
+    (e.g. FAT) fall back to checking first.
+    """
+    try:
+        _renameat2(input_file, output_file, _RENAME_NOREPLACE)
+        return
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+    try:
+        link(input_file, output_file)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+    else:
+        unlink(input_file)
+        return
+    if exists(output_file):
+        raise FileExistsError(errno.EEXIST, 'File exists', output_file)
+    rename(input_file, output_file)
+
+
+def _claim_output_file(claim_function: callable, output_file: str) -> str:
+    """
+    Call ``claim_function(output_file)``, which fails with
+    ``FileExistsError`` if ``output_file`` exists (e.g. written by another
+    process in the meantime). In that case, the next free name with a counter
+    suffix is claimed instead, continuing after the counter of the name
+    planned by :func:`_plan_output_file`. Returns the claimed output file.
+    """
+    output_dir = dirname(output_file)
+    if isinstance(output_file, _PlannedOutputFile):
+        output_file_basename = output_file.output_file_basename
+        counter = output_file.counter
+        output_file_ext = output_file.output_file_suffix
+    else:
+        # Planned by an earlier run (see _resume_planned_files): a trailing
+        # number may be part of the name (e.g. IMG_1234.jpg with --no-rename)
+        output_file_basename, output_file_ext = splitext(basename(output_file))
+        counter = 0
+    while True:
+        try:
+            claim_function(output_file)
+            return output_file
+        except FileExistsError:
+            counter += 1
+            _LOGGER.info('Output file \033[0;33m\'%s\'\033[0;m already exists',
+                         output_file)
+            output_file = join(
+                output_dir,
+                f'{output_file_basename}_{counter}{output_file_ext}')
+
+
+# Prefix of the temporary files (e.g. in the destination directories)
+_TEMP_FILE_PREFIX = '.sort-media-'
+# Seconds after which temporary files are considered left by a crashed run
+_STALE_TEMP_FILE_AGE = 10 * 60
+
+
+def _copy_exclusive(input_file: str,
+                    output_file: str,
+                    copy_function: callable = copy) -> str:
+    """
+    Copy ``input_file`` to a temporary file next to ``output_file`` and
+    rename it to ``output_file`` (or the next free name, see
+    :func:`_claim_output_file`), without ever overwriting an existing file.
+    Returns the output file.
+    """
+    temp_fd, temp_file = mkstemp(prefix=_TEMP_FILE_PREFIX,
+                                 suffix=splitext(output_file)[1],
+                                 dir=dirname(output_file))
+    close(temp_fd)
+    try:
+        copy_function(input_file, temp_file)
+        return _claim_output_file(partial(_rename_exclusive, temp_file),
+                                  output_file)
+    finally:
+        if exists(temp_file):
+            unlink(temp_file)
+
+
+def _move_exclusive(input_file: str,
+                    output_file: str,
+                    copy_function: callable = copy) -> str:
+    """
+    Move ``input_file`` to ``output_file`` (or the next free name), without
+    ever overwriting an existing file. Files on other file systems are
+    copied (see :func:`_copy_exclusive`) and removed afterwards.
+    Returns the output file.
+    """
+    if abspath(input_file) == abspath(output_file):
+        # Already at its location (re-layout)
+        return output_file
+    try:
+        return _claim_output_file(partial(_rename_exclusive, input_file),
+                                  output_file)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    output_file = _copy_exclusive(input_file,
+                                  output_file,
+                                  copy_function=copy_function)
+    unlink(input_file)
+    return output_file
+
+
+def _prepare_input_file(input_file: str,
+                        dest_dir: str,
+                        separate: bool = False,
+                        do_rename: bool = True,
+                        journal: _Journal = None,
+                        locate_function: callable = _canonical_image_location,
+                        reserved_files: set = None,
+                        plan_function: callable = None):
+    """
+    Plan the output file for ``input_file``, see :func:`_plan_output_file`.
+    Returns ``None`` for directories.
+    """
+    if isdir(input_file):
+        _LOGGER.info('Skipping directory \033[0;33m%s\033[0;m', input_file)
+        return None
+
+    _LOGGER.info('Processing input file %s', input_file)
+
+    output_file = _plan_output_file(input_file,
+                                    dest_dir,
+                                    separate=separate,
+                                    do_rename=do_rename,
+                                    locate_function=locate_function,
+                                    reserved_files=reserved_files,
+                                    plan_function=plan_function)
+
+    # _LOGGER.info('Copying %s to %s', input_file, output_dir)
+
+    # makedirs(output_dir, mode=0o755, exist_ok=True)
+
+    # # process_function(input_file, output_dir)
+
+    if journal is not None:
+        journal.plan(input_file, output_file)
+
+    return output_file
+
+
+def _process_input_file(input_file: str,
+                        dest_dir: str,
+                        separate: bool = False,
+                        do_rename: bool = True,
+                        process_function: callable = copy,
+                        journal: _Journal = None,
+                        locate_function: callable = _canonical_image_location,
+                        plan_function: callable = None):
+    output_file = _prepare_input_file(input_file,
+                                      dest_dir,
+                                      separate=separate,
+                                      do_rename=do_rename,
+                                      journal=journal,
+                                      locate_function=locate_function,
+                                      plan_function=plan_function)
+    if output_file is None:
+        return None
+
+    output_file = process_function(input_file, output_file) or output_file
+
+    if journal is not None:
+        journal.done(input_file, output_file)
+
+    return output_file
+
+
+# Maximum number of input files parsed ahead (keeps memory bounded)
+_MAX_PARSE_AHEAD = 256
+
+# Result of processing a single input file.
+# status is one of 'done', 'skipped' or 'failed', reason is why the file was
+# skipped (one of the _SKIPPED_* constants)
+MediaFileResult = namedtuple('MediaFileResult',
+                             ('input_file', 'status', 'output_file', 'error',
+                              'reason'),
+                             defaults=(None, None, None))
+
+_SKIPPED_JOURNALED = 'journaled'
+_SKIPPED_DIRECTORY = 'directory'
+
+
+# Digest size (bytes) of the files in the manifest
+_MANIFEST_DIGEST_SIZE = 16
+_MANIFEST_BUFFER_SIZE = 1024 * 1024
+
+
+class _Manifest:
+    """
+    Manifest of a run (see ``--manifest``): a JSON lines file with a
+    record per input file, written once it is processed. Unlike the
+    journal, the records are buffered (and only flushed when the buffer
+    is full and on close), so writing the manifest costs next to nothing.
+
+    Records have the input and output files, the media type, the
+    extraction backend, the source of the date/time, the size and digest
+    (BLAKE2b) of the content, the status and the class of the error (if
+    failed), and the time spent per stage in milliseconds (see
+    :data:`_STAGES`). Details of files which were not processed (e.g.
+    skipped or failed early on) are missing. The digest is computed while
+    copying, files which are not copied (renamed or archived) only get one
+    with ``manifest_digest`` (see :func:`_generate_process_function`).
+    """
+
+    def __init__(self, manifest_file: str):
+        self.manifest_file = manifest_file
+        self._fd = None
+        self._lock = Lock()
+
+    def open(self):
+        self._fd = open(self.manifest_file,
+                        'a',
+                        encoding='utf-8',
+                        buffering=_MANIFEST_BUFFER_SIZE)
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def write(self, result: MediaFileResult):
+        details = _STATS.pop_details(result.input_file)
+        record = dict(
+            src=abspath(result.input_file),
+            dst=result.output_file and abspath(result.output_file),
+            media_type=details.get('media_type'),
+            backend=details.get('backend'),
+            date_source=details.get('date_source'),
+            size=details.get('size'),
+            digest=details.get('digest'),
+            status=result.status,
+            # The error is '<class>: <message>' (see _failed_result)
+            error=result.error and result.error.split(':', 1)[0],
+            timings={
+                stage: round(seconds * 1000, 3)
+                for stage, seconds in details.get('timings', {}).items()
+            })
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._fd.write(line)
+
+
+def _failed_result(input_file: str, journal: _Journal = None):
+    """
+    Report the exception being handled for ``input_file``.
+    """
+    _LOGGER.info(
+        'Failed to process \033[0;31m%s\033[0;m. \033[0;33mSkipping\033[0;m.',
+        input_file)
+    _LOGGER.exception('Failed to process %s.', input_file)
+    if journal is not None:
+        journal.fail(input_file)
+    error = sys.exc_info()[1]
+    return MediaFileResult(input_file,
+                           'failed',
+                           error=f'{type(error).__name__}: {error}')
+
+
+def _try_process_input_file(
+        input_file: str,
+        dest_dir: str,
+        separate: bool = False,
+        do_rename: bool = True,
+        process_function: callable = copy,
+        journal: _Journal = None,
+        locate_function: callable = _canonical_image_location,
+        plan_function: callable = None) -> MediaFileResult:
+    if journal is not None and journal.is_known(input_file):
+        _LOGGER.debug('Skipping already journaled input file %s', input_file)
+        return MediaFileResult(input_file,
+                               'skipped',
+                               reason=_SKIPPED_JOURNALED)
+    try:
+        output_file = _process_input_file(input_file,
+                                          dest_dir,
+                                          separate=separate,
+                                          do_rename=do_rename,
+                                          process_function=process_function,
+                                          journal=journal,
+                                          locate_function=locate_function,
+                                          plan_function=plan_function)
+    except:
+        return _failed_result(input_file, journal)
+
+    if output_file is None:
+        return MediaFileResult(input_file,
+                               'skipped',
+                               reason=_SKIPPED_DIRECTORY)
+    return MediaFileResult(input_file, 'done', output_file)
+
+
+def _try_commit_output_file(input_file: str,
+                            output_file: str,
+                            process_function: callable = copy,
+                            journal: _Journal = None,
+                            reserved_files: set = None) -> MediaFileResult:
+    """
+    Apply the file operation prepared by :func:`_prepare_input_file`.
+    """
+    planned_output_file = output_file
+    try:
+        output_file = process_function(input_file, output_file) or output_file
+    except:
+        return _failed_result(input_file, journal)
+    finally:
+        if reserved_files is not None:
+            # The output file exists now (or the name is free again)
+            reserved_files.discard(planned_output_file)
+
+    if journal is not None:
+        journal.done(input_file, output_file)
+    return MediaFileResult(input_file, 'done', output_file)
+
+
+_TRANSFER_LANES = ('pictures', 'videos', 'audio', 'other', 'huge')
+_DEFAULT_LANE_JOBS = {
+    'pictures': 4,
+    'videos': 2,
+    'audio': 2,
+    'other': 2,
+    'huge': 1,
+}
+_MEDIA_SUBDIR_LANES = {
+    _PICTURES_SUBDIR: 'pictures',
+    _VIDEOS_SUBDIR: 'videos',
+    _AUDIO_SUBDIR: 'audio',
+}
+# Default minimum size of files in the 'huge' lane
+_HUGE_FILE_SIZE = 1000 * 1000 * 1000
+# Maximum number of worker threads per lane for --jobs auto
+_MAX_AUTO_LANE_JOBS = 16
+
+
+class _TransferLanes:
+    """
+    Worker pools (lanes) for the file operations, per media type and for
+    huge files. Many small pictures keep flowing while big videos are
+    being copied.
+
+    With ``auto`` concurrency, every lane gets a :class:`_StageConcurrency`
+    (see :attr:`stages`) which limits its workers.
+    """
+
+    def __init__(self,
+                 lane_jobs: dict = None,
+                 huge_file_size: int = _HUGE_FILE_SIZE,
+                 auto: bool = False):
+        lane_jobs = dict(_DEFAULT_LANE_JOBS, **(lane_jobs or {}))
+        self.huge_file_size = huge_file_size
+        self.stages = {}
+        self._executors = {}
+        self._queued = {}
+        self._waiting = {}
+        for lane, jobs in lane_jobs.items():
+            if auto:
+                self.stages[lane] = _StageConcurrency(
+                    lane,
+                    limit=jobs,
+                    max_limit=_MAX_AUTO_LANE_JOBS,
+                    queue_depth=partial(self._queue_depth, lane))
+                jobs = _MAX_AUTO_LANE_JOBS
+            self._executors[lane] = ThreadPoolExecutor(
+                max_workers=jobs, thread_name_prefix=f'transfer-{lane}')
+            # Bound the queue, to keep the reserved names bounded
+            self._queued[lane] = BoundedSemaphore(_MAX_PARSE_AHEAD)
+            self._waiting[lane] = 0
+        self._lock = Lock()
+
+    def _queue_depth(self, lane: str) -> tuple:
+        return self._waiting[lane], 0
+
+    def lane(self, media_subdir: str, input_file: str) -> str:
+        try:
+            if stat(input_file).st_size >= self.huge_file_size:
+                return 'huge'
+        except OSError:
+            pass
+        return _MEDIA_SUBDIR_LANES.get(media_subdir, 'other')
+
+    def submit(self, lane: str, function: callable, input_file: str, *args,
+               **kwargs):
+        """
+        Run ``function(input_file, *args, **kwargs)`` in ``lane``.
+        Blocks while too many operations are queued in the lane.
+        """
+        self._queued[lane].acquire()
+        with self._lock:
+            self._waiting[lane] += 1
+        stage = self.stages.get(lane)
+
+        def run():
+            with self._lock:
+                self._waiting[lane] -= 1
+            try:
+                if stage is None:
+                    return function(input_file, *args, **kwargs)
+                return stage.run(function, input_file, *args, **kwargs)
+            finally:
+                self._queued[lane].release()
+
+        return self._executors[lane].submit(run)
+
+    def shutdown(self, cancel_futures: bool = False):
+        """
+        Wait for the file operations, after cancelling the queued ones
+        with ``cancel_futures``.
+        """
+        for executor in self._executors.values():
+            executor.shutdown(wait=True, cancel_futures=cancel_futures)
+
+
+# FIEMAP ioctl (see linux/fiemap.h), requesting only the first extent
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = '=QQIIII'
+_FIEMAP_EXTENT = '=QQQQQIIII'
+_FIEMAP_REQUEST = pack(_FIEMAP_HEADER, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1,
+                       0) + bytes(calcsize(_FIEMAP_EXTENT))
+
+_INPUT_FILE_ORDERS = ('name', 'inode', 'extent')
+
+
+def _first_extent_offset(input_file: str) -> int:
+    """
+    Return the physical offset (on disk) of the first extent of
+    ``input_file``. Raises ``OSError`` when not supported (e.g. by the
+    file system).
+    """
+    with open(input_file, 'rb') as input_fd:
+        fiemap = bytearray(_FIEMAP_REQUEST)
+        ioctl(input_fd.fileno(), _FS_IOC_FIEMAP, fiemap)
+    mapped_extents = unpack_from(_FIEMAP_HEADER, fiemap)[3]
+    if mapped_extents == 0:
+        # Empty file (or data inlined in the inode)
+        return 0
+    return unpack_from(_FIEMAP_EXTENT, fiemap, calcsize(_FIEMAP_HEADER))[1]
+
+
+def _order_input_files(input_files, order: str = 'name'):
+    """
+    Order the input files by their physical location for ``order`` 'inode'
+    (inode number) or 'extent' (offset of the first extent on disk), to
+    avoid seeking all over the disk on rotational media. Input files are
+    grouped by device first.
+
+    The default ('name') keeps the (glob) order and doesn't need to list
+    all input files first.
+    """
+    if order == 'name':
+        return input_files
+
+    use_extents = order == 'extent'
+
+    def location(input_file: str) -> tuple:
+        """
+        Return ``(device, extent offset or inode number, inode number,
+        input file)``.
+        """
+        nonlocal use_extents
+        try:
+            file_stat = stat(input_file)
+        except OSError:
+            return (-1, -1, -1, input_file)
+        if use_extents and not S_ISDIR(file_stat.st_mode):
+            try:
+                return (file_stat.st_dev, _first_extent_offset(input_file),
+                        file_stat.st_ino, input_file)
+            except OSError as e:
+                _LOGGER.warning(
+                    'Unable to get extents (%s), ordering by inode instead',
+                    e)
+                use_extents = False
+        return (file_stat.st_dev, file_stat.st_ino, file_stat.st_ino,
+                input_file)
+
+    locations = [location(input_file) for input_file in input_files]
+    if order == 'extent' and not use_extents:
+        # Don't mix extent offsets and inode numbers after a fallback
+        locations = [(dev, inode, inode, input_file)
+                     for dev, _, inode, input_file in locations]
+    locations.sort()
+    _LOGGER.debug('Ordered %d input files by %s', len(locations), order)
+    return (input_file for _, _, _, input_file in locations)
+
+
+# Bytes of the upcoming input files to read ahead (media headers)
+_READAHEAD_SIZE = 256 * 1024
+# Number of upcoming input files to read ahead
+_READAHEAD_FILES = 8
+# Number of transfers after which dropping the output file from the page
+# cache is retried (its dirty pages are written back by then)
+_DROP_CACHE_DELAY = 16
+
+
+def _fadvise(file_name: str, offset: int, length: int, advice: int):
+    try:
+        fd = os_open(file_name, O_RDONLY | O_NONBLOCK | O_CLOEXEC)
+    except OSError:
+        # E.g. already moved or removed
+        return
+    try:
+        posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        _LOGGER.debug('posix_fadvise failed for %s: %s', file_name, e)
+    finally:
+        close(fd)
+
+
+def _readahead_input_files(input_files):
+    """
+    Yield the input files, asking the kernel to read the headers of the
+    upcoming ones ahead (``POSIX_FADV_WILLNEED``).
+    """
+    upcoming = deque()
+    for input_file in input_files:
+        _fadvise(input_file, 0, _READAHEAD_SIZE, POSIX_FADV_WILLNEED)
+        upcoming.append(input_file)
+        if len(upcoming) > _READAHEAD_FILES:
+            yield upcoming.popleft()
+    yield from upcoming
+
+
+class _TokenBucket:
+    """
+    Limit the ``rate`` of something (bytes, files, ...) per second,
+    allowing bursts up to ``burst``.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._tokens = self.burst
+        self._timestamp = monotonic()
+        self._lock = Lock()
+
+    def consume(self, amount: float = 1):
+        """
+        Take ``amount`` tokens, sleeping until they are available.
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+            # Going into debt makes the next consumers wait as well
+            self._tokens -= amount
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            sleep(delay)
+
+
+class _Throttle:
+    """
+    Limits for reading (bytes/second), writing (bytes/second) and
+    processed files per second. ``None`` means unlimited.
+    """
+
+    # Chunk size for throttled copies
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self,
+                 read_rate: float = None,
+                 write_rate: float = None,
+                 file_rate: float = None):
+        self._read = None if read_rate is None else _TokenBucket(
+            read_rate, max(read_rate, self.CHUNK_SIZE))
+        self._write = None if write_rate is None else _TokenBucket(
+            write_rate, max(write_rate, self.CHUNK_SIZE))
+        self._files = None if file_rate is None else _TokenBucket(
+            file_rate, max(file_rate, 1))
+
+    @property
+    def limits_bytes(self) -> bool:
+        return self._read is not None or self._write is not None
+
+    def read(self, size: int):
+        if self._read is not None:
+            self._read.consume(size)
+
+    def write(self, size: int):
+        if self._write is not None:
+            self._write.consume(size)
+
+    def file(self):
+        if self._files is not None:
+            self._files.consume()
+
+    def copy(self, input_file: str, output_file: str):
+        """
+        Same as ``shutil.copy2``, in chunks within the limits.
+        """
+        _copy_chunked(input_file, output_file, throttle=self)
+
+    def locate(self, input_file: str):
+        """
+        :func:`_canonical_image_location` within the limits, counting
+        the media header as read.
+        """
+        self.file()
+        if self._read is not None:
+            self.read(min(stat(input_file).st_size, _READAHEAD_SIZE))
+        return _canonical_image_location(input_file)
+
+
+def _copy_chunked(input_file: str,
+                  output_file: str,
+                  throttle: _Throttle = None,
+                  hasher=None):
+    """
+    Same as ``shutil.copy2``, in chunks: within the limits of ``throttle``
+    and updating ``hasher`` (e.g. ``hashlib.blake2b``) with the content, if
+    any, so the content is only read once.
+    """
+    with open(input_file, 'rb') as input_fd, \
+            open(output_file, 'wb') as output_fd:
+        for chunk in iter(partial(input_fd.read, _Throttle.CHUNK_SIZE), b''):
+            if throttle is not None:
+                throttle.read(len(chunk))
+                throttle.write(len(chunk))
+            if hasher is not None:
+                hasher.update(chunk)
+            output_fd.write(chunk)
+    copystat(input_file, output_file)
+
+
+_DEVICE_TYPES = ('rotational', 'solid-state', 'other')
+
+# Mount points of this process, with their devices and sources
+_MOUNTINFO_FILE = '/proc/self/mountinfo'
+
+
+def _backing_device(device: int):
+    """
+    Return the block device mounted as the anonymous ``device`` (major 0,
+    e.g. btrfs), from :data:`_MOUNTINFO_FILE`, or ``None`` if it has none
+    (NFS, SMB, tmpfs, overlayfs, zfs, ...).
+    """
+    device_id = f'{major(device)}:{minor(device)}'
+    try:
+        with open(_MOUNTINFO_FILE, 'r') as mountinfo_fd:
+            for line in mountinfo_fd:
+                # <id> <parent id> <major:minor> ... - <type> <source> ...
+                fields = line.split()
+                if len(fields) < 3 or fields[2] != device_id:
+                    continue
+                source = fields[fields.index('-') + 2]
+                if source.startswith('/dev/'):
+                    source_stat = stat(source)
+                    if S_ISBLK(source_stat.st_mode):
+                        return source_stat.st_rdev
+                return None
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _device_type(device: int) -> str:
+    """
+    Return the type of the block ``device`` (``st_dev``):
+    'rotational', 'solid-state' or 'other' (e.g. network file systems).
+    """
+    if major(device) == 0:
+        backing_device = _backing_device(device)
+        if backing_device is None:
+            _LOGGER.debug(
+                'Device %d:%d has no block device, falling back to other',
+                major(device), minor(device))
+            return 'other'
+        device = backing_device
+    sys_dir = f'/sys/dev/block/{major(device)}:{minor(device)}'
+    # Partitions don't have a queue, their disk does
+    for queue_dir in (join(sys_dir, 'queue'), join(sys_dir, '..', 'queue')):
+        try:
+            with open(join(queue_dir, 'rotational'), 'r') as rotational_fd:
+                rotational = rotational_fd.read().strip() == '1'
+        except OSError:
+            continue
+        return 'rotational' if rotational else 'solid-state'
+    return 'other'
+
+
+class _DeviceSlots:
+    """
+    Limit the number of concurrent operations per device, depending on the
+    type of device (see :func:`_device_type`).
+    """
+
+    def __init__(self, limits: dict):
+        self._limits = limits
+        self._semaphores = {}
+        self._lock = Lock()
+
+    def _semaphore(self, device: int) -> BoundedSemaphore:
+        with self._lock:
+            semaphore = self._semaphores.get(device)
+            if semaphore is None:
+                device_type = _device_type(device)
+                limit = self._limits[device_type]
+                _LOGGER.debug('Device %d:%d is %s, using %d slots',
+                              major(device), minor(device), device_type,
+                              limit)
+                semaphore = BoundedSemaphore(limit)
+                self._semaphores[device] = semaphore
+            return semaphore
+
+    @staticmethod
+    def _device(path: str) -> int:
+        # The output directory may not exist yet
+        while True:
+            try:
+                return stat(path).st_dev
+            except FileNotFoundError:
+                parent = dirname(path)
+                if parent == path:
+                    raise
+                path = parent
+
+    @contextmanager
+    def acquire(self, *paths: str):
+        """
+        Take a slot on the device of each of the ``paths``.
+        """
+        # Always in the same order, to avoid dead-locks
+        semaphores = [
+            self._semaphore(device)
+            for device in sorted({self._device(abspath(path))
+                                  for path in paths})
+        ]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    def locate(self, input_file: str, locate_function: callable):
+        with self.acquire(input_file):
+            return locate_function(input_file)
+
+
+class _StageConcurrency:
+    """
+    Adjustable limit of the number of concurrently running tasks of a
+    processing stage (e.g. parsing), with throughput counters for
+    :class:`_ConcurrencyController`.
+
+    ``queue_depth`` returns the number of tasks waiting to run and the
+    number of finished tasks waiting for the next stage.
+    """
+
+    def __init__(self,
+                 name: str,
+                 limit: int,
+                 max_limit: int,
+                 queue_depth: callable = None):
+        self.name = name
+        self.limit = limit
+        self.max_limit = max_limit
+        self.queue_depth = queue_depth or (lambda: (0, 0))
+        self.files = 0
+        self.bytes = 0
+        self._active = 0
+        self._condition = Condition()
+
+    def set_limit(self, limit: int):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    @contextmanager
+    def running(self, size: int = 0):
+        with self._condition:
+            self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self.files += 1
+                self.bytes += size
+                self._condition.notify()
+
+    def run(self, function: callable, input_file: str, *args, **kwargs):
+        try:
+            size = stat(input_file).st_size
+        except OSError:
+            size = 0
+        with self.running(size):
+            return function(input_file, *args, **kwargs)
+
+
+class _ConcurrencyController(Thread):
+    """
+    Tune the concurrency of processing stages to their measured throughput
+    (files per second), by hill climbing: keep changing the limit in the
+    same direction while the throughput improves, turn around when it
+    drops. On a plateau, fewer workers are preferred (the knee of the
+    curve). Stages whose results are piling up for the next stage are
+    scaled down.
+    """
+
+    # Relative throughput change considered significant
+    TOLERANCE = 0.05
+
+    def __init__(self, stages: list, interval: float = 2.0):
+        super().__init__(name='concurrency-controller', daemon=True)
+        self.stages = stages
+        self.interval = interval
+        # (seconds since start, stage, old limit, new limit, files/s, MB/s,
+        #  reason)
+        self.decisions = []
+        self._stop_event = Event()
+        self._state = {stage.name: (None, 1) for stage in stages}
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        start = monotonic()
+        last = {
+            stage.name: (stage.files, stage.bytes)
+            for stage in self.stages
+        }
+        while not self._stop_event.wait(self.interval):
+            for stage in self.stages:
+                files, size = stage.files, stage.bytes
+                last_files, last_size = last[stage.name]
+                last[stage.name] = (files, size)
+                if files == last_files:
+                    # Idle (e.g. waiting on discovery)
+                    continue
+                files_per_sec = (files - last_files) / self.interval
+                mb_per_sec = (size - last_size) / self.interval / 1e6
+                self._tune(stage, files_per_sec, mb_per_sec,
+                           monotonic() - start)
+
+    def _tune(self, stage: _StageConcurrency, files_per_sec: float,
+              mb_per_sec: float, elapsed: float):
+        last_throughput, direction = self._state[stage.name]
+        waiting, ready = stage.queue_depth()
+        if ready > waiting and ready >= 2 * stage.limit:
+            direction, reason = -1, f'next stage behind ({ready} ready)'
+        elif last_throughput is None:
+            reason = 'probing'
+        elif files_per_sec > last_throughput * (1 + self.TOLERANCE):
+            reason = 'throughput up'
+        elif files_per_sec < last_throughput * (1 - self.TOLERANCE):
+            direction, reason = -direction, 'throughput down'
+        else:
+            direction, reason = -1, 'throughput flat'
+        self._state[stage.name] = (files_per_sec, direction)
+
+        limit = min(stage.max_limit, max(1, stage.limit + direction))
+        if limit == stage.limit:
+            return
+        _LOGGER.info('Auto jobs: %s workers %d -> %d (%.1f files/s, '
+                     '%.1f MB/s, %s)', stage.name, stage.limit, limit,
+                     files_per_sec, mb_per_sec, reason)
+        self.decisions.append((elapsed, stage.name, stage.limit, limit,
+                               files_per_sec, mb_per_sec, reason))
+        stage.set_limit(limit)
+
+
+# ioprio_set(2) system call numbers
+_SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    'riscv64': 30,
+    's390x': 282,
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_CLASSES = {
+    # Lowest priority level of the best-effort class
+    'best-effort': (2 << _IOPRIO_CLASS_SHIFT) | 7,
+    'idle': 3 << _IOPRIO_CLASS_SHIFT,
+}
+
+
+def _set_io_priority(io_class: str):
+    """
+    Set the I/O scheduling class of this process, like ionice(1).
+    Threads started afterwards inherit it.
+    """
+    from platform import machine
+
+    syscall_number = _SYS_IOPRIO_SET.get(machine())
+    if syscall_number is None:
+        _LOGGER.warning('Setting the I/O priority is not supported on %s',
+                        machine())
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall_number, _IOPRIO_WHO_PROCESS, 0,
+                    _IOPRIO_CLASSES[io_class]) != 0:
+        _LOGGER.warning('Unable to set the I/O priority: %s',
+                        errno.errorcode.get(ctypes.get_errno()))
+
+
+# Archives (by file name) whose members can be ingested directly
+_ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+                     '.tar.xz', '.txz')
+# Separates the archive and the member name of archive members,
+# e.g. 'takeout.zip::Takeout/Google Photos/IMG_0001.jpg'
+_ARCHIVE_MEMBER_SEPARATOR = '::'
+_ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+
+def _is_archive(input_file: str) -> bool:
+    return (input_file.lower().endswith(_ARCHIVE_SUFFIXES)
+            and not isdir(input_file))
+
+
+def _is_archive_member(input_file: str) -> bool:
+    return _ARCHIVE_MEMBER_SEPARATOR in input_file
+
+
+def _iter_archive_members(archive_file: str):
+    """
+    Yield ``(member name, mtime, file object)`` for the regular files in
+    ``archive_file``, in the order of the archive. Tar archives (also
+    compressed) are read as a stream, so every member can only be read
+    before continuing with the next member.
+    """
+    if archive_file.lower().endswith('.zip'):
+        with ZipFile(archive_file) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                mtime = datetime.datetime(*info.date_time).timestamp()
+                with archive.open(info) as member_fd:
+                    yield info.filename, mtime, member_fd
+    else:
+        with tarfile.open(archive_file, mode='r|*') as archive:
+            for info in archive:
+                if not info.isfile():
+                    continue
+                yield info.name, info.mtime, archive.extractfile(info)
+
+
+def _try_ingest_archive_member(member_file: str,
+                               member_fd,
+                               mtime: float,
+                               dest_dir: str,
+                               separate: bool = False,
+                               do_rename: bool = True,
+                               archive_function: callable = move,
+                               journal: _Journal = None,
+                               locate_function:
+                               callable = _canonical_image_location,
+                               reserved_files: set = None,
+                               throttle: _Throttle = None,
+                               extract_dir: str = None,
+                               plan_function: callable = None
+                               ) -> MediaFileResult:
+    """
+    Ingest an archive member, reading it only once: the member is written
+    to a temporary file in ``extract_dir`` (by default ``dest_dir``) while
+    reading it from the archive. Its media information is then parsed from
+    that file (still in the page cache) and ``archive_function`` renames it
+    to its output file.
+    """
+    if journal is not None and journal.is_known(member_file):
+        _LOGGER.debug('Skipping already journaled archive member %s',
+                      member_file)
+        return MediaFileResult(member_file,
+                               'skipped',
+                               reason=_SKIPPED_JOURNALED)
+
+    _LOGGER.info('Processing archive member %s', member_file)
+
+    if extract_dir is None:
+        extract_dir = dest_dir
+    makedirs(extract_dir, mode=0o755, exist_ok=True)
+    # Same file extension, which is used by MediaInfo
+    temp_fd, temp_file = mkstemp(prefix=_TEMP_FILE_PREFIX,
+                                 suffix=splitext(member_file)[1],
+                                 dir=extract_dir)
+    planned_output_file = None
+    try:
+        with open(temp_fd, 'wb') as output_fd, _STATS.timer(
+                'extract', member_file):
+            for chunk in iter(partial(member_fd.read, _ARCHIVE_CHUNK_SIZE),
+                              b''):
+                if throttle is not None:
+                    throttle.read(len(chunk))
+                    throttle.write(len(chunk))
+                output_fd.write(chunk)
+        chmod(temp_file, 0o644)
+        utime(temp_file, (mtime, mtime))
+
+        output_file = _plan_output_file(
+            member_file,
+            dest_dir,
+            separate=separate,
+            do_rename=do_rename,
+            locate_function=lambda member_file: locate_function(temp_file),
+            reserved_files=reserved_files,
+            plan_function=plan_function)
+        if journal is not None:
+            journal.plan(member_file, output_file)
+
+        planned_output_file = output_file
+        output_file = archive_function(temp_file, output_file) or output_file
+    except:
+        return _failed_result(member_file, journal)
+    finally:
+        if reserved_files is not None:
+            reserved_files.discard(planned_output_file)
+        # Not renamed (failed or dry-run)
+        if exists(temp_file):
+            unlink(temp_file)
+        _STATS.move_details(temp_file, member_file)
+
+    if journal is not None:
+        journal.done(member_file, output_file)
+    return MediaFileResult(member_file, 'done', output_file)
+
+
+def _ingest_archive(archive_file: str,
+                    dest_dir: str,
+                    separate: bool = False,
+                    do_rename: bool = True,
+                    archive_function: callable = move,
+                    journal: _Journal = None,
+                    locate_function: callable = _canonical_image_location,
+                    reserved_files: set = None,
+                    throttle: _Throttle = None,
+                    extract_dir: str = None,
+                    plan_function: callable = None):
+    """
+    Ingest the members of ``archive_file`` (see
+    :func:`_try_ingest_archive_member`) and yield a
+    :class:`MediaFileResult` for each of them.
+    """
+    _LOGGER.info('Processing archive \033[0;33m%s\033[0;m', archive_file)
+    try:
+        for member_name, mtime, member_fd in _iter_archive_members(
+                archive_file):
+            yield _try_ingest_archive_member(
+                f'{archive_file}{_ARCHIVE_MEMBER_SEPARATOR}{member_name}',
+                member_fd,
+                mtime,
+                dest_dir,
+                separate=separate,
+                do_rename=do_rename,
+                archive_function=archive_function,
+                journal=journal,
+                locate_function=locate_function,
+                reserved_files=reserved_files,
+                throttle=throttle,
+                extract_dir=extract_dir,
+                plan_function=plan_function)
+    except:
+        # Invalid or truncated archive
+        yield _failed_result(archive_file, journal)
+
+
+_DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_digest(input_file: str,
+                 digest_size: int = _DIGEST_SUFFIX_LENGTH // 2) -> str:
+    digest = hashlib.blake2b(digest_size=digest_size)
+    with open(input_file, 'rb') as input_fd:
+        for chunk in iter(partial(input_fd.read, _DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _digest_location(input_file: str, locate_function: callable):
+    """
+    Same as ``locate_function``, with a (short) digest of the content of
+    ``input_file`` appended to the file name. Different files with the same
+    date/time thus get different names, without checking (or reserving)
+    names in the destination directory first.
+    """
+    (
+        media_subdir,
+        output_subdir,
+        output_file_basename,
+        output_file_ext,
+    ) = locate_function(input_file)
+    return (
+        media_subdir,
+        output_subdir,
+        f'{output_file_basename}_{_file_digest(input_file)}',
+        output_file_ext,
+    )
+
+
+def _in_shard(input_file: str, root_dir: str, shard: tuple) -> bool:
+    """
+    Whether ``input_file`` belongs to ``shard`` (``(index, count)``, index
+    starting at 1), by a stable hash of its path relative to ``root_dir``:
+    the same on every run and machine.
+    """
+    index, count = shard
+    return zlib.crc32(fsencode(relpath(input_file, root_dir))) % count == (
+        index - 1)
+
+
+def _iter_process_media_files(source_files: str,
+                              dest_dir: str,
+                              separate: bool = False,
+                              do_rename: bool = True,
+                              process_function: callable = copy,
+                              journal: _Journal = None,
+                              executor: Executor = None,
+                              order: str = 'name',
+                              readahead: bool = False,
+                              throttle: _Throttle = None,
+                              device_slots: _DeviceSlots = None,
+                              parse_concurrency: _StageConcurrency = None,
+                              transfer_lanes: _TransferLanes = None,
+                              archive_function: callable = None,
+                              extract_dir: str = None,
+                              shard: tuple = None,
+                              progress: _ProgressReporter = None,
+                              plan_function: callable = None):
+    """
+    Process the source files and yield a :class:`MediaFileResult` for each
+    of them (in ``order``, see :func:`_order_input_files`).
+
+    With ``readahead``, the headers of the upcoming input files are read
+    ahead, see :func:`_readahead_input_files`.
+
+    With an ``executor``, the media files are parsed in parallel (ahead).
+    Choosing the output file names and the file operations are still done
+    one by one (in order), so the output file names are the same as
+    without ``executor``. The number of media files parsed at the same
+    time is further limited by ``parse_concurrency``.
+
+    With ``transfer_lanes`` (and an ``executor``), the file operations are
+    run in parallel as well, in the lane for their media type or size.
+    The output file names are still chosen in order (reserving the names
+    of pending operations), but results are yielded as the file
+    operations complete.
+
+    Parsing is also limited by ``throttle`` and ``device_slots``.
+
+    With an ``archive_function``, the members of zip and tar archives are
+    ingested (see :func:`_ingest_archive`) instead of the archives, one
+    archive at a time. They are extracted to ``extract_dir`` (by default
+    ``dest_dir``), see :func:`_try_ingest_archive_member`.
+
+    With a ``shard`` (``(index, count)``), only the source files of that
+    shard are processed (see :func:`_in_shard`) and the output file names
+    get a digest of their content (see :func:`_digest_location`), so all
+    shards can write to the same ``dest_dir`` at the same time.
+
+    The discovered input files are counted by ``progress`` (if any).
+
+    With a ``plan_function``, the output backend chooses the output files
+    (e.g. :meth:`_ArchiveSink.plan`), see :func:`_plan_output_file`.
+    """
+    if journal is not None:
+        _resume_planned_files(journal, process_function)
+
+    input_files = iglob(source_files, recursive=True)
+    if _STATS.enabled:
+        input_files = _STATS.timed('discovery', input_files)
+    if shard is not None:
+        root_dir = _glob_root(source_files)
+        input_files = (input_file for input_file in input_files
+                       if _in_shard(input_file, root_dir, shard))
+    if progress is not None:
+        input_files = progress.discovering(input_files)
+    input_files = _order_input_files(input_files, order=order)
+    if readahead:
+        input_files = _readahead_input_files(input_files)
+    if throttle is None:
+        locate_function = _canonical_image_location
+    else:
+        locate_function = throttle.locate
+    if shard is not None:
+        locate_function = partial(_digest_location,
+                                  locate_function=locate_function)
+    if device_slots is not None:
+        locate_function = partial(device_slots.locate,
+                                  locate_function=locate_function)
+    if parse_concurrency is not None:
+        locate_function = partial(parse_concurrency.run, locate_function)
+    reserved_files = set()
+
+    def is_archive(input_file: str) -> bool:
+        return archive_function is not None and _is_archive(input_file)
+
+    def ingest_archive(archive_file: str):
+        return _ingest_archive(archive_file,
+                               dest_dir,
+                               separate=separate,
+                               do_rename=do_rename,
+                               archive_function=archive_function,
+                               journal=journal,
+                               locate_function=locate_function,
+                               reserved_files=reserved_files,
+                               throttle=throttle,
+                               extract_dir=extract_dir,
+                               plan_function=plan_function)
+
+    if executor is None:
+        for input_file in input_files:
+            if is_archive(input_file):
+                yield from ingest_archive(input_file)
+                continue
+            yield _try_process_input_file(input_file,
+                                          dest_dir,
+                                          separate=separate,
+                                          do_rename=do_rename,
+                                          process_function=process_function,
+                                          journal=journal,
+                                          locate_function=locate_function,
+                                          plan_function=plan_function)
+        return
+
+    def process_next():
+        input_file, location = pending.popleft()
+        if is_archive(input_file):
+            yield from ingest_archive(input_file)
+        elif transfer_lanes is not None:
+            result = dispatch(input_file, location)
+            if result is not None:
+                yield result
+        else:
+            yield _try_process_input_file(
+                input_file,
+                dest_dir,
+                separate=separate,
+                do_rename=do_rename,
+                process_function=process_function,
+                journal=journal,
+                locate_function=lambda input_file: location.result(),
+                plan_function=plan_function)
+        yield from completed_results()
+
+    completed = deque()
+    transfers = set()
+
+    def dispatch(input_file: str, location) -> MediaFileResult:
+        if journal is not None and journal.is_known(input_file):
+            return MediaFileResult(input_file,
+                                   'skipped',
+                                   reason=_SKIPPED_JOURNALED)
+        try:
+            output_file = _prepare_input_file(
+                input_file,
+                dest_dir,
+                separate=separate,
+                do_rename=do_rename,
+                journal=journal,
+                locate_function=lambda input_file: location.result(),
+                reserved_files=reserved_files,
+                plan_function=plan_function)
+        except:
+            return _failed_result(input_file, journal)
+        if output_file is None:
+            return MediaFileResult(input_file,
+                                   'skipped',
+                                   reason=_SKIPPED_DIRECTORY)
+
+        media_subdir = location.result()[0]
+        transfer = transfer_lanes.submit(
+            transfer_lanes.lane(media_subdir, input_file),
+            _try_commit_output_file,
+            input_file,
+            output_file,
+            process_function=process_function,
+            journal=journal,
+            reserved_files=reserved_files)
+        transfers.add(transfer)
+        transfer.add_done_callback(completed.append)
+        return None
+
+    def completed_results():
+        while completed:
+            transfer = completed.popleft()
+            transfers.discard(transfer)
+            yield transfer.result()
+
+    pending = deque()
+
+    def queue_depth() -> tuple:
+        ready = sum(1 for _, location in list(pending)
+                    if location is not None and location.done())
+        return len(pending) - ready, ready
+
+    if parse_concurrency is not None:
+        parse_concurrency.queue_depth = queue_depth
+    if _STATS.enabled:
+        _STATS.queues['parse'] = queue_depth
+
+    for input_file in input_files:
+        if isdir(input_file) or is_archive(input_file) or (
+                journal is not None and journal.is_known(input_file)):
+            location = None
+        else:
+            location = executor.submit(locate_function, input_file)
+        pending.append((input_file, location))
+        if len(pending) >= _MAX_PARSE_AHEAD:
+            yield from process_next()
+    while pending:
+        yield from process_next()
+    while transfers:
+        wait(list(transfers), return_when=FIRST_COMPLETED)
+        yield from completed_results()
+
+
+def process_media_files(source_files: str,
+                        dest_dir: str,
+                        separate: bool = False,
+                        do_rename: bool = True,
+                        process_function: callable = copy,
+                        journal: _Journal = None,
+                        executor: Executor = None,
+                        on_result: callable = None,
+                        order: str = 'name',
+                        readahead: bool = False,
+                        throttle: _Throttle = None,
+                        device_slots: _DeviceSlots = None,
+                        parse_concurrency: _StageConcurrency = None,
+                        transfer_lanes: _TransferLanes = None,
+                        archive_function: callable = None,
+                        extract_dir: str = None,
+                        shard: tuple = None,
+                        progress: _ProgressReporter = None,
+                        plan_function: callable = None):
+    """
+    Sort the media files matching ``source_files`` into ``dest_dir``.
+
+    ``on_result`` is called with the :class:`MediaFileResult` of each input
+    file. See :func:`_iter_process_media_files` for ``executor``, ``order``,
+    ``readahead``, ``throttle``, ``device_slots``, ``parse_concurrency``,
+    ``transfer_lanes``, ``archive_function``, ``extract_dir``, ``shard``,
+    ``progress`` and ``plan_function``.
+    """
+    for result in _iter_process_media_files(
+            source_files,
+            dest_dir,
+            separate=separate,
+            do_rename=do_rename,
+            process_function=process_function,
+            journal=journal,
+            executor=executor,
+            order=order,
+            readahead=readahead,
+            throttle=throttle,
+            device_slots=device_slots,
+            parse_concurrency=parse_concurrency,
+            transfer_lanes=transfer_lanes,
+            archive_function=archive_function,
+            extract_dir=extract_dir,
+            shard=shard,
+            progress=progress,
+            plan_function=plan_function):
+        if on_result is not None:
+            on_result(result)
+
+
+async def process_media_files_async(source_files: str,
+                                    dest_dir: str,
+                                    separate: bool = False,
+                                    do_rename: bool = True,
+                                    process_function: callable = copy,
+                                    journal: _Journal = None,
+                                    jobs: int = _DEFAULT_JOBS,
+                                    lane_jobs: dict = None,
+                                    max_pending: int = _MAX_PARSE_AHEAD,
+                                    **kwargs):
+    """
+    Asynchronous version of :func:`process_media_files`, for asyncio
+    applications: an asynchronous generator of the :class:`MediaFileResult`
+    of each input file, as the file operations complete.
+
+    The media files are parsed by ``jobs`` worker threads and the file
+    operations are run in lanes (see :class:`_TransferLanes` for
+    ``lane_jobs``), so the event loop is never blocked. At most
+    ``max_pending`` results are buffered for a slow consumer. See
+    :func:`_iter_process_media_files` for the other arguments.
+
+    Cancelling the consuming task (or closing the generator) stops the run
+    cleanly: no more input files are started, and the file operations in
+    progress are completed first.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    results = asyncio.Queue()
+    # Free slots of the buffered results
+    slots = Semaphore(max_pending)
+    stop_event = Event()
+
+    def produce():
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        transfer_lanes = _TransferLanes(lane_jobs)
+        iterator = _iter_process_media_files(source_files,
+                                             dest_dir,
+                                             separate=separate,
+                                             do_rename=do_rename,
+                                             process_function=process_function,
+                                             journal=journal,
+                                             executor=executor,
+                                             transfer_lanes=transfer_lanes,
+                                             **kwargs)
+        try:
+            for result in iterator:
+                slots.acquire()
+                if stop_event.is_set():
+                    break
+                loop.call_soon_threadsafe(results.put_nowait, result)
+        finally:
+            iterator.close()
+            # Operations in progress are completed, queued ones cancelled
+            transfer_lanes.shutdown(cancel_futures=stop_event.is_set())
+            executor.shutdown(cancel_futures=True)
+            loop.call_soon_threadsafe(results.put_nowait, None)
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            result = await results.get()
+            slots.release()
+            if result is None:
+                break
+            yield result
+    finally:
+        if not producer.done():
+            stop_event.set()
+            slots.release()
+        # Raises the exception of the producer (if any)
+        await asyncio.shield(producer)
+
+
+# inotify(7) constants
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+
+_INOTIFY_EVENT = 'iIII'
+_INOTIFY_EVENT_SIZE = calcsize(_INOTIFY_EVENT)
+
+
+class _InotifyWatcher:
+    """
+    Recursively watch directories for new files using Linux inotify(7).
+    """
+
+    _WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+                   | _IN_DELETE_SELF)
+
+    def __init__(self, root_dirs: list):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = (ctypes.c_int,
+                                                 ctypes.c_char_p,
+                                                 ctypes.c_uint32)
+        self._fd = self._libc.inotify_init1(O_CLOEXEC | O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+        self._overflow = False
+        for root_dir in root_dirs:
+            self._add_tree(root_dir)
+
+    def close(self):
+        close(self._fd)
+
+    def _add_watch(self, directory: str):
+        wd = self._libc.inotify_add_watch(self._fd, directory.encode(),
+                                          self._WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'Too many inotify watches, see '
+                              '/proc/sys/fs/inotify/max_user_watches')
+            _LOGGER.warning('Unable to watch %s: %s', directory,
+                            errno.errorcode.get(error, error))
+            return
+        self._watches[wd] = directory
+
+    def _add_tree(self, root_dir: str) -> list:
+        """
+        Watch ``root_dir`` and its subdirectories.
+        Returns the files which already exist in them.
+        """
+        existing_files = []
+        for directory, _, file_names in walk(root_dir):
+            self._add_watch(directory)
+            existing_files.extend(
+                join(directory, file_name) for file_name in file_names)
+        return existing_files
+
+    def rescan_needed(self) -> bool:
+        """
+        Whether events were lost (queue overflow) since the last call.
+        """
+        overflow, self._overflow = self._overflow, False
+        return overflow
+
+    def wait(self, timeout: float) -> list:
+        """
+        Wait up to ``timeout`` seconds for new or written files.
+        """
+        readable, _, _ = select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        changed_files = []
+        try:
+            buffer = read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = unpack_from(_INOTIFY_EVENT, buffer,
+                                                   offset)
+            offset += _INOTIFY_EVENT_SIZE
+            name = fsdecode(buffer[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+
+            if mask & _IN_Q_OVERFLOW:
+                self._overflow = True
+                continue
+            if mask & _IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = join(directory, name)
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    # Files may be created before the watch is in place
+                    changed_files.extend(self._add_tree(path))
+            elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                changed_files.append(path)
+        return changed_files
+
+
+class _PollingWatcher:
+    """
+    Fallback for :class:`_InotifyWatcher` which periodically scans the
+    directories (e.g. for network file systems, where inotify doesn't
+    see changes made by other hosts). Waiting is cut short when
+    ``stop_event`` gets set.
+    """
+
+    def __init__(self,
+                 root_dirs: list,
+                 poll_interval: float,
+                 stop_event: Event = None):
+        self._root_dirs = root_dirs
+        self._poll_interval = poll_interval
+        self._stop_event = stop_event if stop_event is not None else Event()
+        self._next_poll = monotonic()
+        self._snapshot = self._scan()
+
+    def close(self):
+        pass
+
+    def _scan(self) -> dict:
+        snapshot = {}
+        for root_dir in self._root_dirs:
+            for directory, _, file_names in walk(root_dir):
+                for file_name in file_names:
+                    path = join(directory, file_name)
+                    try:
+                        file_stat = stat(path)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path] = (file_stat.st_size,
+                                      file_stat.st_mtime_ns)
+        return snapshot
+
+    def rescan_needed(self) -> bool:
+        return False
+
+    def wait(self, timeout: float) -> list:
+        delay = self._next_poll - monotonic()
+        if delay > timeout:
+            self._stop_event.wait(timeout)
+            return []
+        if delay > 0 and self._stop_event.wait(delay):
+            return []
+        self._next_poll = monotonic() + self._poll_interval
+
+        snapshot = self._scan()
+        changed_files = [
+            path for path, signature in snapshot.items()
+            if self._snapshot.get(path) != signature
+        ]
+        self._snapshot = snapshot
+        return changed_files
+
+
+def watch_media_files(source_files: str,
+                      dest_dir: str,
+                      separate: bool = False,
+                      do_rename: bool = True,
+                      process_function: callable = copy,
+                      journal: _Journal = None,
+                      settle_time: float = 2.0,
+                      poll_interval: float = 10.0,
+                      polling: bool = False,
+                      stop_event: Event = None,
+                      on_result: callable = None):
+    """
+    Process the existing source files and keep watching their directories
+    for new files, until ``stop_event`` is set. ``on_result`` is called with
+    the :class:`MediaFileResult` of each input file.
+
+    New files are only processed once their size and modification time
+    didn't change for ``settle_time`` seconds, so files which are still
+    being written (or uploaded) are left alone.
+    Uses inotify, unless not available or ``polling`` is requested.
+
+    All source files are processed again when rescanning (on start and
+    when file system events got lost), so copying requires a ``journal``.
+    """
+    if stop_event is None:
+        stop_event = Event()
+
+    root_dirs = [_glob_root(abspath(source_files))]
+    dest_dir_prefix = abspath(dest_dir) + sep
+    pattern = _glob_regex(abspath(source_files))
+
+    watcher = None
+    if not polling:
+        try:
+            watcher = _InotifyWatcher(root_dirs)
+        except (OSError, AttributeError) as e:
+            _LOGGER.warning('inotify not available (%s), polling every %s '
+                            'seconds instead', e, poll_interval)
+    if watcher is None:
+        watcher = _PollingWatcher(root_dirs, poll_interval, stop_event)
+
+    def rescan():
+        process_media_files(source_files,
+                            dest_dir,
+                            separate=separate,
+                            do_rename=do_rename,
+                            process_function=process_function,
+                            journal=journal,
+                            on_result=on_result)
+
+    # Watches are in place: files arriving from now on are not missed
+    rescan()
+    _LOGGER.info('Watching %s for new files', ', '.join(root_dirs))
+
+    # Files waiting to settle: path => ((size, mtime), since)
+    pending = {}
+    try:
+        while not stop_event.is_set():
+            for path in watcher.wait(timeout=min(1.0, settle_time)):
+                # Like glob, ignore hidden (e.g. temporary upload) files
+                if (path.startswith(dest_dir_prefix)
+                        or basename(path).startswith('.')
+                        or not pattern.match(path)):
+                    continue
+                pending[path] = (None, None)
+
+            if watcher.rescan_needed():
+                _LOGGER.warning('Lost file system events, rescanning')
+                rescan()
+
+            now = monotonic()
+            for path, (signature, since) in list(pending.items()):
+                try:
+                    file_stat = stat(path)
+                except FileNotFoundError:
+                    # E.g. temporary upload file which got renamed
+                    del pending[path]
+                    continue
+                current = (file_stat.st_size, file_stat.st_mtime_ns)
+                if current != signature:
+                    pending[path] = (current, now)
+                elif now - since >= settle_time:
+                    del pending[path]
+                    result = _try_process_input_file(
+                        path,
+                        dest_dir,
+                        separate=separate,
+                        do_rename=do_rename,
+                        process_function=process_function,
+                        journal=journal)
+                    if on_result is not None:
+                        on_result(result)
+    finally:
+        watcher.close()
+
+
+def relayout_media_files(source_files: str,
+                         dest_dir: str,
+                         separate: bool = False,
+                         do_rename: bool = True,
+                         jobs: int = _DEFAULT_JOBS,
+                         process_function: callable = move,
+                         journal: _Journal = None):
+    """
+    Move already sorted media files to the layout for ``dest_dir`` and
+    ``separate``, without parsing them again.
+
+    The location is computed from the canonical file names (see
+    :func:`_canonical_name_location`), only files with other names are
+    parsed (and keep their names unless ``do_rename``). The file operations
+    are planned first and then applied in parallel (``jobs``). These are
+    simple renames within the same file system.
+    """
+    if journal is not None:
+        _resume_planned_files(journal, process_function)
+
+    root_dir = _glob_root(abspath(source_files))
+    locate_function = partial(_relayout_location, root_dir=root_dir)
+    operations = []
+    reserved_files = set()
+    for input_file in iglob(source_files, recursive=True):
+        if isdir(input_file):
+            continue
+        if journal is not None and journal.is_known(input_file):
+            continue
+        try:
+            output_file = _plan_output_file(
+                input_file,
+                dest_dir,
+                separate=separate,
+                do_rename=do_rename,
+                locate_function=locate_function,
+                reserved_files=reserved_files)
+        except:
+            _LOGGER.exception('Failed to re-layout %s.', input_file)
+            if journal is not None:
+                journal.fail(input_file)
+            continue
+        if abspath(output_file) == abspath(input_file):
+            _LOGGER.debug('Keeping %s', input_file)
+            continue
+        operations.append((input_file, output_file))
+
+    _LOGGER.info('Re-layout of %d files', len(operations))
+
+    def relayout_file(operation: tuple):
+        input_file, output_file = operation
+        if journal is not None:
+            journal.plan(input_file, output_file)
+        try:
+            # Another name if taken in the meantime (see _claim_output_file)
+            output_file = process_function(input_file,
+                                           output_file) or output_file
+        except:
+            _LOGGER.exception('Failed to re-layout %s.', input_file)
+            if journal is not None:
+                journal.fail(input_file)
+        else:
+            if journal is not None:
+                journal.done(input_file, output_file)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(relayout_file, operations):
+            pass
+
+    _remove_empty_dirs({abspath(dirname(input_file))
+                        for input_file, _ in operations}, root_dir)
+
+
+def _parse_options(args: list):
+    from argparse import ArgumentParser, ArgumentTypeError
+
+    parser = ArgumentParser(
+        description=
+        'Sort image files like Nexcloud Android client does on a smartphone.')
+
+    parser.add_argument('--source-files', dest='source_files')
+
+    parser.add_argument('--destination-dir', dest='dest_dir')
+
+    parser.add_argument('--move',
+                        dest='copy',
+                        default=True,
+                        action='store_false')
+
+    parser.add_argument('--separate',
+                        dest='separate',
+                        default=False,
+                        action='store_true')
+
+    parser.add_argument('--no-rename',
+                        dest='rename',
+                        default=True,
+                        action='store_false')
+
+    parser.add_argument('--dryrun',
+                        dest='dryrun',
+                        default=False,
+                        action='store_true')
+
+    parser.add_argument(
+        '--relayout',
+        dest='relayout',
+        default=False,
+        action='store_true',
+        help='Move already sorted source files to the layout of the '
+        'destination directory, using their file names (implies --move)')
+
+    parser.add_argument(
+        '--watch',
+        dest='watch',
+        default=False,
+        action='store_true',
+        help='Keep watching the source directories for new files '
+        '(requires --move or --journal)')
+
+    parser.add_argument(
+        '--settle-time',
+        dest='settle_time',
+        type=float,
+        default=2.0,
+        help='Seconds a new file must be unchanged before it is processed '
+        'with --watch (default: %(default)s)')
+
+    parser.add_argument(
+        '--polling',
+        dest='polling',
+        default=False,
+        action='store_true',
+        help='Poll the source directories instead of using inotify '
+        'with --watch (e.g. for network file systems)')
+
+    parser.add_argument(
+        '--poll-interval',
+        dest='poll_interval',
+        type=float,
+        default=10.0,
+        help='Seconds between scans when polling (default: %(default)s)')
+
+    journal_group = parser.add_mutually_exclusive_group()
+
+    journal_group.add_argument('--journal',
+                               dest='journal_file',
+                               metavar='JOURNAL_FILE',
+                               help='Write a journal of the file operations')
+
+    journal_group.add_argument(
+        '--resume',
+        dest='resume_file',
+        metavar='JOURNAL_FILE',
+        help='Resume the interrupted run of the given journal')
+
+    journal_group.add_argument(
+        '--undo',
+        dest='undo_file',
+        metavar='JOURNAL_FILE',
+        help='Revert the file operations of the run of the given journal')
+
+    parser.add_argument(
+        '--manifest',
+        dest='manifest_file',
+        metavar='MANIFEST_FILE',
+        help='Append a record per processed file (JSON lines) to '
+        'MANIFEST_FILE')
+
+    parser.add_argument(
+        '--manifest-digest',
+        dest='manifest_digest',
+        default=False,
+        action='store_true',
+        help='Also digest the files which are not copied for --manifest '
+        '(moved within a file system or archived), reading them once more')
+
+    def jobs_type(value: str):
+        return value if value == 'auto' else int(value)
+
+    parser.add_argument('--jobs',
+                        dest='jobs',
+                        type=jobs_type,
+                        default=_DEFAULT_JOBS,
+                        help='Number of media files parsed in parallel, '
+                        'or parallel file operations for --undo '
+                        'and --relayout (default: number of CPUs + 4, at '
+                        'most 32). '
+                        'With auto, the number of workers is tuned to the '
+                        'measured throughput')
+
+    parser.add_argument(
+        '--archives',
+        dest='archives',
+        default=False,
+        action='store_true',
+        help='Sort the media files in the zip and tar archives matching '
+        '--source-files, without extracting the archives first. '
+        'The archives are kept (also with --move)')
+
+    parser.add_argument(
+        '--output-archive',
+        dest='output_archive',
+        choices=_OUTPUT_ARCHIVE_FORMATS,
+        help='Append the sorted files to an archive per month '
+        '(YYYY/MM.tar or YYYY/MM.zip) instead of writing single files')
+
+    parser.add_argument(
+        '--output-archive-mb',
+        dest='output_archive_mb',
+        type=float,
+        default=_OUTPUT_ARCHIVE_SIZE / 1000000,
+        help='Size in MB of an output archive before continuing with '
+        'the next one (default: %(default)g)')
+
+    def shard_type(value: str):
+        try:
+            index, count = (int(number) for number in value.split('/'))
+        except ValueError:
+            raise ArgumentTypeError(f'invalid shard: {value!r} (use I/N)')
+        if not 1 <= index <= count:
+            raise ArgumentTypeError(
+                f'invalid shard: {value!r} (I must be from 1 to N)')
+        return index, count
+
+    parser.add_argument(
+        '--shard',
+        dest='shard',
+        metavar='I/N',
+        type=shard_type,
+        help='Only process shard I (from 1 to N) of the source files, '
+        'split by a hash of their path. Output file names get a digest of '
+        'their content, so N processes (or machines) can write to the same '
+        'destination directory')
+
+    parser.add_argument(
+        '--order',
+        dest='order',
+        choices=_INPUT_FILE_ORDERS,
+        default='name',
+        help='Process the source files in glob order (name) or by their '
+        'location on disk (inode number or first extent), which is faster '
+        'on rotational disks (default: %(default)s)')
+
+    parser.add_argument(
+        '--fadvise',
+        dest='fadvise',
+        default=False,
+        action='store_true',
+        help='Read the headers of upcoming source files ahead and drop '
+        'processed files from the page cache')
+
+    parser.add_argument('--max-read-mbps',
+                        dest='max_read_mbps',
+                        type=float,
+                        help='Limit reading to this many MB per second')
+
+    parser.add_argument('--max-write-mbps',
+                        dest='max_write_mbps',
+                        type=float,
+                        help='Limit writing to this many MB per second')
+
+    parser.add_argument('--max-files-per-sec',
+                        dest='max_files_per_sec',
+                        type=float,
+                        help='Limit the number of files processed per second')
+
+    for device_type, default_jobs in zip(_DEVICE_TYPES, (1, 8, 4)):
+        parser.add_argument(
+            f'--{device_type}-jobs',
+            dest=f'{device_type.replace("-", "_")}_jobs',
+            type=int,
+            default=default_jobs,
+            help=f'Maximum number of parallel operations on a {device_type} '
+            'device' + (' (network file systems and file systems without a '
+                        'block device, e.g. tmpfs, overlayfs or zfs)'
+                        if device_type == 'other' else '') +
+            ' (default: %(default)s)')
+
+    def lane_jobs_type(value: str):
+        lane, _, jobs = value.partition('=')
+        if lane not in _TRANSFER_LANES:
+            raise ArgumentTypeError(
+                'invalid lane: {!r} (choose from {})'.format(
+                    lane, ', '.join(_TRANSFER_LANES)))
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            raise ArgumentTypeError(f'invalid number of jobs: {jobs!r}')
+        if jobs < 1:
+            raise ArgumentTypeError('the number of jobs must be at least 1')
+        return lane, jobs
+
+    parser.add_argument(
+        '--lane-jobs',
+        dest='lane_jobs',
+        metavar='LANE=JOBS',
+        type=lane_jobs_type,
+        action='append',
+        default=[],
+        help='Number of parallel file operations in a lane ({}) with '
+        '--jobs greater than 1 or auto (default: {})'.format(
+            ', '.join(_TRANSFER_LANES),
+            ', '.join(f'{lane}={jobs}'
+                      for lane, jobs in _DEFAULT_LANE_JOBS.items())))
+
+    parser.add_argument(
+        '--huge-file-mb',
+        dest='huge_file_mb',
+        type=float,
+        default=_HUGE_FILE_SIZE / 1000000,
+        help='Minimum size in MB of the files in the huge lane '
+        '(default: %(default)g)')
+
+    parser.add_argument('--quiet',
+                        dest='quiet',
+                        action='store_true',
+                        help='Only log warnings, errors and summaries '
+                        '(no line per file)')
+
+    parser.add_argument(
+        '--progress',
+        dest='progress',
+        action='store_true',
+        help='Show the progress (files/s, MB/s, ETA) instead of a line per '
+        'file (implies --quiet). Unless on a terminal, a line is logged '
+        'every {:g} seconds'.format(_PROGRESS_INTERVAL))
+
+    parser.add_argument(
+        '--precount',
+        dest='precount',
+        action='store_true',
+        help='Count the source files in the background, for the ETA of '
+        '--progress before all source files are discovered')
+
+    parser.add_argument('--stats',
+                        dest='stats',
+                        action='store_true',
+                        help='Log the timings of the processing stages (per '
+                        'file extension) and the throughput at the end')
+
+    parser.add_argument(
+        '--metrics-file',
+        dest='metrics_file',
+        metavar='METRICS_FILE',
+        help='Write metrics in the Prometheus text format to METRICS_FILE '
+        '(e.g. *.prom for the textfile collector of node_exporter)')
+
+    parser.add_argument(
+        '--metrics-interval',
+        dest='metrics_interval',
+        type=float,
+        default=_METRICS_INTERVAL,
+        help='Seconds between the updates of --metrics-file '
+        '(default: %(default)g)')
+
+    parser.add_argument(
+        '--profile',
+        dest='profile_prefix',
+        metavar='PREFIX',
+        help='Profile the run (all threads) and write PREFIX.pstats and/or '
+        'PREFIX.collapsed (collapsed stacks for flame graphs)')
+
+    parser.add_argument(
+        '--profiler',
+        dest='profiler',
+        choices=_PROFILERS,
+        default='both',
+        help='Profile with cProfile (deterministic, slow), by sampling the '
+        'stacks (cheap) or both (default: %(default)s)')
+
+    parser.add_argument('--nice',
+                        dest='nice',
+                        type=int,
+                        default=0,
+                        help='Increment the nice value (CPU priority)')
+
+    parser.add_argument('--ionice',
+                        dest='ionice',
+                        choices=sorted(_IOPRIO_CLASSES),
+                        help='Set the I/O scheduling class, like ionice(1)')
+
+    server_group = parser.add_mutually_exclusive_group()
+
+    server_group.add_argument(
+        '--serve',
+        dest='serve_socket',
+        metavar='SOCKET',
+        help='Run as server, processing the jobs sent with --client')
+
+    server_group.add_argument(
+        '--client',
+        dest='client_socket',
+        metavar='SOCKET',
+        help='Send the job to the server listening on SOCKET (see --serve)')
+
+    parsed_args = parser.parse_args(args=args)
+
+    if parsed_args.serve_socket is not None:
+        if parsed_args.source_files is not None or parsed_args.dest_dir:
+            parser.error('--serve takes the jobs from --client')
+    elif parsed_args.resume_file is None and parsed_args.undo_file is None:
+        if parsed_args.source_files is None or parsed_args.dest_dir is None:
+            parser.error('the following arguments are required: '
+                         '--source-files, --destination-dir')
+    elif (parsed_args.source_files is not None
+          or parsed_args.dest_dir is not None):
+        parser.error('--resume and --undo take the options from the journal')
+
+    if parsed_args.dryrun and (parsed_args.journal_file is not None
+                               or parsed_args.resume_file is not None):
+        parser.error('--dryrun can not be combined with a journal')
+
+    for jobs_option in ('jobs', 'rotational_jobs', 'solid_state_jobs',
+                        'other_jobs'):
+        if getattr(parsed_args, jobs_option) == 'auto':
+            continue
+        if getattr(parsed_args, jobs_option) < 1:
+            parser.error('--{} must be at least 1'.format(
+                jobs_option.replace('_', '-')))
+
+    for limit in ('max_read_mbps', 'max_write_mbps', 'max_files_per_sec'):
+        if getattr(parsed_args, limit) is not None and getattr(
+                parsed_args, limit) <= 0:
+            parser.error('--{} must be positive'.format(
+                limit.replace('_', '-')))
+
+    for size_option in ('huge_file_mb', 'output_archive_mb'):
+        if getattr(parsed_args, size_option) <= 0:
+            parser.error('--{} must be positive'.format(
+                size_option.replace('_', '-')))
+
+    if parsed_args.fadvise and posix_fadvise is None:
+        parser.error('--fadvise is not supported on this platform')
+
+    if parsed_args.watch and (parsed_args.relayout
+                              or parsed_args.undo_file is not None):
+        parser.error('--watch can not be combined with --relayout or --undo')
+
+    # Copied source files would be copied again on every rescan
+    if (parsed_args.watch and parsed_args.copy
+            and parsed_args.journal_file is None
+            and parsed_args.resume_file is None):
+        parser.error('--watch requires --move or --journal')
+
+    for archive_option in ('archives', 'output_archive'):
+        if getattr(parsed_args, archive_option) and (parsed_args.watch or
+                                                     parsed_args.relayout):
+            parser.error('--{} can not be combined with --watch or '
+                         '--relayout'.format(archive_option.replace('_', '-')))
+
+    if parsed_args.shard is not None and (
+            parsed_args.watch or parsed_args.relayout
+            or parsed_args.output_archive or not parsed_args.rename):
+        parser.error('--shard can not be combined with --watch, --relayout, '
+                     '--output-archive or --no-rename')
+
+    if parsed_args.metrics_interval <= 0:
+        parser.error('--metrics-interval must be positive')
+
+    if parsed_args.precount and not parsed_args.progress:
+        parser.error('--precount requires --progress')
+
+    if parsed_args.manifest_digest and parsed_args.manifest_file is None:
+        parser.error('--manifest-digest requires --manifest')
+
+    # The jobs run in the server (see _JobHandler)
+    if (parsed_args.profile_prefix is not None
+            and parsed_args.client_socket is not None):
+        parser.error('--profile can not be combined with --client, profile '
+                     'the server with --serve --profile instead')
+
+    # Only processing reports the result of every file
+    for option, value in (('--manifest', parsed_args.manifest_file),
+                          ('--progress', parsed_args.progress or None)):
+        if value is not None and (parsed_args.watch or parsed_args.relayout
+                                  or parsed_args.undo_file is not None):
+            parser.error(f'{option} can not be combined with --watch, '
+                         '--relayout or --undo')
+
+    return parsed_args
+
+
+_OUTPUT_ARCHIVE_FORMATS = ('tar', 'zip')
+# Default size of an output archive before rolling over to the next one
+_OUTPUT_ARCHIVE_SIZE = 4 * 1000 * 1000 * 1000
+# Archives kept open at the same time (least recently used are closed)
+_MAX_OPEN_ARCHIVES = 32
+
+
+class _ArchiveBucket:
+    """
+    Output archives of a bucket (month), see :class:`_ArchiveSink`.
+    """
+
+    def __init__(self, bucket_dir: str):
+        self.bucket_dir = bucket_dir
+        # Archive (part) the next planned members go to and its planned size
+        self.part = 0
+        self.size = 0
+        # Open archive (if any) and its part
+        self.archive = None
+        self.archive_part = None
+        # Member names (also planned ones) in all archives of the bucket
+        self.names = None
+        self.lock = Lock()
+
+
+class _ArchiveSink:
+    """
+    Output backend appending the output files to an archive per bucket
+    (month) instead of writing them as single files: the output file
+    ``<dest_dir>/[<media>/]YYYY/MM/DD/<name>`` is stored as member
+    ``DD/<name>`` of ``<dest_dir>/[<media>/]YYYY/MM.tar`` (or ``.zip``).
+
+    The member of an output file is planned up front (see :meth:`plan`),
+    so the journal refers to the actual member from the start. Member names
+    are unique in all archives of a bucket, using the same counter suffix
+    as :func:`_plan_output_file`. Once an archive reaches ``max_size``, the
+    bucket rolls over to the next archive (``MM_1.tar``, ``MM_2.tar``,
+    ...). Existing archives are appended to.
+    """
+
+    def __init__(self,
+                 archive_format: str = 'tar',
+                 max_size: int = _OUTPUT_ARCHIVE_SIZE,
+                 throttle: _Throttle = None):
+        self.archive_format = archive_format
+        self.max_size = max_size
+        self.throttle = throttle
+        # Least recently used first
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def _archive_file(self, bucket: _ArchiveBucket, part: int) -> str:
+        if part == 0:
+            return f'{bucket.bucket_dir}.{self.archive_format}'
+        return f'{bucket.bucket_dir}_{part}.{self.archive_format}'
+
+    def _bucket(self, bucket_dir: str) -> _ArchiveBucket:
+        with self._lock:
+            bucket = self._buckets.get(bucket_dir)
+            if bucket is None:
+                bucket = _ArchiveBucket(bucket_dir)
+                self._buckets[bucket_dir] = bucket
+            self._buckets.move_to_end(bucket_dir)
+            open_buckets = [
+                other for other in self._buckets.values()
+                if other.archive is not None and other is not bucket
+            ]
+        # Close the least recently used archives (if not busy)
+        for other in open_buckets[:len(open_buckets) + 1 -
+                                  _MAX_OPEN_ARCHIVES]:
+            if other.lock.acquire(blocking=False):
+                try:
+                    self._close(other)
+                finally:
+                    other.lock.release()
+        return bucket
+
+    def _member_names(self, archive_file: str) -> list:
+        if self.archive_format == 'zip':
+            with ZipFile(archive_file) as archive:
+                return archive.namelist()
+        with tarfile.open(archive_file) as archive:
+            return archive.getnames()
+
+    def _load(self, bucket: _ArchiveBucket):
+        if bucket.names is not None:
+            return
+        # Continue with the archives of an earlier run
+        bucket.names = set()
+        while exists(self._archive_file(bucket, bucket.part)):
+            bucket.names.update(
+                self._member_names(self._archive_file(bucket, bucket.part)))
+            bucket.part += 1
+        bucket.part = max(bucket.part - 1, 0)
+        archive_file = self._archive_file(bucket, bucket.part)
+        bucket.size = stat(archive_file).st_size if exists(archive_file) else 0
+
+    def _open(self, bucket: _ArchiveBucket, part: int):
+        self._close(bucket)
+        archive_file = self._archive_file(bucket, part)
+        makedirs(dirname(archive_file), mode=0o755, exist_ok=True)
+        _LOGGER.debug('Opening output archive %s', archive_file)
+        if self.archive_format == 'zip':
+            # Media files are compressed already
+            bucket.archive = ZipFile(archive_file, mode='a')
+        else:
+            bucket.archive = tarfile.open(archive_file, mode='a')
+        bucket.archive_part = part
+
+    def _close(self, bucket: _ArchiveBucket):
+        if bucket.archive is not None:
+            bucket.archive.close()
+            bucket.archive = None
+            bucket.archive_part = None
+
+    def plan(self, input_file: str, output_file: str) -> str:
+        """
+        Plan the member of ``input_file`` for the output file
+        ``output_file`` (without counter suffix, see
+        :func:`_plan_output_file`) and return its name
+        (``<archive>::<member>``). The member name is reserved right away,
+        so files transferred in parallel never get the same name.
+        """
+        bucket = self._bucket(dirname(dirname(output_file)))
+        output_file_basename, output_file_ext = splitext(
+            basename(output_file))
+        member_dir = basename(dirname(output_file))
+        file_size = stat(input_file).st_size
+        with bucket.lock:
+            self._load(bucket)
+
+            member_name = f'{member_dir}/{basename(output_file)}'
+            counter = 0
+            while member_name in bucket.names:
+                counter += 1
+                _LOGGER.info(
+                    'Output archive member \033[0;33m\'%s\'\033[0;m already '
+                    'exists', member_name)
+                member_name = (f'{member_dir}/{output_file_basename}_'
+                               f'{counter}{output_file_ext}')
+            bucket.names.add(member_name)
+
+            if bucket.size > 0 and bucket.size + file_size > self.max_size:
+                bucket.part += 1
+                bucket.size = 0
+            bucket.size += file_size
+
+            archive_file = self._archive_file(bucket, bucket.part)
+        return f'{archive_file}{_ARCHIVE_MEMBER_SEPARATOR}{member_name}'
+
+    def add(self, input_file: str, output_file: str) -> str:
+        """
+        Append ``input_file`` as its planned member ``output_file`` (see
+        :meth:`plan`) and return the name of the member. Output files which
+        were not planned as a member are planned first.
+        """
+        if not _is_archive_member(output_file):
+            output_file = self.plan(input_file, output_file)
+        archive_file, _, member_name = output_file.partition(
+            _ARCHIVE_MEMBER_SEPARATOR)
+        # <bucket dir>[_<part>].<format>
+        bucket_name, _, part = splitext(basename(archive_file))[0].partition(
+            '_')
+        bucket = self._bucket(join(dirname(archive_file), bucket_name))
+        part = int(part or 0)
+        file_size = stat(input_file).st_size
+        with bucket.lock:
+            self._load(bucket)
+            # Planned by an interrupted run (see _resume_planned_files)
+            bucket.names.add(member_name)
+            if bucket.archive_part != part:
+                self._open(bucket, part)
+
+            if self.throttle is not None:
+                self.throttle.read(file_size)
+                self.throttle.write(file_size)
+            if self.archive_format == 'zip':
+                bucket.archive.write(input_file, arcname=member_name)
+                bucket.archive.fp.flush()
+            else:
+                bucket.archive.add(input_file,
+                                   arcname=member_name,
+                                   recursive=False)
+                bucket.archive.fileobj.flush()
+        return output_file
+
+    def close(self):
+        with self._lock:
+            for bucket in self._buckets.values():
+                with bucket.lock:
+                    self._close(bucket)
+
+
+def _generate_process_function(is_copy: bool,
+                               is_dryrun: bool,
+                               drop_cache: bool = False,
+                               throttle: _Throttle = None,
+                               device_slots: _DeviceSlots = None,
+                               is_extract: bool = False,
+                               archive_sink: _ArchiveSink = None,
+                               manifest_digest: bool = False):
+    copy_function = copy
+    copy_throttle = None
+    if throttle is not None and throttle.limits_bytes and not is_extract:
+        copy_function = throttle.copy
+        copy_throttle = throttle
+    # Copies digest the content for the manifest on the way (see
+    # _copy_chunked), the other files only with manifest_digest
+    can_digest = archive_sink is None and not is_dryrun
+
+    if archive_sink is not None:
+        _LOGGER.debug("Archiving files")
+        action_name = 'Archiving'
+
+        def real_makedirs(*args, **kwargs):
+            # The sink creates the directories of the archives
+            pass
+
+        def real_process_function(input_file: str, output_file: str):
+            output_file = archive_sink.add(input_file, output_file)
+            if not is_copy and not is_extract:
+                unlink(input_file)
+            return output_file
+    elif is_extract:
+        # Extracted archive members are (temporary) files in the
+        # destination directory already
+        _LOGGER.debug("Extracting archive members")
+        action_name = 'Extracting'
+        real_makedirs = makedirs
+        real_process_function = _move_exclusive
+    elif is_copy:
+        _LOGGER.debug("Copying files")
+        action_name = 'Copying'
+        real_makedirs = makedirs
+        real_process_function = partial(_copy_exclusive,
+                                        copy_function=copy_function)
+    else:
+        _LOGGER.debug("Moving files")
+        action_name = 'Moving'
+        real_makedirs = makedirs
+        real_process_function = partial(_move_exclusive,
+                                        copy_function=copy_function)
+
+    if is_dryrun:
+        _LOGGER.info("*** DRY-RUN ***")
+
+        def dummy_function(*args, **kwargs):
+            pass
+
+        action_name = '[DRY-RUN] ' + action_name
+        real_makedirs = dummy_function
+        real_process_function = dummy_function
+        drop_cache = False
+
+    # Output files to drop from the page cache (again) later on
+    written_files = deque()
+
+    def drop_from_cache(input_file: str, output_file: str):
+        # Also starts writing back the (dirty) pages of the output file,
+        # so they can be dropped when retrying later on.
+        _fadvise(input_file, 0, 0, POSIX_FADV_DONTNEED)
+        _fadvise(output_file, 0, 0, POSIX_FADV_DONTNEED)
+        written_files.append(output_file)
+        if len(written_files) > _DROP_CACHE_DELAY:
+            _fadvise(written_files.popleft(), 0, 0, POSIX_FADV_DONTNEED)
+
+    def process_function(input_file: str, output_file: str):
+        output_dir = dirname(output_file)
+
+        # _LOGGER.info('%s %s to %s', action_name, input_file, output_dir)
+        _LOGGER.info('%s \033[0;32m%s\033[0;m to \033[0;32m%s\033[0;m',
+                     action_name, input_file, output_file)
+
+        # Create destination directory
+        with _STATS.timer('mkdir', input_file):
+            real_makedirs(output_dir, mode=0o755, exist_ok=True)
+
+        # Apply the action on the file
+        # real_process_function(input_file, output_dir)
+        # The backend may choose another output file (e.g. archive member)
+        size = stat(input_file).st_size if _STATS.enabled else 0
+        digest = None
+        transfer_function = real_process_function
+        if _STATS.tracks_details and can_digest:
+            hasher = hashlib.blake2b(digest_size=_MANIFEST_DIGEST_SIZE)
+
+            def digest_copy_function(input_file: str, output_file: str):
+                nonlocal digest
+                _copy_chunked(input_file,
+                              output_file,
+                              throttle=copy_throttle,
+                              hasher=hasher)
+                digest = hasher.hexdigest()
+
+            transfer_function = partial(real_process_function,
+                                        copy_function=digest_copy_function)
+        elif _STATS.tracks_details and manifest_digest:
+            # Before archiving (and removing) it
+            with _STATS.timer('digest', input_file):
+                digest = _file_digest(input_file,
+                                      digest_size=_MANIFEST_DIGEST_SIZE)
+        if device_slots is None:
+            with _STATS.timer('transfer', input_file, size):
+                output_file = transfer_function(input_file,
+                                                output_file) or output_file
+        else:
+            with device_slots.acquire(input_file, output_dir), _STATS.timer(
+                    'transfer', input_file, size):
+                output_file = transfer_function(input_file,
+                                                output_file) or output_file
+        if _STATS.tracks_details:
+            if digest is None and manifest_digest and can_digest:
+                # Renamed, not copied
+                with _STATS.timer('digest', input_file):
+                    digest = _file_digest(output_file,
+                                          digest_size=_MANIFEST_DIGEST_SIZE)
+            _STATS.note(input_file, size=size, digest=digest)
+
+        if drop_cache:
+            drop_from_cache(input_file, output_file)
+
+        return output_file
+
+    return process_function
+
+
+def _run_processing(source_files: str, dest_dir: str, options, executor,
+                    **kwargs):
+    """
+    Run :func:`process_media_files` with the worker threads for ``options``.
+    """
+    with ExitStack() as exit_stack:
+        parse_concurrency = None
+        controller = None
+        jobs = options.jobs
+        if jobs == 'auto':
+            parse_concurrency = _StageConcurrency('parse',
+                                                  limit=_DEFAULT_JOBS,
+                                                  max_limit=_MAX_AUTO_JOBS)
+            controller = _ConcurrencyController([parse_concurrency])
+            jobs = _MAX_AUTO_JOBS
+
+        if executor is None and jobs > 1:
+            executor = exit_stack.enter_context(
+                ThreadPoolExecutor(max_workers=jobs))
+
+        transfer_lanes = None
+        if executor is not None:
+            transfer_lanes = _TransferLanes(
+                dict(options.lane_jobs),
+                huge_file_size=options.huge_file_mb * 1000000,
+                auto=controller is not None)
+            exit_stack.callback(transfer_lanes.shutdown)
+            if _STATS.enabled:
+                for lane in _TRANSFER_LANES:
+                    _STATS.queues[lane] = partial(transfer_lanes._queue_depth,
+                                                  lane)
+            if controller is not None:
+                controller.stages.extend(transfer_lanes.stages.values())
+
+        if controller is not None:
+            _STATS.decisions = controller.decisions
+            controller.start()
+            exit_stack.callback(controller.stop)
+
+        process_media_files(source_files,
+                            dest_dir,
+                            executor=executor,
+                            order=options.order,
+                            readahead=options.fadvise,
+                            parse_concurrency=parse_concurrency,
+                            transfer_lanes=transfer_lanes,
+                            **kwargs)
+
+    if controller is not None:
+        _SUMMARY_LOGGER.info(
+            'Auto jobs: %s',
+            ', '.join(f'{stage.name} workers settled at {stage.limit}'
+                      for stage in controller.stages))
+
+
+def _record_result(on_result: callable, recorders: list,
+                   result: MediaFileResult):
+    for recorder in recorders:
+        recorder(result)
+    if on_result is not None:
+        on_result(result)
+
+
+def _run(options, executor: Executor = None, on_result: callable = None):
+    """
+    Run the job for the parsed command line ``options``.
+    """
+    source_files = options.source_files
+    dest_dir = options.dest_dir
+    is_copy = options.copy
+    separate = options.separate
+    do_rename = options.rename
+    is_dryrun = options.dryrun
+    relayout = options.relayout
+    archives = options.archives
+    output_archive = options.output_archive
+    shard = options.shard
+    # Tuning is only supported for processing
+    fixed_jobs = _DEFAULT_JOBS if options.jobs == 'auto' else options.jobs
+
+    if options.undo_file is not None:
+        undo_media_files(options.undo_file,
+                         jobs=fixed_jobs,
+                         is_dryrun=is_dryrun)
+        return
+
+    journal = None
+    if options.resume_file is not None:
+        journal = _Journal(options.resume_file)
+        journal.load()
+        source_files = journal.run_options['source_files']
+        dest_dir = journal.run_options['dest_dir']
+        is_copy = journal.run_options['copy']
+        separate = journal.run_options['separate']
+        do_rename = journal.run_options['rename']
+        relayout = journal.run_options.get('relayout', False)
+        archives = journal.run_options.get('archives', False)
+        output_archive = journal.run_options.get('output_archive')
+        shard = journal.run_options.get('shard')
+        if shard is not None:
+            shard = tuple(shard)
+        _LOGGER.info('Resuming run of %s: %d planned, %d done, %d failed',
+                     options.resume_file, len(journal.planned),
+                     len(journal.finished), len(journal.failed))
+    elif options.journal_file is not None:
+        journal = _Journal(options.journal_file)
+
+    if relayout:
+        is_copy = False
+
+    if journal is not None:
+        journal.open(source_files=abspath(source_files),
+                     dest_dir=abspath(dest_dir),
+                     copy=is_copy,
+                     separate=separate,
+                     rename=do_rename,
+                     relayout=relayout,
+                     archives=archives,
+                     output_archive=output_archive,
+                     shard=shard)
+
+    throttle = None
+    if (options.max_read_mbps is not None
+            or options.max_write_mbps is not None
+            or options.max_files_per_sec is not None):
+        throttle = _Throttle(
+            read_rate=options.max_read_mbps and options.max_read_mbps * 1e6,
+            write_rate=options.max_write_mbps
+            and options.max_write_mbps * 1e6,
+            file_rate=options.max_files_per_sec)
+
+    device_slots = _DeviceSlots({
+        'rotational': options.rotational_jobs,
+        'solid-state': options.solid_state_jobs,
+        'other': options.other_jobs,
+    })
+
+    archive_sink = None
+    plan_function = None
+    if output_archive is not None:
+        archive_sink = _ArchiveSink(output_archive,
+                                    max_size=options.output_archive_mb *
+                                    1000000,
+                                    throttle=throttle)
+        plan_function = archive_sink.plan
+
+    process_function = _generate_process_function(
+        is_copy,
+        is_dryrun,
+        drop_cache=options.fadvise,
+        throttle=throttle,
+        device_slots=device_slots,
+        archive_sink=archive_sink,
+        manifest_digest=options.manifest_digest)
+    # Called with the result of every processed file
+    recorders = []
+    manifest = None
+    if options.manifest_file is not None:
+        manifest = _Manifest(options.manifest_file)
+        manifest.open()
+    # The progress shows the bytes transferred, the profile the stages
+    timed = (options.stats or manifest is not None or options.progress
+             or options.profile_prefix is not None
+             or options.metrics_file is not None)
+    if timed:
+        _STATS.enable(details=manifest is not None)
+        recorders.append(_STATS.result)
+    if manifest is not None:
+        recorders.append(manifest.write)
+    progress = None
+    if options.progress:
+        progress = _ProgressReporter()
+        recorders.append(progress.result)
+        if options.precount:
+            progress.precount(source_files, shard=shard)
+        progress.start()
+    metrics = None
+    if options.metrics_file is not None:
+        metrics = _MetricsExporter(options.metrics_file,
+                                   interval=options.metrics_interval)
+        recorders.append(metrics.result)
+        metrics.start()
+    if recorders:
+        on_result = partial(_record_result, on_result, recorders)
+
+    archive_function = None
+    extract_dir = None
+    if archives:
+        # Archive members are extracted (to a temporary file) instead
+        archive_function = _generate_process_function(
+            is_copy,
+            is_dryrun,
+            drop_cache=options.fadvise,
+            device_slots=device_slots,
+            is_extract=True,
+            archive_sink=archive_sink,
+            manifest_digest=options.manifest_digest)
+        if is_dryrun:
+            # Nothing is written to the destination directory
+            extract_dir = gettempdir()
+
+    try:
+        if relayout:
+            relayout_media_files(source_files,
+                                 dest_dir,
+                                 separate=separate,
+                                 do_rename=do_rename,
+                                 jobs=fixed_jobs,
+                                 process_function=process_function,
+                                 journal=journal)
+        elif options.watch:
+            from signal import SIGTERM, signal
+
+            stop_event = Event()
+            signal(SIGTERM, lambda signum, frame: stop_event.set())
+            try:
+                watch_media_files(source_files,
+                                  dest_dir,
+                                  separate=separate,
+                                  do_rename=do_rename,
+                                  process_function=process_function,
+                                  journal=journal,
+                                  settle_time=options.settle_time,
+                                  poll_interval=options.poll_interval,
+                                  polling=options.polling,
+                                  stop_event=stop_event,
+                                  on_result=on_result)
+            except KeyboardInterrupt:
+                pass
+        else:
+            _run_processing(source_files,
+                            dest_dir,
+                            options,
+                            separate=separate,
+                            do_rename=do_rename,
+                            process_function=process_function,
+                            journal=journal,
+                            executor=executor,
+                            on_result=on_result,
+                            throttle=throttle,
+                            device_slots=device_slots,
+                            archive_function=archive_function,
+                            extract_dir=extract_dir,
+                            shard=shard,
+                            progress=progress,
+                            plan_function=plan_function)
+    finally:
+        if archive_sink is not None:
+            archive_sink.close()
+        if journal is not None:
+            journal.close()
+        if manifest is not None:
+            manifest.close()
+        if progress is not None:
+            progress.stop()
+        if metrics is not None:
+            metrics.stop()
+        if timed:
+            _STATS.disable()
+        if options.stats:
+            _STATS.report()
+
+
+class _JobHandler(StreamRequestHandler):
+    """
+    Handle a job sent by :func:`_send_job`.
+
+    The job is a JSON object (on a single line) with the command line
+    arguments (``args``) and working directory (``cwd``) of the client.
+    The response is a JSON object per line: one for every processed file
+    (see :class:`MediaFileResult`) and a final one with the ``exit_code``.
+    """
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+            args = job['args']
+            options = _parse_options(args)
+            if (options.serve_socket is not None
+                    or options.client_socket is not None or options.watch
+                    or options.profile_prefix is not None):
+                raise ValueError('--serve, --client, --watch and --profile '
+                                 'are not supported for jobs')
+        except SystemExit:
+            # Usage errors are already reported by argparse
+            self._respond(dict(exit_code=2, error='Invalid arguments'))
+            return
+        except Exception as e:
+            self._respond(dict(exit_code=2, error=str(e)))
+            return
+
+        _LOGGER.info('Running job: %s', ' '.join(args))
+        failures = 0
+
+        def on_result(result: MediaFileResult):
+            nonlocal failures
+            failures += result.status == 'failed'
+            self._respond(result._asdict())
+
+        # Jobs run one at a time: relative paths are resolved against the
+        # working directory of the client and output file names of
+        # concurrent jobs could clash.
+        with self.server.job_lock:
+            chdir(job.get('cwd', self.server.cwd))
+            try:
+                _run(options,
+                     executor=self.server.executor,
+                     on_result=on_result)
+            except (BrokenPipeError, ConnectionResetError):
+                _LOGGER.warning('Client disconnected, job aborted')
+                return
+            except Exception as e:
+                _LOGGER.exception('Job failed')
+                self._respond(dict(exit_code=1, error=str(e)))
+                return
+            finally:
+                chdir(self.server.cwd)
+
+        self._respond(dict(exit_code=1 if failures else 0))
+
+    def _respond(self, response: dict):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+def serve(socket_path: str, jobs: int = _DEFAULT_JOBS):
+    """
+    Process the jobs sent to the Unix socket ``socket_path`` (see
+    :class:`_JobHandler`) until interrupted.
+
+    The media libraries stay loaded and the worker threads stay alive
+    between jobs, so small jobs don't pay for starting up.
+    """
+    from signal import SIGTERM, default_int_handler, signal
+
+    # Load the MediaInfo library (configuration) once
+    _backend_module('mediainfo').MediaInfo().Close()
+
+    # Stop on SIGTERM like on Ctrl+C
+    signal(SIGTERM, default_int_handler)
+
+    if jobs == 'auto':
+        jobs = _MAX_AUTO_JOBS
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor, \
+            ThreadingUnixStreamServer(socket_path, _JobHandler) as server:
+        server.executor = executor
+        server.job_lock = Lock()
+        server.cwd = getcwd()
+        _LOGGER.info('Listening on %s', socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            unlink(socket_path)
+
+
+def _send_job(socket_path: str, args: list) -> int:
+    """
+    Send a job to the server listening on ``socket_path`` and log the
+    results. Returns the exit code of the job.
+    """
+    from socket import AF_UNIX, SOCK_STREAM, socket
+
+    with socket(AF_UNIX, SOCK_STREAM) as client_socket:
+        client_socket.connect(socket_path)
+        with client_socket.makefile('rwb') as job_fd:
+            job_fd.write(
+                json.dumps(dict(args=args, cwd=getcwd())).encode() + b'\n')
+            job_fd.flush()
+            for line in job_fd:
+                response = json.loads(line)
+                if 'exit_code' in response:
+                    if 'error' in response:
+                        _LOGGER.error('Job failed: %s', response['error'])
+                    return response['exit_code']
+                if response['status'] == 'failed':
+                    _LOGGER.error('Failed to process %s: %s',
+                                  response['input_file'], response['error'])
+                elif response['status'] == 'done':
+                    _LOGGER.info('%s => %s', response['input_file'],
+                                 response['output_file'])
+
+    _LOGGER.error('Connection to server lost')
+    return 1
+
+
+# Seconds between the samples of the sampling profiler (see --profile)
+_PROFILE_SAMPLE_INTERVAL = 0.005
+_PROFILERS = ('both', 'cprofile', 'sampling')
+
+
+class _SamplingProfiler(Thread):
+    """
+    Sample the stacks of all (other) threads every ``interval`` seconds
+    (see ``--profile``). The stacks are counted as collapsed stacks
+    (``root;caller;callee count``, as used by ``flamegraph.pl``, speedscope
+    and others), rooted at the stage and the file extension the thread was
+    working on (see :attr:`_Stats.tags`), or at the thread name otherwise
+    (e.g. waiting for work).
+    """
+
+    def __init__(self, interval: float = _PROFILE_SAMPLE_INTERVAL):
+        super().__init__(name='sampling-profiler', daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        # (stage, file extension) => samples
+        self.stages = {}
+        self._stop_event = Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        from threading import enumerate as enumerate_threads
+
+        own_ident = self.ident
+        while not self._stop_event.wait(self.interval):
+            thread_names = {
+                thread.ident: thread.name
+                for thread in enumerate_threads()
+            }
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} '
+                                 f'({basename(code.co_filename)}:'
+                                 f'{code.co_firstlineno})')
+                    frame = frame.f_back
+                tag = _STATS.tags.get(ident)
+                if tag is None:
+                    root = thread_names.get(ident, str(ident))
+                    # Name of the pool or lane, without the worker number
+                    root = re.sub(r'_\d+$', '', root)
+                else:
+                    self.stages[tag] = self.stages.get(tag, 0) + 1
+                    root = f'{tag[0]} {tag[1]}'
+                stack.append(root)
+                collapsed = ';'.join(reversed(stack))
+                self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+
+    def write(self, collapsed_file: str):
+        with open(collapsed_file, 'w', encoding='utf-8') as collapsed_fd:
+            for stack, count in sorted(self.stacks.items()):
+                collapsed_fd.write(f'{stack} {count}\n')
+
+    def report(self):
+        samples = sum(self.stages.values())
+        if samples == 0:
+            return
+        _SUMMARY_LOGGER.info('Profile: %d samples while processing files',
+                             samples)
+        for (stage, extension), count in sorted(self.stages.items(),
+                                                key=lambda item: -item[1]):
+            _SUMMARY_LOGGER.info('%-10s %-8s %5.1f%%', stage, extension,
+                                 count / samples * 100)
+
+
+@contextmanager
+def _profiling(prefix: str, profiler: str = 'both'):
+    """
+    Profile all threads while running the context (see ``--profile``):
+    with cProfile, written to ``<prefix>.pstats`` (see :mod:`pstats`),
+    and/or with :class:`_SamplingProfiler`, written to
+    ``<prefix>.collapsed``.
+
+    Before Python 3.12, cProfile only profiles the thread enabling it, so a
+    profile is enabled in every thread started meanwhile (e.g. worker
+    threads) as well, and all of them are merged. Since Python 3.12, a
+    single profile covers all threads (and no other one can be enabled).
+    """
+    import cProfile
+    import pstats
+    import threading
+
+    profiles = []
+    sampler = None
+    if profiler in ('both', 'sampling'):
+        # Stage and file extension per thread
+        _STATS.tags = {}
+        sampler = _SamplingProfiler()
+        sampler.start()
+    if profiler in ('both', 'cprofile'):
+
+        def profile_thread(*args):
+            # Replaced by cProfile for the rest of the thread
+            sys.setprofile(None)
+            profile = cProfile.Profile()
+            profiles.append(profile)
+            profile.enable()
+
+        if sys.version_info < (3, 12):
+            threading.setprofile(profile_thread)
+        profiles.append(cProfile.Profile())
+        profiles[0].enable()
+
+    try:
+        yield
+    finally:
+        if profiles:
+            threading.setprofile(None)
+            profiles[0].disable()
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(f'{prefix}.pstats')
+            _SUMMARY_LOGGER.info('Profile written to %s', f'{prefix}.pstats')
+        if sampler is not None:
+            sampler.stop()
+            _STATS.tags = None
+            sampler.write(f'{prefix}.collapsed')
+            sampler.report()
+            _SUMMARY_LOGGER.info('Collapsed stacks written to %s',
+                                 f'{prefix}.collapsed')
+
+
+def main():
+    from sys import argv, stdout
+    from os import environ
+
+    log_debug = bool(environ.get('DEBUG', False))
+    logging.basicConfig(stream=stdout,
+                        level=logging.DEBUG if log_debug else logging.INFO,
+                        format='%(message)s')
+
+    options = _parse_options(argv[1:])
+
+    if (options.quiet or options.progress) and not log_debug:
+        # Only the summaries (and warnings/errors), not a line per file
+        _LOGGER.setLevel(logging.WARNING)
+        _SUMMARY_LOGGER.setLevel(logging.INFO)
+
+    # Before starting any threads, which inherit the priorities
+    if options.nice:
+        nice(options.nice)
+    if options.ionice is not None:
+        _set_io_priority(options.ionice)
+
+    profiling = nullcontext()
+    if (options.profile_prefix is not None
+            and options.client_socket is None):
+        profiling = _profiling(options.profile_prefix, options.profiler)
+
+    with profiling:
+        if options.serve_socket is not None:
+            serve(options.serve_socket, jobs=options.jobs)
+        elif options.client_socket is not None:
+            # Forward all other arguments
+            args = []
+            arg_iter = iter(argv[1:])
+            for arg in arg_iter:
+                if arg == '--client':
+                    next(arg_iter)
+                elif not arg.startswith('--client='):
+                    args.append(arg)
+            sys.exit(_send_job(options.client_socket, args))
+        else:
+            _run(options)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,882 @@
+"""
+Tests of sort_media_files.py which don't need the media libraries.
+
+Usage:
+    - python3 -m pytest test_sort_media_files.py
+"""
+import asyncio
+import hashlib
+import pstats
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedev, makedirs, remove
+from os.path import dirname, exists, join
+from stat import S_IFBLK
+from time import monotonic
+from types import SimpleNamespace
+from zipfile import ZipFile
+
+import pytest
+
+import sort_media_files
+from sort_media_files import (MediaFileResult, _ArchiveSink,
+                              _ConcurrencyController, _Journal,
+                              _MetricsExporter, _PollingWatcher,
+                              _StageConcurrency, _TokenBucket, _TransferLanes,
+                              _backing_device, _copy_exclusive,
+                              _canonical_image_location, _digest_location,
+                              _generate_process_function, _in_shard,
+                              _ingest_archive,
+                              _plan_output_file, _profiling,
+                              _resume_planned_files, _try_process_input_file,
+                              process_media_files, process_media_files_async,
+                              relayout_media_files, undo_media_files)
+
+
+def _write(file_name: str, content: bytes):
+    with open(file_name, 'wb') as file_fd:
+        file_fd.write(content)
+
+
+def _read(file_name: str) -> bytes:
+    with open(file_name, 'rb') as file_fd:
+        return file_fd.read()
+
+
+def _location(input_file: str) -> tuple:
+    return 'Pictures', join('2019', '01', '02'), '2019-01-02_03-04-05', 'jpg'
+
+
+def _crashed_run(tmp_path, is_copy: bool, output_content: bytes = None):
+    """
+    Journal of a run which crashed after writing the output file (if
+    ``output_content``), but before its ``done`` record.
+    """
+    source_dir = tmp_path / 'source'
+    output_dir = tmp_path / 'dest' / '2019' / '01' / '02'
+    makedirs(source_dir)
+    makedirs(output_dir)
+    input_file = str(source_dir / 'IMG_1234.jpg')
+    output_file = str(output_dir / '2019-01-02_03-04-05.jpg')
+    _write(input_file, b'picture')
+
+    journal_file = str(tmp_path / 'journal.jsonl')
+    journal = _Journal(journal_file)
+    journal.open(source_files=str(source_dir / '**'),
+                 dest_dir=str(tmp_path / 'dest'),
+                 copy=is_copy,
+                 separate=False,
+                 rename=True)
+    journal.plan(input_file, output_file)
+    if output_content is not None:
+        _write(output_file, output_content)
+    journal.close()
+
+    journal = _Journal(journal_file)
+    journal.load()
+    journal.open()
+    return journal, input_file, output_file
+
+
+def test_resume_keeps_copied_output_file(tmp_path):
+    journal, input_file, output_file = _crashed_run(tmp_path,
+                                                    is_copy=True,
+                                                    output_content=b'picture')
+    _resume_planned_files(journal, _generate_process_function(True, False))
+    journal.close()
+
+    assert listdir(dirname(output_file)) == ['2019-01-02_03-04-05.jpg']
+    assert exists(input_file)
+    assert journal.finished == {input_file: output_file}
+    assert not journal.planned
+
+
+def test_resume_removes_moved_input_file(tmp_path):
+    # Moved across file systems: copied, but the input file not removed yet
+    journal, input_file, output_file = _crashed_run(tmp_path,
+                                                    is_copy=False,
+                                                    output_content=b'picture')
+    _resume_planned_files(journal, _generate_process_function(False, False))
+    journal.close()
+
+    assert listdir(dirname(output_file)) == ['2019-01-02_03-04-05.jpg']
+    assert not exists(input_file)
+    assert _read(output_file) == b'picture'
+    assert journal.finished == {input_file: output_file}
+
+
+def test_resume_keeps_other_output_file(tmp_path):
+    # Another file took the name in the meantime
+    journal, input_file, output_file = _crashed_run(tmp_path,
+                                                    is_copy=True,
+                                                    output_content=b'other')
+    _resume_planned_files(journal, _generate_process_function(True, False))
+    journal.close()
+
+    other_output_file = output_file.replace('05.jpg', '05_1.jpg')
+    assert _read(output_file) == b'other'
+    assert _read(other_output_file) == b'picture'
+    assert journal.finished == {input_file: other_output_file}
+
+
+def test_resume_removes_stale_temp_files(tmp_path, monkeypatch):
+    journal, input_file, output_file = _crashed_run(tmp_path, is_copy=True)
+    output_dir = dirname(output_file)
+    stale_temp_file = join(output_dir, '.sort-media-stale.jpg')
+    _write(stale_temp_file, b'pict')
+    monkeypatch.setattr(sort_media_files, '_STALE_TEMP_FILE_AGE', -1)
+
+    _resume_planned_files(journal, _generate_process_function(True, False))
+    journal.close()
+
+    assert listdir(output_dir) == ['2019-01-02_03-04-05.jpg']
+    assert _read(output_file) == b'picture'
+
+
+def test_resume_keeps_recent_temp_files(tmp_path):
+    # Possibly written by another process
+    journal, input_file, output_file = _crashed_run(tmp_path, is_copy=True)
+    recent_temp_file = join(dirname(output_file), '.sort-media-recent.jpg')
+    _write(recent_temp_file, b'pict')
+
+    _resume_planned_files(journal, _generate_process_function(True, False))
+    journal.close()
+
+    assert exists(recent_temp_file)
+
+
+def test_claim_keeps_trailing_number_of_name(tmp_path):
+    input_file = str(tmp_path / 'IMG_1234.jpg')
+    _write(input_file, b'picture')
+    dest_dir = str(tmp_path / 'dest')
+    output_file = _plan_output_file(input_file,
+                                    dest_dir,
+                                    do_rename=False,
+                                    locate_function=_location)
+    # Written by another process in the meantime
+    makedirs(dirname(output_file))
+    _write(output_file, b'other')
+
+    output_file = _copy_exclusive(input_file, output_file)
+
+    assert output_file == join(dest_dir, '2019', '01', '02',
+                               'IMG_1234_1.jpg')
+    assert _read(output_file) == b'picture'
+
+
+def test_claim_continues_after_planned_counter(tmp_path):
+    input_file = str(tmp_path / 'IMG_1234.jpg')
+    _write(input_file, b'picture')
+    dest_dir = str(tmp_path / 'dest')
+    output_dir = join(dest_dir, '2019', '01', '02')
+    makedirs(output_dir)
+    _write(join(output_dir, '2019-01-02_03-04-05.jpg'), b'first')
+    output_file = _plan_output_file(input_file,
+                                    dest_dir,
+                                    locate_function=_location)
+    assert output_file == join(output_dir, '2019-01-02_03-04-05_1.jpg')
+    _write(output_file, b'second')
+
+    output_file = _copy_exclusive(input_file, output_file)
+
+    assert output_file == join(output_dir, '2019-01-02_03-04-05_2.jpg')
+
+
+def _sorted_files(root_dir) -> list:
+    return sorted(
+        str(path.relative_to(root_dir)) for path in root_dir.rglob('*')
+        if path.is_file())
+
+
+def test_relayout_separate_flat_library(tmp_path):
+    # Flat library named like a media subdir
+    library_dir = tmp_path / 'Pictures'
+    makedirs(library_dir / '2019' / '01' / '02')
+    _write(str(library_dir / '2019' / '01' / '02' / '2019-01-02_03-04-05.jpg'),
+           b'picture')
+    _write(str(library_dir / '2019' / '01' / '02' / '2019-01-02_03-04-06.mp4'),
+           b'video')
+
+    relayout_media_files(str(library_dir / '**'),
+                         str(library_dir),
+                         separate=True,
+                         process_function=_generate_process_function(
+                             False, False))
+
+    assert _sorted_files(library_dir) == [
+        join('Pictures', '2019', '01', '02', '2019-01-02_03-04-05.jpg'),
+        join('Videos', '2019', '01', '02', '2019-01-02_03-04-06.mp4'),
+    ]
+
+
+def test_relayout_keeps_digest_suffix(tmp_path, monkeypatch):
+    def parse(input_file: str):
+        raise AssertionError(f'{input_file} parsed')
+
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location', parse)
+    library_dir = tmp_path / 'library'
+    makedirs(library_dir / '2019' / '01' / '02')
+    _write(
+        str(library_dir / '2019' / '01' / '02' /
+            '2019-01-02_03-04-05_0123abcd.jpg'), b'picture')
+
+    relayout_media_files(str(library_dir / '**'),
+                         str(library_dir),
+                         separate=True,
+                         process_function=_generate_process_function(
+                             False, False))
+
+    assert _sorted_files(library_dir) == [
+        join('Pictures', '2019', '01', '02',
+             '2019-01-02_03-04-05_0123abcd.jpg')
+    ]
+
+
+def test_relayout_no_rename(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    library_dir = tmp_path / 'library'
+    makedirs(library_dir / '2019' / '01' / '02')
+    _write(str(library_dir / '2019' / '01' / '02' / 'IMG_1234.jpg'),
+           b'picture')
+
+    relayout_media_files(str(library_dir / '**'),
+                         str(library_dir),
+                         separate=True,
+                         do_rename=False,
+                         process_function=_generate_process_function(
+                             False, False))
+
+    assert _sorted_files(library_dir) == [
+        join('Pictures', '2019', '01', '02', 'IMG_1234.jpg')
+    ]
+
+
+def test_relayout_journals_claimed_output_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    library_dir = tmp_path / 'library'
+    makedirs(library_dir)
+    input_file = str(library_dir / 'IMG_1234.jpg')
+    _write(input_file, b'picture')
+    move_function = _generate_process_function(False, False)
+
+    def process_function(input_file: str, output_file: str):
+        # Taken in the meantime
+        makedirs(dirname(output_file))
+        _write(output_file, b'other')
+        return move_function(input_file, output_file)
+
+    journal = _Journal(str(tmp_path / 'journal.jsonl'))
+    journal.open(source_files=str(library_dir / '**'),
+                 dest_dir=str(library_dir),
+                 copy=False,
+                 separate=False,
+                 rename=True)
+    relayout_media_files(str(library_dir / '**'),
+                         str(library_dir),
+                         process_function=process_function,
+                         journal=journal)
+    journal.close()
+
+    output_file = str(library_dir / '2019' / '01' / '02' /
+                      '2019-01-02_03-04-05_1.jpg')
+    assert journal.finished == {input_file: output_file}
+    assert _read(output_file) == b'picture'
+
+
+def test_ingest_archive_dryrun(tmp_path):
+    archive_file = str(tmp_path / 'takeout.zip')
+    with ZipFile(archive_file, 'w') as archive:
+        archive.writestr('Takeout/IMG_1234.jpg', b'picture')
+    extract_dir = tmp_path / 'extract'
+    dest_dir = str(tmp_path / 'dest')
+
+    results = list(
+        _ingest_archive(archive_file,
+                        dest_dir,
+                        archive_function=_generate_process_function(
+                            True, True, is_extract=True),
+                        locate_function=_location,
+                        extract_dir=str(extract_dir)))
+
+    assert [result.status for result in results] == ['done']
+    assert not exists(dest_dir)
+    assert listdir(extract_dir) == []
+
+
+def _busy(count: int) -> int:
+    return sum(range(count))
+
+
+def test_profiling_worker_threads(tmp_path):
+    prefix = str(tmp_path / 'profile')
+    with _profiling(prefix, profiler='cprofile'):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert list(executor.map(_busy, [1000] * 8)) == [499500] * 8
+
+    calls = {
+        function: call_count
+        for (_, _, function), (_, call_count, _, _, _) in pstats.Stats(
+            f'{prefix}.pstats').stats.items()
+    }
+    assert calls['_busy'] == 8
+
+
+def test_metrics_skipped_reasons(tmp_path):
+    journal, input_file, output_file = _crashed_run(tmp_path, is_copy=True)
+    exporter = _MetricsExporter(str(tmp_path / 'metrics.prom'))
+    for result in (
+            _try_process_input_file(input_file,
+                                    str(tmp_path / 'dest'),
+                                    journal=journal),
+            _try_process_input_file(str(tmp_path / 'source'),
+                                    str(tmp_path / 'dest')),
+    ):
+        exporter.result(result)
+    journal.close()
+
+    lines = exporter._format().splitlines()
+    assert ('sort_media_files_files_total{status="skipped",'
+            'media_type="other",extension="other",reason="directory"} 1'
+            ) in lines
+    assert ('sort_media_files_files_total{status="skipped",'
+            'media_type="image",extension="jpg",reason="journaled"} 1'
+            ) in lines
+
+
+def test_metrics_media_types(tmp_path):
+    exporter = _MetricsExporter(str(tmp_path / 'metrics.prom'))
+    for input_file, output_file in (
+        ('IMG_1234.JPG', '2019-01-02_03-04-05.jpg'),
+        ('MVI_1234.MOV', '2019-01-02_03-04-05.mov'),
+        ('clip.3gp', None),
+        ('voice.amr', '2019-01-02_03-04-05.amr'),
+        ('notes.txt', None),
+        ('notes.docx', None),
+    ):
+        exporter.result(
+            MediaFileResult(input_file, 'done', output_file=output_file))
+
+    lines = [
+        line for line in exporter._format().splitlines()
+        if line.startswith('sort_media_files_files_total{')
+    ]
+    assert lines == [
+        'sort_media_files_files_total{status="done",media_type="audio",'
+        'extension="amr",reason=""} 1',
+        'sort_media_files_files_total{status="done",media_type="image",'
+        'extension="jpg",reason=""} 1',
+        'sort_media_files_files_total{status="done",media_type="other",'
+        'extension="other",reason=""} 2',
+        'sort_media_files_files_total{status="done",media_type="video",'
+        'extension="3gp",reason=""} 1',
+        'sort_media_files_files_total{status="done",media_type="video",'
+        'extension="mov",reason=""} 1',
+    ]
+
+
+def test_jpeg_without_exif_parsed_once(tmp_path, monkeypatch):
+    parsed_files = []
+
+    def read_exif_info(input_file: str, try_tags: tuple = tuple()):
+        parsed_files.append(input_file)
+        raise Exception('No EXIF info')
+
+    def mediainfo_extract(self, input_file: str, header: bytes):
+        raise AssertionError(f'{input_file} passed on to MediaInfo')
+
+    monkeypatch.setattr(sort_media_files, '_read_exif_info', read_exif_info)
+    monkeypatch.setattr(sort_media_files._MediaInfoBackend, 'extract',
+                        mediainfo_extract)
+    input_file = str(tmp_path / 'IMG_1234.jpg')
+    _write(input_file, b'\xff\xd8\xff\xe0picture')
+
+    with pytest.raises(Exception, match='No EXIF info'):
+        _canonical_image_location(input_file)
+    assert parsed_files == [input_file]
+
+
+def test_archive_sink_plans_member_names(tmp_path):
+    archive_sink = _ArchiveSink('tar')
+    output_file = str(tmp_path / 'dest' / '2019' / '01' / '02' /
+                      '2019-01-02_03-04-05.jpg')
+    input_files = []
+    for index in range(3):
+        input_files.append(str(tmp_path / f'IMG_{index}.jpg'))
+        _write(input_files[-1], b'picture %d' % index)
+    member_files = [
+        archive_sink.plan(input_file, output_file)
+        for input_file in input_files
+    ]
+    # Transferred in another order (in parallel)
+    for input_file, member_file in reversed(
+            list(zip(input_files, member_files))):
+        assert archive_sink.add(input_file, member_file) == member_file
+    archive_sink.close()
+
+    archive_file = str(tmp_path / 'dest' / '2019' / '01.tar')
+    assert member_files == [
+        f'{archive_file}::02/2019-01-02_03-04-05.jpg',
+        f'{archive_file}::02/2019-01-02_03-04-05_1.jpg',
+        f'{archive_file}::02/2019-01-02_03-04-05_2.jpg',
+    ]
+    with tarfile.open(archive_file) as archive:
+        assert archive.extractfile(
+            '02/2019-01-02_03-04-05_1.jpg').read() == b'picture 1'
+
+
+def test_resume_and_undo_archived_move(tmp_path):
+    journal, input_file, output_file = _crashed_run(tmp_path, is_copy=False)
+    archive_sink = _ArchiveSink('zip')
+    # Crashed after archiving (and removing) the input file
+    member_file = archive_sink.plan(input_file, output_file)
+    journal.plan(input_file, member_file)
+    archive_sink.add(input_file, member_file)
+    archive_sink.close()
+    remove(input_file)
+
+    _resume_planned_files(journal,
+                          _generate_process_function(
+                              False, False, archive_sink=archive_sink))
+    journal.close()
+    assert journal.finished == {input_file: member_file}
+
+    undo_media_files(journal.journal_file)
+
+    assert _read(input_file) == b'picture'
+
+
+def _source_files(source_dir, count: int) -> list:
+    makedirs(source_dir / 'DCIM')
+    input_files = []
+    for index in range(count):
+        input_files.append(str(source_dir / 'DCIM' / f'IMG_{index:04}.jpg'))
+        _write(input_files[-1], b'picture %d' % index)
+    return input_files
+
+
+def test_shards_partition_input_files(tmp_path):
+    input_files = _source_files(tmp_path / 'source', 100)
+
+    shards = [[
+        input_file for input_file in input_files
+        if _in_shard(input_file, str(tmp_path / 'source'), (index, 3))
+    ] for index in (1, 2, 3)]
+
+    assert sorted(sum(shards, [])) == input_files
+    assert all(shards)
+
+
+def test_digest_suffix_of_content(tmp_path):
+    input_file, same_file, other_file = _source_files(tmp_path / 'source',
+                                                      3)
+    _write(same_file, b'picture 0')
+
+    def location(input_file: str) -> tuple:
+        return _digest_location(input_file, locate_function=_location)
+
+    assert location(input_file) == location(same_file)
+    assert location(input_file)[2] != location(other_file)[2]
+    assert location(input_file)[2].startswith('2019-01-02_03-04-05_')
+
+
+def test_concurrent_shards_share_destination(tmp_path, monkeypatch):
+    # All pictures taken at the same second
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    input_files = _source_files(tmp_path / 'source', 120)
+    dest_dir = tmp_path / 'dest'
+
+    def run_shard(index: int):
+        process_media_files(str(tmp_path / 'source' / '**'),
+                            str(dest_dir),
+                            process_function=_generate_process_function(
+                                True, False),
+                            shard=(index, 3))
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(run_shard, (1, 2, 3)))
+
+    # Also no temporary files left
+    output_files = _sorted_files(dest_dir)
+    assert len(output_files) == len(input_files)
+    assert sorted(_read(str(dest_dir / output_file))
+                  for output_file in output_files) == sorted(
+                      _read(input_file) for input_file in input_files)
+
+
+def _check_stopped_run(source_dir, dest_dir, results: list):
+    # Every output file is complete, no temporary files are left
+    output_files = _sorted_files(dest_dir)
+    assert len(output_files) >= len(results)
+    assert all(
+        _read(join(dest_dir, output_file)) in {
+            _read(join(source_dir, 'DCIM', input_file))
+            for input_file in listdir(join(source_dir, 'DCIM'))
+        } for output_file in output_files)
+
+
+def test_async_close_early(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    _source_files(tmp_path / 'source', 200)
+    threads = set(threading.enumerate())
+
+    async def consume() -> list:
+        results = []
+        iterator = process_media_files_async(
+            str(tmp_path / 'source' / '**'),
+            str(tmp_path / 'dest'),
+            process_function=_generate_process_function(True, False),
+            jobs=2,
+            max_pending=4)
+        try:
+            async for result in iterator:
+                results.append(result)
+                if len(results) == 5:
+                    break
+        finally:
+            await iterator.aclose()
+        return results
+
+    results = asyncio.run(consume())
+
+    assert len(results) == 5
+    # No worker threads left
+    assert set(threading.enumerate()) <= threads
+    _check_stopped_run(tmp_path / 'source', tmp_path / 'dest', results)
+
+
+def test_async_cancel(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    _source_files(tmp_path / 'source', 200)
+    threads = set(threading.enumerate())
+    results = []
+
+    async def consume():
+        async for result in process_media_files_async(
+                str(tmp_path / 'source' / '**'),
+                str(tmp_path / 'dest'),
+                process_function=_generate_process_function(True, False),
+                jobs=2,
+                max_pending=4):
+            results.append(result)
+            if len(results) == 5:
+                # Wait to be cancelled
+                await asyncio.Event().wait()
+
+    async def run():
+        task = asyncio.create_task(consume())
+        while len(results) < 5:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+
+    assert len(results) == 5
+    # No worker threads left
+    assert set(threading.enumerate()) <= threads
+    _check_stopped_run(tmp_path / 'source', tmp_path / 'dest', results)
+
+
+def _journaled_run(tmp_path, is_copy: bool, count: int = 3) -> tuple:
+    input_files = _source_files(tmp_path / 'source', count)
+    journal_file = str(tmp_path / 'journal.jsonl')
+    journal = _Journal(journal_file)
+    journal.open(source_files=str(tmp_path / 'source' / '**'),
+                 dest_dir=str(tmp_path / 'dest'),
+                 copy=is_copy,
+                 separate=False,
+                 rename=True)
+    process_media_files(str(tmp_path / 'source' / '**'),
+                        str(tmp_path / 'dest'),
+                        process_function=_generate_process_function(
+                            is_copy, False),
+                        journal=journal)
+    journal.close()
+    return journal_file, input_files
+
+
+def test_journal_records_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    journal_file, input_files = _journaled_run(tmp_path, is_copy=False)
+
+    journal = _Journal(journal_file)
+    journal.load()
+
+    assert journal.run_options['copy'] is False
+    assert sorted(journal.finished) == input_files
+    assert not journal.planned and not journal.failed
+    for input_file, output_file in journal.finished.items():
+        assert not exists(input_file)
+        assert _read(output_file) == b'picture %d' % input_files.index(
+            input_file)
+
+
+def test_journal_ignores_partial_record(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    journal_file, input_files = _journaled_run(tmp_path, is_copy=True)
+    # Crashed while writing a record
+    with open(journal_file, 'a', encoding='utf-8') as journal_fd:
+        journal_fd.write('{"op":"plan","src":')
+
+    journal = _Journal(journal_file)
+    journal.load()
+    journal.open()
+    journal.close()
+
+    assert sorted(journal.finished) == input_files
+    journal = _Journal(journal_file)
+    journal.load()
+    assert sorted(journal.finished) == input_files
+
+
+def test_resume_skips_processed_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    journal_file, input_files = _journaled_run(tmp_path, is_copy=True)
+    _write(str(tmp_path / 'source' / 'DCIM' / 'IMG_new.jpg'), b'new')
+
+    journal = _Journal(journal_file)
+    journal.load()
+    journal.open()
+    results = []
+    process_media_files(str(tmp_path / 'source' / '**'),
+                        str(tmp_path / 'dest'),
+                        process_function=_generate_process_function(
+                            True, False),
+                        journal=journal,
+                        on_result=results.append)
+    journal.close()
+
+    assert sorted((result.status, result.reason) for result in results) == [
+        ('done', None)
+    ] + [('skipped', 'directory')] * 2 + [('skipped', 'journaled')] * 3
+    assert len(_sorted_files(tmp_path / 'dest')) == 4
+
+
+def test_undo_move(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    journal_file, input_files = _journaled_run(tmp_path, is_copy=False)
+
+    undo_media_files(journal_file)
+
+    for index, input_file in enumerate(input_files):
+        assert _read(input_file) == b'picture %d' % index
+    # Empty date directories are removed
+    assert listdir(tmp_path / 'dest') == []
+    journal = _Journal(journal_file)
+    journal.load()
+    assert not journal.finished
+
+
+def test_undo_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    journal_file, input_files = _journaled_run(tmp_path, is_copy=True)
+
+    undo_media_files(journal_file)
+
+    for index, input_file in enumerate(input_files):
+        assert _read(input_file) == b'picture %d' % index
+    assert listdir(tmp_path / 'dest') == []
+
+
+def test_undo_removed_output_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(sort_media_files, '_canonical_image_location',
+                        _location)
+    journal_file, input_files = _journaled_run(tmp_path, is_copy=False)
+    journal = _Journal(journal_file)
+    journal.load()
+    removed_input_file = input_files[1]
+    remove(journal.finished[removed_input_file])
+
+    undo_media_files(journal_file)
+
+    assert not exists(removed_input_file)
+    for input_file in (input_files[0], input_files[2]):
+        assert exists(input_file)
+    journal = _Journal(journal_file)
+    journal.load()
+    # Not recorded as undone
+    assert list(journal.finished) == [removed_input_file]
+
+
+class _FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_rate_and_burst(monkeypatch):
+    clock = _FakeClock()
+    monkeypatch.setattr(sort_media_files, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(sort_media_files, 'sleep', clock.sleep)
+    bucket = _TokenBucket(100, burst=200)
+
+    # Burst right away
+    bucket.consume(200)
+    assert clock.sleeps == []
+    # Then at the rate
+    bucket.consume(50)
+    assert clock.sleeps == [0.5]
+    bucket.consume(100)
+    assert clock.sleeps == [0.5, 1.0]
+    # Idle time only saves up to the burst
+    clock.now += 60
+    bucket.consume(300)
+    assert clock.sleeps == [0.5, 1.0, 1.0]
+
+
+def _tuned_limits(stage: _StageConcurrency, throughputs: list) -> list:
+    controller = _ConcurrencyController([stage])
+    limits = []
+    for elapsed, files_per_sec in enumerate(throughputs):
+        controller._tune(stage, files_per_sec, 0.0, elapsed)
+        limits.append(stage.limit)
+    return limits
+
+
+def test_controller_follows_throughput():
+    stage = _StageConcurrency('parse', limit=4, max_limit=6)
+
+    # Growing while the throughput rises (up to max_limit), turning around
+    # whenever it drops, backing off on a plateau
+    assert _tuned_limits(stage,
+                         [100, 150, 200, 250, 300, 200, 150, 150]) == [
+                             5, 6, 6, 6, 6, 5, 6, 5
+                         ]
+
+
+def test_controller_backs_off_for_next_stage():
+    stage = _StageConcurrency('parse',
+                              limit=4,
+                              max_limit=8,
+                              queue_depth=lambda: (0, 8))
+
+    # Results piling up for the next stage, whatever the throughput
+    assert _tuned_limits(stage, [100, 200, 300]) == [3, 2, 1]
+
+
+def test_backing_device(tmp_path, monkeypatch):
+    mountinfo_file = tmp_path / 'mountinfo'
+    mountinfo_file.write_text(
+        '29 1 8:2 / / rw,relatime - ext4 /dev/sda2 rw\n'
+        '30 29 0:45 / /data rw,relatime - btrfs /dev/sdb1 rw,ssd\n'
+        '31 29 0:46 / /var/lib/docker/overlay2/merged rw - overlay overlay '
+        'rw,lowerdir=/lower\n'
+        '32 29 0:47 / /tank rw shared:1 - zfs tank rw,xattr\n')
+    monkeypatch.setattr(sort_media_files, '_MOUNTINFO_FILE',
+                        str(mountinfo_file))
+    block_device = makedev(8, 17)
+
+    def stat(path: str):
+        assert path == '/dev/sdb1'
+        return SimpleNamespace(st_mode=S_IFBLK | 0o660, st_rdev=block_device)
+
+    monkeypatch.setattr(sort_media_files, 'stat', stat)
+
+    # btrfs, overlayfs, zfs and an unknown device
+    assert _backing_device(makedev(0, 45)) == block_device
+    assert _backing_device(makedev(0, 46)) is None
+    assert _backing_device(makedev(0, 47)) is None
+    assert _backing_device(makedev(0, 48)) is None
+
+
+def test_transfer_lanes(tmp_path):
+    small_file = str(tmp_path / 'small.jpg')
+    _write(small_file, b'picture')
+    huge_file = str(tmp_path / 'huge.mp4')
+    _write(huge_file, bytes(1000))
+    transfer_lanes = _TransferLanes(huge_file_size=1000)
+    try:
+        assert transfer_lanes.lane('Pictures', small_file) == 'pictures'
+        assert transfer_lanes.lane('Videos', small_file) == 'videos'
+        assert transfer_lanes.lane('Audio', small_file) == 'audio'
+        assert transfer_lanes.lane('Other', small_file) == 'other'
+        # Whatever the media type
+        assert transfer_lanes.lane('Videos', huge_file) == 'huge'
+        assert transfer_lanes.lane('Pictures', huge_file) == 'huge'
+
+        assert transfer_lanes.submit('huge', _read,
+                                     huge_file).result() == bytes(1000)
+    finally:
+        transfer_lanes.shutdown()
+
+
+def _transfer_details(tmp_path, monkeypatch, is_copy: bool,
+                      manifest_digest: bool) -> dict:
+    stats = sort_media_files._Stats()
+    stats.enable(details=True)
+    monkeypatch.setattr(sort_media_files, '_STATS', stats)
+    tmp_path.mkdir(exist_ok=True)
+    input_file = str(tmp_path / 'IMG_1234.jpg')
+    _write(input_file, b'picture')
+    output_file = str(tmp_path / 'dest' / '2019-01-02_03-04-05.jpg')
+
+    process_function = _generate_process_function(
+        is_copy, False, manifest_digest=manifest_digest)
+    assert _read(process_function(input_file, output_file)) == b'picture'
+    return stats.pop_details(input_file)
+
+
+def test_manifest_digest_while_copying(tmp_path, monkeypatch):
+    def digest(input_file: str, **kwargs):
+        raise AssertionError(f'{input_file} read again')
+
+    monkeypatch.setattr(sort_media_files, '_file_digest', digest)
+
+    details = _transfer_details(tmp_path,
+                                monkeypatch,
+                                is_copy=True,
+                                manifest_digest=False)
+
+    assert details['digest'] == hashlib.blake2b(b'picture',
+                                                digest_size=16).hexdigest()
+    assert 'digest' not in details['timings']
+
+
+def test_manifest_digest_of_renamed_files(tmp_path, monkeypatch):
+    details = _transfer_details(tmp_path,
+                                monkeypatch,
+                                is_copy=False,
+                                manifest_digest=False)
+    assert details['digest'] is None
+
+    details = _transfer_details(tmp_path / 'opt-in',
+                                monkeypatch,
+                                is_copy=False,
+                                manifest_digest=True)
+    assert details['digest'] == hashlib.blake2b(b'picture',
+                                                digest_size=16).hexdigest()
+
+
+def test_polling_watcher_stops_waiting(tmp_path):
+    stop_event = threading.Event()
+    watcher = _PollingWatcher([str(tmp_path)], 0.0, stop_event)
+    _write(str(tmp_path / 'IMG_1234.jpg'), b'picture')
+    assert watcher.wait(timeout=1.0) == [str(tmp_path / 'IMG_1234.jpg')]
+
+    watcher = _PollingWatcher([str(tmp_path)], 60.0, stop_event)
+    threading.Timer(0.1, stop_event.set).start()
+    start = monotonic()
+    assert watcher.wait(timeout=30.0) == []
+    assert monotonic() - start < 5.0